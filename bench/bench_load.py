@@ -0,0 +1,432 @@
+"""
+Banc d'essai de charge : démarre le serveur (et éventuellement le proxy MITM) en
+local, puis simule des clients qui suivent le parcours de poc-client.
+
+Usage : python bench/bench_load.py [--clients 1000] [--duration 30] [--mailbox-size 0]
+                                   [--backend log] [--server-mode threads] [--workers 1]
+                                   [--proxy] [--listeners] [--seed 42] [--output resultats.json]
+
+Chaque client s'inscrit, se connecte, consulte ses conversations puis discute :
+envoi d'un message à un partenaire, relève des messages de ce partenaire
+(get_messages depuis son curseur), pause aléatoire, et de temps en temps changement
+de partenaire. Il se déconnecte à la fin. Avec --listeners, chaque client garde en
+plus une seconde connexion en attente sur wait_messages, comme le vrai client.
+
+Les boîtes peuvent être pré-remplies (--mailbox-size messages répartis entre les
+clients). Tous les tirages dépendent de --seed : deux exécutions avec les mêmes
+paramètres envoient la même suite de requêtes.
+
+Le rapport donne, par action, le débit, les latences p50/p95/p99 et les erreurs,
+ainsi que le temps CPU et la mémoire (RSS) du serveur et du proxy (lus dans /proc,
+Linux uniquement). Le CPU du générateur est affiché aussi : s'il approche 100 %,
+c'est lui qui limite le débit mesuré.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "common"))
+sys.path.append(os.path.join(ROOT, "poc-server"))
+
+from protocol import HEADER, encode_frame
+from bench_storage import generate, populate
+
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+START_TIMEOUT = 600
+WAIT_TIMEOUT = 20
+FETCH_LIMIT = 20
+SWITCH_PROBABILITY = 0.1
+
+
+class Stats:
+    """
+    Latences et erreurs collectées par action.
+    """
+
+    def __init__(self):
+        self.latencies = {}  # action → latences en ms
+        self.errors = {}     # action → nombre d'erreurs
+
+    def record(self, action, latency, ok):
+        """
+        Enregistre une requête.
+        :param action: Action de la requête.
+        :param latency: Durée en ms.
+        :param ok: False si la requête a échoué.
+        """
+        self.latencies.setdefault(action, []).append(latency)
+        if not ok:
+            self.errors[action] = self.errors.get(action, 0) + 1
+
+    def report(self, duration):
+        """
+        Calcule le résumé par action.
+        :param duration: Durée de la mesure en secondes.
+        :return: Dictionnaire action → indicateurs.
+        """
+        results = {}
+        for action, samples in sorted(self.latencies.items()):
+            samples.sort()
+            pick = lambda q: samples[min(int(len(samples) * q), len(samples) - 1)]
+            results[action] = {
+                "requests": len(samples),
+                "throughput": len(samples) / duration,
+                "p50": pick(0.50),
+                "p95": pick(0.95),
+                "p99": pick(0.99),
+                "max": samples[-1],
+                "errors": self.errors.get(action, 0),
+            }
+        return results
+
+
+class BenchClient:
+    """
+    Connexion tramée d'un client simulé : une requête à la fois, comme ServerConnection.
+    """
+
+    def __init__(self, port, stats):
+        self.port = port
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+        self.next_id = 0
+
+    async def close(self):
+        """
+        Ferme la connexion.
+        """
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.writer = None
+
+    async def request(self, data, timed=True):
+        """
+        Envoie une requête et attend sa réponse.
+        :param data: Requête.
+        :param timed: Enregistre la latence dans les statistiques.
+        :return: Réponse (dict), ou une réponse d'erreur si la connexion a échoué.
+        """
+        start = time.perf_counter()
+        try:
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port)
+            self.next_id += 1
+            self.writer.write(encode_frame(dict(data, id=self.next_id)))
+            (size,) = HEADER.unpack(await self.reader.readexactly(HEADER.size))
+            response = json.loads(await self.reader.readexactly(size))
+        except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+            await self.close()
+            response = {"status": "error", "message": str(e)}
+        if timed:
+            self.stats.record(data["action"], (time.perf_counter() - start) * 1000,
+                              response.get("status") == "ok")
+        return response
+
+
+async def listen(client, token, deadline):
+    """
+    Attente des messages en long-poll sur une connexion dédiée (non chronométrée :
+    la durée mesure l'attente, pas le serveur).
+    :param client: Connexion dédiée.
+    :param token: Token de session.
+    :param deadline: Fin de la mesure.
+    """
+    cursor = 0
+    while time.monotonic() < deadline:
+        timeout = min(WAIT_TIMEOUT, max(deadline - time.monotonic(), 0))
+        result = await client.request({"action": "wait_messages", "token": token,
+                                       "since": cursor, "timeout": timeout}, timed=False)
+        if result.get("status") != "ok":
+            await asyncio.sleep(1)
+            continue
+        cursor = result.get("cursor", cursor)
+    await client.close()
+
+
+async def simulate(index, args, port, stats, start_at, deadline):
+    """
+    Parcours complet d'un client simulé.
+    :param index: Numéro du client (nom user{index}).
+    :param args: Paramètres du banc d'essai.
+    :param port: Port du serveur ou du proxy.
+    :param stats: Statistiques partagées.
+    :param start_at: Instant de démarrage (montée en charge progressive).
+    :param deadline: Fin de la mesure.
+    """
+    rng = random.Random(f"{args.seed}-{index}")
+    await asyncio.sleep(max(start_at - time.monotonic(), 0))
+    name = f"user{index}"
+    client = BenchClient(port, stats)
+    await client.request({"action": "register", "username": name, "password": "bench"})
+    result = await client.request({"action": "login", "username": name, "password": "bench"})
+    token = result.get("token")
+    if not token:
+        await client.close()
+        return
+    listener = None
+    if args.listeners:
+        listener = asyncio.ensure_future(listen(BenchClient(port, stats), token, deadline))
+    cursors = {}
+    partner = None
+    while time.monotonic() < deadline:
+        if partner is None or rng.random() < SWITCH_PROBABILITY:
+            await client.request({"action": "list_conversations", "token": token})
+            partner = f"user{rng.randrange(args.clients)}"
+        text = f"message de {name} " + "x" * rng.randint(5, 200)
+        await client.request({"action": "send_message", "token": token, "to": partner, "message": text})
+        result = await client.request({"action": "get_messages", "token": token, "from": partner,
+                                       "since": cursors.get(partner, 0), "limit": FETCH_LIMIT})
+        if result.get("status") == "ok":
+            cursors[partner] = result.get("cursor", 0)
+        await asyncio.sleep(rng.expovariate(1 / args.think_time) if args.think_time else 0)
+    await client.request({"action": "logout", "token": token})
+    await client.close()
+    if listener is not None:
+        await listener
+
+
+def process_tree(pid):
+    """
+    Liste un processus et ses descendants (processus du mode multi-processus).
+    :param pid: Processus racine.
+    :return: Liste de pid.
+    """
+    pids = [pid]
+    for current in pids:
+        try:
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return pids
+
+def sample(pid):
+    """
+    Lit la consommation d'un processus et de ses descendants.
+    :param pid: Processus racine.
+    :return: (temps CPU en secondes, RSS en octets).
+    """
+    cpu = rss = 0
+    for current in process_tree(pid):
+        try:
+            with open(f"/proc/{current}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / CLK_TCK  # utime + stime
+        rss += int(fields[21]) * PAGE_SIZE
+    return cpu, rss
+
+
+class Monitor:
+    """
+    Échantillonne périodiquement le CPU et la mémoire des processus mesurés.
+    """
+
+    def __init__(self, processes, interval=0.5):
+        self.processes = processes  # nom → pid
+        self.interval = interval
+        self.start = {name: sample(pid) for name, pid in processes.items()}
+        self.peak = {name: rss for name, (_, rss) in self.start.items()}
+
+    async def run(self, deadline):
+        """
+        Relève la mémoire jusqu'à la fin de la mesure (pour le maximum).
+        :param deadline: Fin de la mesure.
+        """
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.interval)
+            for name, pid in self.processes.items():
+                self.peak[name] = max(self.peak[name], sample(pid)[1])
+
+    def report(self, duration):
+        """
+        Calcule la consommation sur la durée de la mesure.
+        :param duration: Durée de la mesure en secondes.
+        :return: Dictionnaire nom → (CPU moyen en %, RSS initial et maximal en Mio).
+        """
+        results = {}
+        for name, pid in self.processes.items():
+            cpu, rss = sample(pid)
+            results[name] = {
+                "cpu_percent": (cpu - self.start[name][0]) * 100 / duration,
+                "rss_start_mib": self.start[name][1] / 2 ** 20,
+                "rss_peak_mib": max(self.peak[name], rss) / 2 ** 20,
+            }
+        return results
+
+
+def free_port():
+    """
+    Réserve un port TCP libre.
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_listening(port, process, name):
+    """
+    Attend qu'un processus accepte les connexions.
+    :param port: Port d'écoute attendu.
+    :param process: Processus lancé.
+    :param name: Nom affiché en cas d'échec.
+    """
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{name} arrêté au démarrage (code {process.returncode})")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{name} ne répond pas sur le port {port}")
+
+def start_process(script, workdir, env, name):
+    """
+    Lance un service (poc-server.py ou mitm-proxy.py) dans le dossier de travail.
+    :param script: Chemin du script depuis la racine du dépôt.
+    :param workdir: Dossier de travail (data/ et logs/ y sont créés).
+    :param env: Variables d'environnement ajoutées.
+    :param name: Nom du service (fichier de sortie <name>.out).
+    :return: Processus lancé.
+    """
+    log = open(os.path.join(workdir, f"{name}.out"), "w")
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, script)], cwd=workdir,
+                            env=dict(os.environ, **env), stdin=subprocess.DEVNULL, stdout=log, stderr=log)
+
+async def run_load(args, port, processes):
+    """
+    Lance les clients simulés et la surveillance des processus.
+    :return: (statistiques, rapport des processus, durée réelle).
+    """
+    stats = Stats()
+    begin = time.monotonic()
+    deadline = begin + args.ramp + args.duration
+    monitor = Monitor(dict(processes, **{"générateur": os.getpid()}))
+    watcher = asyncio.ensure_future(monitor.run(deadline))
+    await asyncio.gather(*[
+        simulate(i, args, port, stats, begin + args.ramp * i / args.clients, deadline)
+        for i in range(args.clients)
+    ])
+    await watcher
+    duration = time.monotonic() - begin
+    return stats.report(duration), monitor.report(duration), duration
+
+def print_actions(actions, duration):
+    """
+    Affiche le rapport par action (voir Stats.report).
+    :param actions: Indicateurs par action.
+    :param duration: Durée de la mesure en secondes.
+    """
+    print(f"\n{'action':<32} {'requêtes':>9} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'erreurs':>8}")
+    for action, r in actions.items():
+        print(f"{action:<32} {r['requests']:>9} {r['throughput']:8.1f} {r['p50']:8.2f} {r['p95']:8.2f} "
+              f"{r['p99']:8.2f} {r['max']:8.2f} {r['errors']:>8}")
+    total = sum(r["requests"] for r in actions.values())
+    print(f"{'total':<32} {total:>9} {total / duration:8.1f}")
+
+def main(args):
+    """
+    Prépare les données, démarre les services, mesure puis affiche le rapport.
+    :param args: Paramètres du banc d'essai.
+    """
+    # deux sockets par client (trois avec --listeners), côté générateur et côté serveur
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if hard < args.clients * 4:
+        print(f"[ATTENTION] limite de descripteurs ({hard}) basse pour {args.clients} clients")
+
+    workdir = tempfile.mkdtemp(prefix="bench-load-")
+    processes = {}
+    children = []
+    try:
+        data = os.path.join(workdir, "data")
+        os.makedirs(data)
+        if args.mailbox_size:
+            print(f"Pré-remplissage : {args.mailbox_size} messages...", flush=True)
+            populate(args.backend, data, generate(args.mailbox_size, args.clients, random.Random(args.seed)))
+
+        server_port = free_port()
+        server = start_process("poc-server/poc-server.py", workdir, {
+            "PORT": str(server_port),
+            "STORAGE_BACKEND": args.backend,
+            "SERVER_MODE": args.server_mode,
+            "WORKERS": str(args.workers),
+            "MAX_CONNECTIONS": str(max(args.clients * 3, 1000)),
+        }, "serveur")
+        children.append(server)
+        wait_listening(server_port, server, "serveur")
+        processes["serveur"] = server.pid
+        port = server_port
+
+        if args.proxy:
+            port = free_port()
+            proxy = start_process("mitm/mitm-proxy.py", workdir, {
+                "PROXY_PORT": str(port),
+                "REAL_SERVER": "127.0.0.1",
+                "REAL_PORT": str(server_port),
+            }, "proxy")
+            children.append(proxy)
+            wait_listening(port, proxy, "proxy")
+            processes["proxy"] = proxy.pid
+
+        print(f"{args.clients} clients pendant {args.duration} s (+{args.ramp} s de montée en charge)"
+              f"{' via le proxy' if args.proxy else ''}...", flush=True)
+        actions, usage, duration = asyncio.run(run_load(args, port, processes))
+    finally:
+        for child in children:
+            child.terminate()
+        for child in children:
+            try:
+                child.wait(10)
+            except subprocess.TimeoutExpired:
+                child.kill()
+        if args.keep:
+            print(f"Dossier de travail conservé : {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_actions(actions, duration)
+    print(f"\n{'processus':<12} {'CPU %':>7} {'RSS début Mio':>14} {'RSS max Mio':>12}")
+    for name, r in usage.items():
+        print(f"{name:<12} {r['cpu_percent']:7.1f} {r['rss_start_mib']:14.1f} {r['rss_peak_mib']:12.1f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"parameters": vars(args), "duration": duration, "actions": actions, "processes": usage},
+                      f, indent=2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Banc d'essai de charge du serveur et du proxy")
+    parser.add_argument('--clients', type=int, default=1000, help="nombre de clients simulés")
+    parser.add_argument('--duration', type=float, default=30, help="durée de la mesure (s)")
+    parser.add_argument('--ramp', type=float, default=5, help="durée de la montée en charge (s)")
+    parser.add_argument('--think-time', type=float, default=1.0, help="pause moyenne entre deux messages (s)")
+    parser.add_argument('--mailbox-size', type=int, default=0, help="messages pré-remplis (0 à 1000000)")
+    parser.add_argument('--backend', default='log', help="moteur de stockage du serveur")
+    parser.add_argument('--server-mode', default='threads', help="threads ou asyncio")
+    parser.add_argument('--workers', type=int, default=1, help="processus serveur (WORKERS)")
+    parser.add_argument('--proxy', action='store_true', help="passe par le proxy MITM")
+    parser.add_argument('--listeners', action='store_true', help="ajoute une attente wait_messages par client")
+    parser.add_argument('--seed', type=int, default=42, help="graine aléatoire")
+    parser.add_argument('--output', default=None, help="enregistre les résultats en JSON")
+    parser.add_argument('--keep', action='store_true', help="conserve le dossier de travail (données, logs)")
+    main(parser.parse_args())
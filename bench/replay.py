@@ -0,0 +1,334 @@
+"""
+Rejoue contre un serveur une capture du trafic relayé par le proxy (CAPTURE_FILE).
+
+Usage : python bench/replay.py capture.mcap [--speed 1] [--port 5000] [--host 127.0.0.1]
+                               [--start 0] [--end 60] [--backend log] [--server-mode threads]
+                               [--output resultats.json]
+
+Chaque connexion capturée est rouverte à son instant d'origine, et ses requêtes
+envoyées aux instants capturés, divisés par --speed (2 : deux fois plus vite ;
+0 : au plus vite). Dans une connexion, une requête ne part qu'après la réponse à la
+précédente, comme avec le vrai client ; les connexions, elles, sont rejouées en
+parallèle. L'attente demandée par wait_messages est elle aussi divisée par --speed
+(nulle au plus vite). Au plus vite, l'ordre entre connexions n'est plus garanti : une
+déconnexion (logout) peut précéder les dernières requêtes d'une autre connexion de la
+même session, qui échouent alors ("unauthorized").
+
+Les jetons de session capturés n'ont pas de sens pour le serveur rejoué : les
+réponses de connexion (login) du rejeu fournissent les nouveaux jetons, substitués
+dans les requêtes suivantes. Une requête qui utilise un jeton obtenu sur une autre
+connexion attend que ce jeton soit connu. Les sessions ouvertes avant le début de
+la capture ne peuvent pas être rejouées : leurs requêtes échouent ("unauthorized").
+
+Sans --port, un serveur neuf est démarré en local dans un dossier temporaire (comme
+bench_load.py), pour comparer deux versions du serveur sur le même trafic.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "common"))
+
+from protocol import HEADER, Codec, FrameDecoder, ProtocolError, decode_payload, encode_frame, is_legacy, split_header
+from capture import CLIENT_TO_SERVER, OPEN, SERVER_TO_CLIENT, read_capture
+from bench_load import Stats, free_port, print_actions, start_process, wait_listening
+
+TOKEN_WAIT = 10
+
+
+class Request:
+    """
+    Requête capturée : instant, octets envoyés, contenu décodé (None si illisible).
+    """
+
+    def __init__(self, instant, raw, req, flags):
+        self.instant = instant
+        self.raw = raw
+        self.req = req
+        self.flags = flags  # None : requête historique
+        self.token = None  # jeton délivré par la réponse capturée
+
+
+class Connection:
+    """
+    Connexion capturée : instant d'ouverture, requêtes et réponses.
+    """
+
+    def __init__(self, opened):
+        self.opened = opened
+        self.legacy = None
+        self.requests = []
+        self.responses = []
+        self.sent = FrameDecoder()
+        self.received = FrameDecoder()
+        self.legacy_request = bytearray()
+        self.legacy_response = bytearray()
+        self.last = opened
+
+    def feed(self, instant, direction, data):
+        """
+        Ajoute des octets capturés.
+        :param instant: Instant de l'enregistrement (ns).
+        :param direction: Sens du flux.
+        :param data: Octets relayés.
+        """
+        if direction == CLIENT_TO_SERVER:
+            if self.legacy is None:
+                self.legacy = is_legacy(data[:1])
+            self.last = instant
+            if self.legacy:
+                self.legacy_request += data
+                return
+            for payload, flags in self.sent.feed(data):
+                self.requests.append(Request(instant, encode_frame(payload, flags), decode(payload, flags), flags))
+        elif direction == SERVER_TO_CLIENT:
+            if self.legacy:
+                self.legacy_response += data
+                return
+            self.responses.extend(decode(payload, flags) for payload, flags in self.received.feed(data))
+
+    def finish(self):
+        """
+        Fin de la capture : associe à chaque requête le jeton de sa réponse.
+        """
+        if self.legacy and self.legacy_request:
+            raw = bytes(self.legacy_request)
+            self.requests.append(Request(self.last, raw, decode(raw, 0), None))
+            self.responses.append(decode(bytes(self.legacy_response), 0))
+        for request, response in zip(self.requests, self.responses):
+            if isinstance(response, dict) and isinstance(response.get("token"), str):
+                request.token = response["token"]
+
+
+def decode(payload, flags):
+    """
+    :return: Contenu décodé, ou None s'il est illisible.
+    """
+    try:
+        return decode_payload(payload, flags)
+    except (ProtocolError, ValueError):
+        return None
+
+
+def load_capture(path, start=None, end=None):
+    """
+    Lit une capture et la découpe en connexions.
+    :param path: Fichier de capture.
+    :param start: Début de la plage rejouée (s depuis le début de la capture).
+    :param end: Fin de la plage rejouée.
+    :return: Connexions ayant au moins une requête, par ordre d'ouverture.
+    """
+    _, records = read_capture(path, start, end)
+    connections = {}
+    for instant, connection, direction, data in records:
+        if direction == OPEN:
+            connections[connection] = Connection(instant)
+        elif connection in connections:
+            connections[connection].feed(instant, direction, data)
+    result = []
+    for connection in connections.values():
+        connection.finish()
+        if connection.requests:
+            result.append(connection)
+    return result
+
+
+class Tokens:
+    """
+    Correspondance entre jetons capturés et jetons délivrés par le serveur rejoué.
+    """
+
+    def __init__(self, captured):
+        self.captured = captured  # jetons délivrés pendant la capture
+        self.mapping = {}
+        self.known = {}  # jeton capturé → événement signalant sa correspondance
+
+    def learn(self, old, new):
+        """
+        Enregistre le jeton délivré à la place d'un jeton capturé.
+        """
+        self.mapping[old] = new
+        self._event(old).set()
+
+    def _event(self, old):
+        """
+        :return: Événement signalant la correspondance d'un jeton capturé.
+        """
+        if old not in self.known:
+            self.known[old] = asyncio.Event()
+        return self.known[old]
+
+    async def translate(self, old):
+        """
+        :param old: Jeton capturé.
+        :return: Jeton à utiliser, attendu au plus TOKEN_WAIT s s'il doit être délivré par le rejeu.
+        """
+        if old in self.captured and old not in self.mapping:
+            try:
+                await asyncio.wait_for(self._event(old).wait(), TOKEN_WAIT)
+            except asyncio.TimeoutError:
+                pass
+        return self.mapping.get(old, old)
+
+    async def prepare(self, request, speed):
+        """
+        :param request: Requête capturée.
+        :param speed: Facteur de vitesse du rejeu.
+        :return: Octets à envoyer, avec le jeton du rejeu et l'attente (wait_messages)
+                 divisée par le facteur de vitesse.
+        """
+        req = request.req
+        if not isinstance(req, dict):
+            return request.raw
+        changes = {}
+        if isinstance(req.get("token"), str):
+            token = await self.translate(req["token"])
+            if token != req["token"]:
+                changes["token"] = token
+        if req.get("action") == "wait_messages" and isinstance(req.get("timeout"), (int, float)) and speed != 1:
+            changes["timeout"] = req["timeout"] / speed if speed else 0
+        if not changes:
+            return request.raw
+        if request.flags is None:
+            return json.dumps(dict(req, **changes)).encode()
+        return Codec(request.flags, threshold=0).encode_frame(dict(req, **changes))
+
+
+async def read_response(reader, legacy):
+    """
+    Lit la réponse à une requête.
+    :return: Réponse décodée (None si illisible ou connexion fermée).
+    """
+    if legacy:
+        return decode(await reader.read(), 0)
+    header = await reader.readexactly(HEADER.size)
+    flags, size = split_header(HEADER.unpack(header)[0])
+    return decode(await reader.readexactly(size), flags)
+
+
+async def replay_connection(connection, args, tokens, stats, origin, begin):
+    """
+    Rejoue une connexion capturée.
+    :param origin: Instant capturé correspondant au début du rejeu (ns).
+    :param begin: Début du rejeu (horloge monotone).
+    """
+    async def wait(instant):
+        if args.speed:
+            delay = begin + (instant - origin) / 1e9 / args.speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    await wait(connection.opened)
+    try:
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+    except OSError as e:
+        stats.record("connect", 0, False)
+        print(f"[ERREUR] connexion : {e}")
+        return
+    try:
+        for request in connection.requests:
+            await wait(request.instant)
+            data = await tokens.prepare(request, args.speed)
+            action = request.req.get("action") if isinstance(request.req, dict) else None
+            start = time.perf_counter()
+            writer.write(data)
+            if connection.legacy:
+                writer.write_eof()
+            await writer.drain()
+            response = await read_response(reader, connection.legacy)
+            ok = isinstance(response, dict) and response.get("status") == "ok"
+            stats.record(str(action), (time.perf_counter() - start) * 1000, ok)
+            if request.token and ok and isinstance(response.get("token"), str):
+                tokens.learn(request.token, response["token"])
+    except (OSError, asyncio.IncompleteReadError) as e:
+        stats.record("connection", 0, False)
+        print(f"[ERREUR] connexion interrompue : {e}")
+    finally:
+        writer.close()
+
+
+async def run_replay(connections, args):
+    """
+    Rejoue toutes les connexions.
+    :return: (rapport par action, durée du rejeu).
+    """
+    captured = {request.token for c in connections for request in c.requests if request.token}
+    tokens = Tokens(captured)
+    stats = Stats()
+    origin = connections[0].opened
+    begin = time.monotonic()
+    await asyncio.gather(*[replay_connection(c, args, tokens, stats, origin, begin) for c in connections])
+    duration = time.monotonic() - begin
+    return stats.report(duration), duration
+
+
+def main(args):
+    """
+    Charge la capture, démarre éventuellement un serveur, rejoue et affiche le rapport.
+    :param args: Paramètres du rejeu.
+    """
+    connections = load_capture(args.capture, args.start, args.end)
+    if not connections:
+        print("Aucune requête à rejouer dans la capture")
+        return
+    connections.sort(key=lambda c: c.opened)
+    span = (max(c.last for c in connections) - connections[0].opened) / 1e9
+    requests = sum(len(c.requests) for c in connections)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    workdir = None
+    server = None
+    try:
+        if args.port is None:
+            workdir = tempfile.mkdtemp(prefix="bench-replay-")
+            os.makedirs(os.path.join(workdir, "data"))
+            args.host, args.port = "127.0.0.1", free_port()
+            server = start_process("poc-server/poc-server.py", workdir, {
+                "PORT": str(args.port),
+                "STORAGE_BACKEND": args.backend,
+                "SERVER_MODE": args.server_mode,
+                "MAX_CONNECTIONS": str(max(len(connections) * 2, 1000)),
+            }, "serveur")
+            wait_listening(args.port, server, "serveur")
+        speed = f"x{args.speed:g}" if args.speed else "au plus vite"
+        print(f"Rejeu de {requests} requêtes sur {len(connections)} connexions "
+              f"({span:.1f} s capturées, {speed}) vers {args.host}:{args.port}...", flush=True)
+        actions, duration = asyncio.run(run_replay(connections, args))
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_actions(actions, duration)
+    print(f"\nDurée : {duration:.1f} s pour {span:.1f} s capturées")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"parameters": vars(args), "duration": duration, "captured_duration": span,
+                       "actions": actions}, f, indent=2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rejeu d'une capture du proxy contre un serveur")
+    parser.add_argument('capture', help="fichier de capture (CAPTURE_FILE du proxy)")
+    parser.add_argument('--speed', type=float, default=1.0, help="facteur de vitesse (0 : au plus vite)")
+    parser.add_argument('--host', default='127.0.0.1', help="adresse du serveur")
+    parser.add_argument('--port', type=int, default=None, help="port du serveur (sans : serveur local neuf)")
+    parser.add_argument('--start', type=float, default=None, help="début de la plage rejouée (s)")
+    parser.add_argument('--end', type=float, default=None, help="fin de la plage rejouée (s)")
+    parser.add_argument('--backend', default='log', help="moteur de stockage du serveur local")
+    parser.add_argument('--server-mode', default='threads', help="mode du serveur local (threads ou asyncio)")
+    parser.add_argument('--output', default=None, help="enregistre les résultats en JSON")
+    main(parser.parse_args())
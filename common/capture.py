@@ -0,0 +1,175 @@
+"""
+Fichier de capture du trafic relayé par le proxy.
+
+Format : un en-tête (MAGIC, version, heure de début), puis une suite d'enregistrements
+(instant en ns depuis le début, connexion, sens, taille) suivis des octets relayés.
+Les sens OPEN et CLOSE marquent l'ouverture (contenu : adresse du client) et la
+fermeture d'une connexion.
+
+Les enregistrements sont accumulés en mémoire et écrits par lots dans un thread
+dédié ; un index (<fichier>.idx) associe à chaque lot l'instant de son premier
+enregistrement et sa position dans le fichier, pour lire une plage de temps sans
+parcourir toute la capture.
+"""
+import os
+import time
+import struct
+import logging
+import threading
+from bisect import bisect_right
+
+from metrics import REGISTRY
+
+MAGIC = b"MCAP"
+VERSION = 1
+FILE_HEADER = struct.Struct(">4sHd")  # magic, version, heure de début (epoch)
+RECORD = struct.Struct(">QIBI")       # instant (ns), connexion, sens, taille
+INDEX = struct.Struct(">QQ")          # instant du premier enregistrement du lot, position
+CLIENT_TO_SERVER = 0
+SERVER_TO_CLIENT = 1
+OPEN = 2
+CLOSE = 3
+
+captured_bytes = REGISTRY.counter("capture_bytes_total", "Octets écrits dans le fichier de capture")
+dropped_records = REGISTRY.counter("capture_records_dropped_total", "Enregistrements perdus (écriture trop lente)")
+
+
+class CaptureWriter:
+    """
+    Écriture d'une capture par lots : record() ne fait qu'ajouter au tampon courant.
+    Le fichier (remplacé s'il existe) est écrit dès que le tampon atteint `batch` octets,
+    et au plus tard après `interval` secondes. Au-delà de `max_pending` octets en attente,
+    les enregistrements sont perdus plutôt que de saturer la mémoire.
+    """
+
+    def __init__(self, path, batch=256 * 1024, interval=1.0, max_pending=64 * 1024 * 1024):
+        self.path = path
+        self.batch = batch
+        self.interval = interval
+        self.max_pending = max_pending
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.file = open(path, "wb")
+        self.index = open(path + ".idx", "wb")
+        self.file.write(FILE_HEADER.pack(MAGIC, VERSION, time.time()))
+        self.start = time.monotonic_ns()
+        self.buffer = bytearray()
+        self.first = 0  # instant du premier enregistrement du tampon
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def record(self, connection, direction, data=b""):
+        """
+        Ajoute un enregistrement au tampon.
+        :param connection: Identifiant de la connexion.
+        :param direction: CLIENT_TO_SERVER, SERVER_TO_CLIENT, OPEN ou CLOSE.
+        :param data: Octets relayés.
+        """
+        now = time.monotonic_ns() - self.start
+        with self.lock:
+            if len(self.buffer) >= self.max_pending:
+                dropped_records.inc()
+                return
+            if not self.buffer:
+                self.first = now
+            self.buffer += RECORD.pack(now, connection, direction, len(data))
+            self.buffer += data
+            full = len(self.buffer) >= self.batch
+        if full:
+            self.ready.set()
+
+    def _run(self):
+        """
+        Thread d'écriture.
+        """
+        while not self.stopped:
+            self.ready.wait(self.interval)
+            self.ready.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Écrit le tampon courant et son entrée d'index.
+        """
+        with self.lock:
+            buffer, first = self.buffer, self.first
+            self.buffer = bytearray()
+        if not buffer:
+            return
+        try:
+            self.index.write(INDEX.pack(first, self.file.tell()))
+            self.file.write(buffer)
+            self.file.flush()
+            self.index.flush()
+            captured_bytes.inc(len(buffer))
+        except (OSError, ValueError) as e:
+            logging.error(f"Écriture de la capture {self.path} échouée : {e}")
+
+    def close(self):
+        """
+        Écrit ce qui reste en mémoire et ferme la capture.
+        """
+        self.stopped = True
+        self.ready.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+        self.index.close()
+
+
+def read_index(path):
+    """
+    :param path: Fichier de capture.
+    :return: Liste des (instant, position) des lots, vide sans index.
+    """
+    try:
+        with open(path + ".idx", "rb") as f:
+            data = f.read()
+    except OSError:
+        return []
+    return [INDEX.unpack_from(data, offset) for offset in range(0, len(data) - INDEX.size + 1, INDEX.size)]
+
+
+def read_capture(path, start=None, end=None):
+    """
+    Parcourt une capture.
+    :param path: Fichier de capture.
+    :param start: Instant (en secondes depuis le début) des premiers enregistrements voulus.
+    :param end: Instant au-delà duquel la lecture s'arrête.
+    :return: (heure de début, générateur de (instant en ns, connexion, sens, octets)).
+    """
+    f = open(path, "rb")
+    header = f.read(FILE_HEADER.size)
+    if len(header) < FILE_HEADER.size:
+        f.close()
+        raise ValueError(f"{path} : capture vide")
+    magic, version, started = FILE_HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        f.close()
+        raise ValueError(f"{path} : format de capture inconnu")
+    start_ns = int(start * 1e9) if start is not None else None
+    end_ns = int(end * 1e9) if end is not None else None
+    if start_ns:
+        index = read_index(path)
+        position = bisect_right(index, (start_ns, float("inf"))) - 1
+        if position >= 0:
+            f.seek(index[position][1])
+
+    def records():
+        with f:
+            while True:
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    return  # fin de fichier (ou dernier enregistrement tronqué)
+                instant, connection, direction, size = RECORD.unpack(header)
+                data = f.read(size)
+                if len(data) < size or (end_ns is not None and instant > end_ns):
+                    return
+                if start_ns is None or instant >= start_ns:
+                    yield instant, connection, direction, data
+
+    return started, records()
@@ -0,0 +1,256 @@
+"""
+Journalisation hors du chemin critique des requêtes.
+
+En mode asynchrone, le thread qui traite une requête se contente de placer
+l'enregistrement dans une file bornée (QueueHandler) ; la mise en forme et
+l'écriture ont lieu dans un thread dédié (QueueListener), qui regroupe les
+écritures sur disque et ne vide le tampon du fichier que lorsque la file est vide
+ou que LOG_BATCH lignes sont en attente.
+
+log_event produit des événements structurés : les champs restent des objets Python
+jusqu'à leur mise en forme dans le thread d'écriture, en texte (message clé=valeur)
+ou en JSONL (un objet JSON par ligne). Ces champs ne doivent donc plus être
+modifiés après l'appel. Les événements de niveau INFO ou inférieur peuvent être
+échantillonnés par action (LOG_SAMPLING).
+"""
+import os
+import sys
+import json
+import atexit
+import queue
+import random
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+from metrics import REGISTRY
+
+TEXT_FORMAT = "[%(asctime)s] [%(levelname)s] %(message)s"
+
+dropped_records = REGISTRY.counter("log_records_dropped_total", "Lignes de log perdues (file pleine)")
+
+
+def parse_sampling(spec):
+    """
+    Lit une configuration d'échantillonnage "action=taux,action=taux".
+    :param spec: Texte de configuration (taux entre 0 et 1).
+    :return: {action : taux}.
+    """
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        action, _, rate = item.partition("=")
+        try:
+            rates[action.strip()] = min(max(float(rate), 0.0), 1.0)
+        except ValueError:
+            logging.warning(f"Échantillonnage des logs ignoré : {item}")
+    return rates
+
+
+class Sampler:
+    """
+    Décide si un événement est journalisé, selon le taux de son action.
+    """
+
+    def __init__(self, rates=None):
+        self.rates = rates or {}
+
+    def keep(self, action):
+        """
+        :param action: Action de l'événement (None : toujours gardé).
+        :return: True si l'événement doit être journalisé.
+        """
+        rate = self.rates.get(action, 1.0) if isinstance(action, str) else 1.0
+        return rate >= 1.0 or (rate > 0.0 and random.random() < rate)
+
+
+sampler = Sampler()
+listener = None
+
+
+def log_event(level, message, logger=None, /, **fields):
+    """
+    Journalise un événement structuré sans le mettre en forme.
+    :param level: Niveau (logging.INFO...).
+    :param message: Message fixe, sans valeur variable.
+    :param logger: Logger utilisé (racine par défaut).
+    :param fields: Champs de l'événement ; "action" sert à l'échantillonnage.
+    """
+    logger = logger or logging.getLogger()
+    if not logger.isEnabledFor(level):
+        return
+    if level <= logging.INFO and not sampler.keep(fields.get("action")):
+        return
+    logger.log(level, message, extra={"fields": fields})
+
+
+def render_value(value):
+    """
+    :return: Valeur d'un champ en texte (JSON compact pour les objets).
+    """
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Format texte historique, suivi des champs de l'événement (clé=valeur).
+    """
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={render_value(value)}" for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Un objet JSON par ligne : horodatage, niveau, logger, message, champs.
+    """
+
+    def format(self, record):
+        entry = {"time": round(record.created, 6), "level": record.levelname,
+                 "logger": record.name, "message": record.getMessage()}
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Place l'enregistrement tel quel dans la file : la mise en forme est laissée au
+    thread d'écriture. Une file pleine fait perdre la ligne plutôt que bloquer.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            # la pile d'appels doit être rendue avant que les cadres ne changent
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records.inc()
+
+
+class BatchFileHandler(logging.FileHandler):
+    """
+    Fichier de log dont le tampon n'est vidé qu'après `batch` lignes, ou quand le
+    thread d'écriture n'a plus rien à traiter (voir BatchQueueListener).
+    """
+
+    def __init__(self, filename, batch=256):
+        super().__init__(filename, encoding="utf-8")
+        self.batch = batch
+        self.pending = 0
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+            self.pending += 1
+            if self.pending >= self.batch:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        super().flush()
+        self.pending = 0
+
+
+class BatchQueueListener(QueueListener):
+    """
+    Thread d'écriture : vide les tampons des fichiers avant de s'endormir sur la file.
+    """
+
+    def dequeue(self, block):
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            for handler in self.handlers:
+                handler.flush()
+            return self.queue.get(block)
+
+
+def start_listener(records, handlers):
+    """
+    Démarre le thread d'écriture.
+    :param records: File des enregistrements.
+    :param handlers: Gestionnaires qui écrivent les enregistrements.
+    """
+    global listener
+    listener = BatchQueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+
+
+def stop_logging():
+    """
+    Écrit les lignes encore en file et arrête le thread d'écriture.
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+        for handler in logging.getLogger().handlers:
+            handler.flush()
+
+
+def setup_logging(path, level=logging.INFO, structured=False, use_queue=True, queue_size=10000,
+                  batch=256, sampling="", console=None):
+    """
+    Configure le logger racine.
+    :param path: Fichier de log.
+    :param level: Niveau minimal.
+    :param structured: JSONL plutôt que texte.
+    :param use_queue: Écriture asynchrone (sinon, écriture dans le thread appelant).
+    :param queue_size: Lignes en attente au-delà desquelles les nouvelles sont perdues.
+    :param batch: Lignes écrites avant de vider le tampon du fichier.
+    :param sampling: Taux d'échantillonnage par action ("get_messages=0.01,...").
+    :param console: Nom d'un logger dont les messages sont aussi affichés sur la sortie standard.
+    """
+    sampler.rates = parse_sampling(sampling)
+    formatter = JsonFormatter() if structured else TextFormatter(TEXT_FORMAT)
+    file_handler = BatchFileHandler(path, batch) if use_queue else logging.FileHandler(path, encoding="utf-8")
+    file_handler.setFormatter(formatter)
+    handlers = [file_handler]
+    if console:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(TextFormatter("%(message)s"))
+        console_handler.addFilter(logging.Filter(console))
+        handlers.append(console_handler)
+    root = logging.getLogger()
+    root.setLevel(level)
+    if not use_queue:
+        for handler in handlers:
+            root.addHandler(handler)
+        return
+    queue_handler = LazyQueueHandler(queue.Queue(queue_size))
+    start_listener(queue_handler.queue, handlers)
+    root.addHandler(queue_handler)
+    atexit.register(stop_logging)
+
+    def before_fork():
+        for handler in handlers:
+            handler.acquire()
+            handler.flush()  # sinon le tampon serait écrit par les deux processus
+
+    def after_fork_in_parent():
+        for handler in handlers:
+            handler.release()
+
+    def after_fork_in_child():
+        # le thread d'écriture n'existe pas dans le processus fils (verrous réinitialisés par logging)
+        queue_handler.queue = queue.Queue(queue_size)
+        start_listener(queue_handler.queue, handlers)
+
+    os.register_at_fork(before=before_fork, after_in_parent=after_fork_in_parent,
+                        after_in_child=after_fork_in_child)
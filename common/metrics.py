@@ -0,0 +1,322 @@
+"""
+Métriques internes (compteurs, jauges, histogrammes) exposées au format texte
+de Prometheus sur un port local, et résumé périodique optionnel dans les logs.
+
+Chaque série est identifiée par son nom et ses étiquettes ; les valeurs sont
+protégées par un verrou par métrique, les mises à jour restent en O(1).
+"""
+import time
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names, values, extra=()):
+    """
+    Construit la partie {nom="valeur",...} d'une ligne Prometheus.
+    :param names: Noms des étiquettes.
+    :param values: Valeurs, dans le même ordre.
+    :param extra: Couples (nom, valeur) ajoutés à la fin (le "le" des histogrammes).
+    :return: Texte, vide sans étiquette.
+    """
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    """
+    Base des métriques : une valeur par combinaison d'étiquettes.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}  # valeurs des étiquettes → valeur
+
+    def _key(self, labels):
+        """
+        :param labels: Étiquettes fournies (les absentes valent "").
+        :return: Clé de la série.
+        """
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def render(self):
+        """
+        :return: Lignes au format texte de Prometheus.
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{format_labels(self.labels, key)} {value}")
+        return lines
+
+    def summary(self):
+        """
+        :return: Valeurs résumées pour les logs : {étiquettes : valeur}.
+        """
+        with self.lock:
+            return {format_labels(self.labels, key): value for key, value in self.values.items()}
+
+
+class Counter(Metric):
+    """
+    Compteur croissant.
+    """
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        """
+        Incrémente le compteur.
+        :param amount: Valeur ajoutée.
+        :param labels: Étiquettes de la série.
+        """
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Valeur instantanée, modifiée directement ou calculée à la lecture.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def inc(self, amount=1, **labels):
+        """
+        Augmente la jauge.
+        :param amount: Valeur ajoutée.
+        :param labels: Étiquettes de la série.
+        """
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """
+        Diminue la jauge.
+        """
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        """
+        Fixe la valeur de la jauge.
+        """
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def render(self):
+        """
+        Relit la valeur calculée avant l'affichage.
+        """
+        if self.function is not None:
+            self.set(self.function())
+        return super().render()
+
+    def summary(self):
+        """
+        Relit la valeur calculée avant le résumé.
+        """
+        if self.function is not None:
+            self.set(self.function())
+        return super().summary()
+
+
+class Histogram(Metric):
+    """
+    Distribution de durées (en secondes) par tranches cumulées.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """
+        Enregistre une mesure.
+        :param value: Valeur mesurée.
+        :param labels: Étiquettes de la série.
+        """
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Chronomètre un bloc de code.
+        :param labels: Étiquettes de la série.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        """
+        :return: Tranches cumulées, somme et nombre de mesures de chaque série.
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = [(key, list(counts), total, count) for key, (counts, total, count) in self.values.items()]
+        for key, counts, total, count in items:
+            cumulated = 0
+            for bound, bucket in zip(self.buckets + ("+Inf",), counts):
+                cumulated += bucket
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, [('le', bound)])} {cumulated}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+    def summary(self):
+        """
+        :return: Nombre de mesures et durée cumulée de chaque série.
+        """
+        with self.lock:
+            return {format_labels(self.labels, key): f"{count} en {total * 1000:.1f} ms"
+                    for key, (_, total, count) in self.values.items()}
+
+
+class Registry:
+    """
+    Ensemble des métriques d'un processus.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        """
+        Enregistre une métrique et la retourne.
+        """
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        """
+        Crée un compteur.
+        :param name: Nom Prometheus.
+        :param help: Description.
+        :param labels: Noms des étiquettes.
+        """
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), function=None):
+        """
+        Crée une jauge.
+        :param function: Calcule la valeur à chaque lecture (sans étiquette).
+        """
+        return self._add(Gauge(name, help, labels, function))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        Crée un histogramme.
+        :param buckets: Bornes supérieures des tranches.
+        """
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """
+        :return: Toutes les métriques au format texte de Prometheus.
+        """
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Répond à GET /metrics avec le contenu du registre.
+    """
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        """
+        Sert /metrics, 404 ailleurs.
+        """
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # pas de ligne par requête de collecte
+
+
+def start_metrics_server(port, host="127.0.0.1", registry=REGISTRY):
+    """
+    Expose les métriques sur http://host:port/metrics dans un thread dédié.
+    :param port: Port d'écoute (0 : désactivé).
+    :param host: Adresse d'écoute (locale par défaut).
+    :param registry: Registre exposé.
+    :return: Serveur HTTP, ou None si désactivé ou si le port est indisponible.
+    """
+    if not port:
+        return None
+    handler = type("Handler", (MetricsHandler,), {"registry": registry})
+    try:
+        server = ThreadingHTTPServer((host, port), handler)
+    except OSError as e:
+        logging.error(f"Métriques indisponibles sur {host}:{port} : {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Métriques exposées sur http://{host}:{port}/metrics")
+    return server
+
+
+def start_stats_dump(interval, registry=REGISTRY):
+    """
+    Écrit périodiquement un résumé des métriques dans les logs.
+    :param interval: Période en secondes (0 : désactivé).
+    :param registry: Registre résumé.
+    """
+    if not interval:
+        return
+
+    def dump():
+        """
+        Boucle d'écriture du résumé.
+        """
+        while True:
+            time.sleep(interval)
+            parts = []
+            for metric in registry.metrics:
+                for labels, value in metric.summary().items():
+                    parts.append(f"{metric.name}{labels}={value}")
+            logging.info("Statistiques : " + " ".join(parts))
+
+    threading.Thread(target=dump, daemon=True).start()
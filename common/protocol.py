@@ -0,0 +1,347 @@
+"""
+Protocole client/serveur.
+
+Deux modes coexistent sur le port du serveur :
+* historique : un objet JSON brut par connexion, la réponse est suivie de la fermeture ;
+* tramé : chaque message est précédé de sa taille sur 4 octets (big-endian),
+  la connexion reste ouverte et le client peut enchaîner les requêtes sans attendre
+  les réponses. Le champ "id" d'une requête est recopié dans sa réponse.
+
+Le premier octet reçu suffit à distinguer les deux modes : une requête historique
+commence par '{' (ou un blanc), alors que l'octet de poids fort de l'en-tête d'une
+trame ne porte que des indicateurs d'encodage (taille maximale 16 Mio) :
+* FLAG_COLUMNAR : les listes d'objets de mêmes clés du premier niveau sont envoyées
+  en colonnes ({"$columns": [...], "$rows": [[...], ...]}), sans répéter les clés ;
+* FLAG_MSGPACK : contenu en MessagePack plutôt qu'en JSON ;
+* FLAG_ZLIB / FLAG_ZSTD : contenu compressé.
+Aucune combinaison de ces bits ne donne un premier octet de requête historique.
+
+Chaque trame décrit son propre encodage. Par défaut tout est en JSON ; l'action
+"negotiate" indique au serveur ce que le client sait lire, et les réponses suivantes
+de la connexion utilisent l'encodage retenu (voir Codec). MessagePack et zstd ne
+sont proposés que si les modules msgpack et zstandard sont installés.
+"""
+import json
+import zlib
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+HEADER = struct.Struct(">I")
+SIZE_MASK = 0x00FFFFFF
+MAX_FRAME_SIZE = SIZE_MASK
+LEGACY_FIRST_BYTES = b"{ \t\r\n"
+FLAG_COLUMNAR = 0x08
+FLAG_MSGPACK = 0x10
+FLAG_ZLIB = 0x40
+FLAG_ZSTD = 0x80
+COMPRESSION_FLAGS = FLAG_ZLIB | FLAG_ZSTD
+KNOWN_FLAGS = FLAG_COLUMNAR | FLAG_MSGPACK | COMPRESSION_FLAGS
+COMPRESSION_THRESHOLD = 1024
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+DECOMPRESSION_ERRORS = (zlib.error, ValueError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+class ProtocolError(Exception):
+    """
+    Flux reçu incompatible avec le protocole (trame trop grande, connexion coupée en pleine trame...).
+    """
+
+
+def is_legacy(first_byte):
+    """
+    Indique si une connexion utilise le mode historique.
+    :param first_byte: Premier octet reçu sur la connexion.
+    :return: True pour une requête JSON brute.
+    """
+    return first_byte in LEGACY_FIRST_BYTES
+
+def split_header(value):
+    """
+    Sépare les indicateurs d'encodage et la taille d'un en-tête de trame.
+    :param value: En-tête décodé (entier).
+    :return: (indicateurs, taille).
+    """
+    return value >> 24, value & SIZE_MASK
+
+def encode_frame(payload, flags=0):
+    """
+    Construit une trame.
+    :param payload: Objet à envoyer en JSON (dict) ou contenu déjà encodé (bytes).
+    :param flags: Indicateurs d'encodage d'un contenu déjà encodé.
+    :return: Trame prête à être envoyée.
+    """
+    if not isinstance(payload, bytes):
+        payload = json.dumps(payload).encode()
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"trame trop grande ({len(payload)} octets)")
+    return HEADER.pack(flags << 24 | len(payload)) + payload
+
+def to_columns(obj):
+    """
+    Met en colonnes les listes d'objets de mêmes clés du premier niveau.
+    :param obj: Objet à envoyer (dict).
+    :return: Objet transformé (l'original n'est pas modifié).
+    """
+    if not isinstance(obj, dict):
+        return obj
+    packed = obj
+    for key, value in obj.items():
+        if not isinstance(value, list) or len(value) < 2 or not isinstance(value[0], dict):
+            continue
+        columns = value[0].keys()
+        if not all(isinstance(item, dict) and item.keys() == columns for item in value):
+            continue
+        if packed is obj:
+            packed = dict(obj)
+        columns = list(columns)
+        packed[key] = {"$columns": columns, "$rows": [[item[c] for c in columns] for item in value]}
+    return packed
+
+def from_columns(obj):
+    """
+    Inverse de to_columns.
+    :param obj: Objet reçu.
+    :return: Objet dont les colonnes sont redevenues des listes d'objets.
+    """
+    if not isinstance(obj, dict):
+        return obj
+    for key, value in obj.items():
+        if isinstance(value, dict) and value.keys() == {"$columns", "$rows"}:
+            columns = value["$columns"]
+            obj[key] = [dict(zip(columns, row)) for row in value["$rows"]]
+    return obj
+
+def compress(data, flag):
+    """
+    :param data: Contenu encodé.
+    :param flag: FLAG_ZLIB ou FLAG_ZSTD.
+    :return: Contenu compressé.
+    """
+    if flag == FLAG_ZSTD:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, ZLIB_LEVEL)
+
+def decompress(data, flags):
+    """
+    Décompresse un contenu, sans dépasser la taille maximale d'une trame.
+    :param data: Contenu reçu.
+    :param flags: Indicateurs de la trame.
+    :return: Contenu décompressé (inchangé sans indicateur de compression).
+    """
+    try:
+        if flags & FLAG_ZSTD:
+            if zstandard is None:
+                raise ProtocolError("trame zstd reçue sans le module zstandard")
+            chunks = []
+            with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+                received = 0
+                while received <= MAX_FRAME_SIZE:
+                    chunk = reader.read(65536)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                    received += len(chunk)
+            data = b"".join(chunks)
+        elif flags & FLAG_ZLIB:
+            data = zlib.decompressobj().decompress(data, MAX_FRAME_SIZE + 1)
+    except DECOMPRESSION_ERRORS as e:
+        raise ProtocolError(f"trame compressée invalide : {e}")
+    if len(data) > MAX_FRAME_SIZE:
+        raise ProtocolError("trame décompressée trop grande")
+    return data
+
+def decode_payload(data, flags=0):
+    """
+    Décode le contenu d'une trame.
+    :param data: Contenu reçu.
+    :param flags: Indicateurs de la trame.
+    :return: Objet décodé.
+    :raise ProtocolError: Encodage inconnu ou non disponible.
+    :raise ValueError: Contenu invalide.
+    """
+    if flags & ~KNOWN_FLAGS:
+        raise ProtocolError(f"encodage de trame inconnu ({flags:#x})")
+    data = decompress(data, flags)
+    if flags & FLAG_MSGPACK:
+        if msgpack is None:
+            raise ProtocolError("trame MessagePack reçue sans le module msgpack")
+        try:
+            obj = msgpack.unpackb(data, raw=False, strict_map_key=False)
+        except Exception as e:
+            raise ValueError(f"MessagePack invalide : {e}")
+    else:
+        obj = json.loads(data)
+    return from_columns(obj) if flags & FLAG_COLUMNAR else obj
+
+def encoding_offer():
+    """
+    :return: Champs d'une requête "negotiate" : encodages lisibles par ce processus,
+             du préféré au moins bon.
+    """
+    return {"formats": (["msgpack"] if msgpack is not None else []) + ["json"],
+            "columnar": True,
+            "compression": (["zstd"] if zstandard is not None else []) + ["zlib"]}
+
+def choose_encoding(offer, threshold=COMPRESSION_THRESHOLD):
+    """
+    Retient, dans l'offre d'un client, l'encodage préféré que ce processus sait produire.
+    :param offer: Requête "negotiate".
+    :param threshold: Taille à partir de laquelle les trames sont compressées.
+    :return: Encodage retenu, transmis au client dans le champ "encoding" de la réponse.
+    """
+    formats = offer.get("formats")
+    compression = offer.get("compression")
+    local = encoding_offer()
+    return {
+        "format": next((f for f in formats if f in local["formats"]), "json")
+                  if isinstance(formats, list) else "json",
+        "columnar": offer.get("columnar") is True,
+        "compression": next((c for c in compression if c in local["compression"]), None)
+                       if isinstance(compression, list) else None,
+        "threshold": threshold,
+    }
+
+
+class Codec:
+    """
+    Encodage des trames envoyées sur une connexion.
+    """
+
+    def __init__(self, flags=0, threshold=COMPRESSION_THRESHOLD):
+        self.flags = flags
+        self.threshold = threshold
+
+    @classmethod
+    def from_encoding(cls, encoding):
+        """
+        :param encoding: Encodage retenu par "negotiate" (voir choose_encoding).
+        :return: Codec correspondant (JSON simple si l'encodage est illisible).
+        """
+        if not isinstance(encoding, dict):
+            return cls()
+        flags = FLAG_COLUMNAR if encoding.get("columnar") is True else 0
+        if encoding.get("format") == "msgpack" and msgpack is not None:
+            flags |= FLAG_MSGPACK
+        if encoding.get("compression") == "zstd" and zstandard is not None:
+            flags |= FLAG_ZSTD
+        elif encoding.get("compression") == "zlib":
+            flags |= FLAG_ZLIB
+        threshold = encoding.get("threshold")
+        return cls(flags, threshold if isinstance(threshold, int) else COMPRESSION_THRESHOLD)
+
+    def encode(self, obj):
+        """
+        Encode un objet ; il n'est compressé qu'au-delà du seuil, et si cela réduit sa taille.
+        :param obj: Objet à envoyer.
+        :return: (contenu, indicateurs).
+        """
+        flags = self.flags & ~COMPRESSION_FLAGS
+        if flags & FLAG_COLUMNAR:
+            obj = to_columns(obj)
+        data = msgpack.packb(obj, use_bin_type=True) if flags & FLAG_MSGPACK else json.dumps(obj).encode()
+        compression = self.flags & COMPRESSION_FLAGS
+        if compression and len(data) >= self.threshold:
+            compressed = compress(data, compression)
+            if len(compressed) < len(data):
+                return compressed, flags | compression
+        return data, flags
+
+    def encode_frame(self, obj):
+        """
+        :param obj: Objet à envoyer.
+        :return: Trame prête à être envoyée.
+        """
+        return encode_frame(*self.encode(obj))
+
+
+PLAIN = Codec()
+
+def recv_exact(sock, size):
+    """
+    Lit exactement size octets sur une socket.
+    :param sock: Socket connectée.
+    :param size: Nombre d'octets attendus.
+    :return: Données lues, ou b"" si la connexion est fermée avant le premier octet.
+    """
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = sock.recv(min(remaining, 65536))
+        if not chunk:
+            if remaining == size:
+                return b""
+            raise ProtocolError("connexion fermée au milieu d'une trame")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+def read_frame(sock):
+    """
+    Lit une trame complète.
+    :param sock: Socket connectée.
+    :return: (contenu de la trame, indicateurs d'encodage), ou None si la connexion est fermée.
+    """
+    header = recv_exact(sock, HEADER.size)
+    if not header:
+        return None
+    flags, size = split_header(HEADER.unpack(header)[0])
+    payload = recv_exact(sock, size)
+    if size and not payload:
+        raise ProtocolError("connexion fermée au milieu d'une trame")
+    return payload, flags
+
+def read_legacy_request(sock, max_size=MAX_FRAME_SIZE):
+    """
+    Lit une requête historique : un objet JSON brut, éventuellement reçu en plusieurs segments.
+    :param sock: Socket connectée.
+    :param max_size: Taille maximale acceptée.
+    :return: Contenu brut de la requête (bytes).
+    """
+    data = b""
+    while len(data) <= max_size:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return data
+        data += chunk
+        try:
+            json.loads(data)
+            return data
+        except ValueError:
+            continue  # objet incomplet : on attend la suite
+    raise ProtocolError("requête trop grande")
+
+
+class FrameDecoder:
+    """
+    Découpe un flux d'octets reçu par morceaux en trames complètes.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Ajoute des octets reçus et retourne les trames désormais complètes.
+        :param data: Octets reçus.
+        :return: Liste des trames : (contenu, indicateurs d'encodage).
+        """
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= HEADER.size:
+            flags, size = split_header(HEADER.unpack_from(self.buffer)[0])
+            end = HEADER.size + size
+            if len(self.buffer) < end:
+                break
+            frames.append((bytes(self.buffer[HEADER.size:end]), flags))
+            del self.buffer[:end]
+        return frames
@@ -0,0 +1,75 @@
+"""
+Mesure le coût du filtrage d'un message selon le nombre de règles.
+
+Usage : python bench_rules.py [--counts 10,100,1000,10000] [--length 200] [--messages 2000] [--seed 42]
+
+Compare le filtrage historique (une recherche par mot bloqué, un str.replace par
+remplacement) aux règles compilées de rules.py, sur des messages aléatoires
+(graine fixe) qui ne contiennent aucun mot des règles : c'est le cas le plus
+fréquent, et le plus coûteux puisque toutes les règles doivent être écartées.
+"""
+import argparse
+import random
+import string
+import time
+from rules import RuleSet
+
+def random_word(rng, length):
+    """
+    Génère un mot aléatoire en minuscules.
+    """
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+def naive_filter(blocked, modifications, msg):
+    """
+    Filtrage historique de modify_payload.
+    """
+    for keyword in blocked:
+        if keyword in msg.lower():
+            return None
+    for k, v in modifications.items():
+        msg = msg.replace(k, v)
+    return msg
+
+def compiled_filter(rules, msg):
+    """
+    Filtrage par règles compilées.
+    """
+    if rules.blocked_keyword(msg) is not None:
+        return None
+    return rules.rewrite(msg)
+
+def measure(func, messages):
+    """
+    Chronomètre le filtrage d'une série de messages.
+    :return: Coût moyen par message en microsecondes.
+    """
+    start = time.perf_counter()
+    for msg in messages:
+        func(msg)
+    return (time.perf_counter() - start) * 1e6 / len(messages)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Banc d'essai du moteur de règles du proxy")
+    parser.add_argument('--counts', default='10,100,1000,10000', help="nombres de règles (bloquées + remplacements)")
+    parser.add_argument('--length', type=int, default=200, help="longueur des messages")
+    parser.add_argument('--messages', type=int, default=2000, help="messages par mesure")
+    parser.add_argument('--seed', type=int, default=42, help="graine aléatoire")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    # les règles se terminent par un chiffre, absent des messages : aucune ne se déclenche
+    messages = [' '.join(random_word(rng, rng.randint(2, 9)) for _ in range(args.length // 5))[:args.length]
+                for _ in range(args.messages)]
+
+    print(f"{'règles':>7} {'compilation ms':>15} {'historique µs':>14} {'compilé µs':>11}")
+    for count in [int(x) for x in args.counts.split(',')]:
+        words = [random_word(rng, rng.randint(4, 12)) + '0' for _ in range(count)]
+        blocked = words[:count // 2]
+        modifications = {word: '***' for word in words[count // 2:]}
+        start = time.perf_counter()
+        rules = RuleSet(blocked, modifications)
+        build = (time.perf_counter() - start) * 1000
+        naive = measure(lambda msg: naive_filter(blocked, modifications, msg), messages)
+        compiled = measure(lambda msg: compiled_filter(rules, msg), messages)
+        print(f"{count:>7} {build:15.1f} {naive:14.1f} {compiled:11.1f}", flush=True)
@@ -1,13 +1,53 @@
-import socket
 import threading
+import time
 import json
 import os
+import sys
+import asyncio
+import atexit
 import logging
+import itertools
+import signal
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
-REAL_SERVER = 'poc-server'
-REAL_PORT = 5000
-PROXY_PORT = 5000
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+from protocol import (COMPRESSION_FLAGS, HEADER, MAX_FRAME_SIZE, Codec, ProtocolError, decode_payload, encoding_offer,
+                      is_legacy, split_header)
+from rules import RuleFile
+from upstream import Resolver, UpstreamPool
+from capture import CLIENT_TO_SERVER, CLOSE, OPEN, SERVER_TO_CLIENT, CaptureWriter
+from metrics import REGISTRY, start_metrics_server, start_stats_dump
+from journal import log_event, setup_logging
+
+REAL_SERVER = os.environ.get("REAL_SERVER", "poc-server")
+REAL_PORT = int(os.environ.get("REAL_PORT", "5000"))
+PROXY_PORT = int(os.environ.get("PROXY_PORT", "5000"))
 LOG_FILE = "logs/mitm.log"
+RELAY_BUFFER_SIZE = 65536
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", "10000"))
+IDLE_TIMEOUT = float(os.environ.get("IDLE_TIMEOUT", "300"))
+CONNECT_TIMEOUT = float(os.environ.get("CONNECT_TIMEOUT", "5"))
+REWRITE_WORKERS = int(os.environ.get("REWRITE_WORKERS", "0"))
+UPSTREAM_SPARES = int(os.environ.get("UPSTREAM_SPARES", "8"))
+UPSTREAM_SHARED = int(os.environ.get("UPSTREAM_SHARED", "4"))
+UPSTREAM_MAX_PENDING = int(os.environ.get("UPSTREAM_MAX_PENDING", "8"))
+POOL_CHECK_INTERVAL = float(os.environ.get("POOL_CHECK_INTERVAL", "30"))
+DNS_REFRESH = float(os.environ.get("DNS_REFRESH", "30"))
+LEGACY_READ_TIMEOUT = 5
+CAPTURE_FILE = os.environ.get("CAPTURE_FILE", "")
+RULES_FILE = os.environ.get("RULES_FILE", "rules/rules.json")
+RULES_RELOAD_INTERVAL = float(os.environ.get("RULES_RELOAD_INTERVAL", "2"))
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9101"))
+STATS_INTERVAL = float(os.environ.get("STATS_INTERVAL", "0"))
+LOG_ASYNC = os.environ.get("LOG_ASYNC", "1") != "0"
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+LOG_SAMPLING = os.environ.get("LOG_SAMPLING", "")
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH = int(os.environ.get("LOG_BATCH", "256"))
+# règles par défaut, utilisées tant que RULES_FILE n'existe pas
 BLOCKED_KEYWORDS = ["secret", "motdepasse"]
 MODIFICATIONS = {
     "remplace": "***",
@@ -15,123 +55,531 @@ MODIFICATIONS = {
 }
 
 os.makedirs("logs", exist_ok=True)
-logging.basicConfig(
-    filename=LOG_FILE,
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s"
-)
+# les requêtes interceptées (logger "mitm.packets") sont aussi affichées sur la console
+setup_logging(LOG_FILE, structured=LOG_FORMAT == "json", use_queue=LOG_ASYNC, queue_size=LOG_QUEUE_SIZE,
+              batch=LOG_BATCH, sampling=LOG_SAMPLING, console="mitm.packets")
+packets = logging.getLogger("mitm.packets")
+
+rule_file = RuleFile(RULES_FILE, BLOCKED_KEYWORDS, MODIFICATIONS, RULES_RELOAD_INTERVAL)
+
+connections = REGISTRY.gauge("proxy_connections", "Connexions relayées ouvertes")
+upstream_errors = REGISTRY.counter("proxy_upstream_errors_total", "Connexions au serveur échouées")
+relayed_bytes = REGISTRY.counter("proxy_bytes_total", "Octets relayés", ["direction"])
+relay_seconds = REGISTRY.histogram("proxy_relay_seconds", "Temps passé dans le proxy par segment relayé", ["direction"])
+filtered_requests = REGISTRY.counter("proxy_requests_total", "Requêtes client par traitement", ["result"])
+rejected_connections = REGISTRY.counter("proxy_rejected_connections_total", "Connexions refusées (MAX_CONNECTIONS)")
+idle_timeouts = REGISTRY.counter("proxy_idle_timeouts_total", "Connexions coupées après IDLE_TIMEOUT sans activité")
+
+rewrite_pool = None  # processus de réécriture (REWRITE_WORKERS), voir start_rewrite_pool
+upstream_pool = None  # connexions au serveur, créées au démarrage de la boucle (voir serve_proxy)
+capture = None  # capture du trafic relayé (CAPTURE_FILE), voir capture.py
+
+SEND_ACTIONS = {"send_message", "send_messages"}
+# requêtes historiques multiplexées sur les connexions partagées : le serveur traite
+# les trames d'une connexion l'une après l'autre, seules les requêtes brèves y passent
+# pour qu'une requête lente (recherche, longue lecture de boîte, attente longue) ne
+# retarde pas les clients qui partagent sa connexion. Les autres gardent la leur, comme
+# negotiate, dont l'encodage s'appliquerait à toute une connexion partagée.
+MULTIPLEXED_ACTIONS = {"ping", "register", "login", "logout", "send_message", "ack_messages", "mark_read",
+                       "list_partners"}
 
-def log_packet(prefix, original, modified=None, blocked_reason=None):
+def log_packet(prefix, request, modified=None, blocked_reason=None):
     """
-    Enregistre les paquets dans le fichier de log,
-    sauf s'il s'agit d'une requête 'get_messages'.
+    Enregistre les requêtes d'envoi de messages dans le fichier de log et sur la console.
+    La mise en forme a lieu dans le thread d'écriture des logs (voir journal.py).
+    :param prefix: Origine de la requête.
+    :param request: Requête décodée (dict).
+    :param modified: Requête transmise à sa place, si elle a été modifiée.
+    :param blocked_reason: Mot interdit, si la requête a été bloquée.
     """
-    try:
-        parsed = json.loads(original)
-        if parsed.get("action") != "send_message":
-            return  # Ne loggue rien sauf les 'send_message'
+    if not isinstance(request, dict) or request.get("action") not in SEND_ACTIONS:
+        return  # Ne loggue rien sauf les envois de messages
+    action = request["action"]
 
-        logging.info(f"{prefix} (ORIGINAL):\n{json.dumps(parsed, indent=2)}")
-        print(f"{prefix} (ORIGINAL):\n{json.dumps(parsed, indent=2)}\n")
+    if blocked_reason:
+        log_event(logging.WARNING, f"{prefix} : message bloqué", packets, action=action,
+                  keyword=blocked_reason, original=request)
+    elif modified is not None and modified is not request:
+        log_event(logging.INFO, f"{prefix} : message modifié", packets, action=action,
+                  original=request, modified=modified)
+    else:
+        log_event(logging.INFO, prefix, packets, action=action, original=request)
 
-        if blocked_reason:
-            logging.warning(f"{prefix} Message bloqué (mot interdit : '{blocked_reason}')")
-            print(f"{prefix} Message bloqué (mot interdit : '{blocked_reason}')\n")
+def filter_text(rules, item):
+    """
+    Applique les règles au texte d'un message.
+    :param rules: Règles actives.
+    :param item: Objet portant le texte dans son champ "message".
+    :return: (objet à transmettre, mot interdit ou None). L'objet d'origine est
+             retourné tel quel si rien n'a changé.
+    """
+    msg = item.get("message", "") if isinstance(item, dict) else None
+    if not isinstance(msg, str):
+        return item, None
+    keyword = rules.blocked_keyword(msg)
+    if keyword is not None:
+        return item, keyword
+    modified = rules.rewrite(msg)
+    return (item if modified == msg else dict(item, message=modified)), None
 
-        elif modified and modified != original:
-            parsed_mod = json.loads(modified)
-            logging.info(f"{prefix} (MODIFIÉ):\n{json.dumps(parsed_mod, indent=2)}")
-            print(f"{prefix} (MODIFIÉ):\n{json.dumps(parsed_mod, indent=2)}\n")
+def restrict_offer(req):
+    """
+    Retire d'une requête "negotiate" les encodages que le proxy ne sait pas lire :
+    les requêtes suivantes de la connexion restent ainsi filtrables.
+    :param req: Requête "negotiate".
+    :return: Requête à transmettre (l'originale si rien n'a changé).
+    """
+    local = encoding_offer()
+    restricted = dict(req)
+    for field in ("formats", "compression"):
+        if isinstance(req.get(field), list):
+            restricted[field] = [option for option in req[field] if option in local[field]]
+    return req if restricted == req else restricted
 
-    except Exception as e:
-        logging.error(f"Erreur log_packet : {e}")
+def modify_payload(req):
+    """
+    Modifie une requête décodée selon les règles actives (voir rules.py).
+    :param req: Requête (dict).
+    :return: (requête à transmettre, None si bloquée ; mot interdit). La requête
+             d'origine est retournée telle quelle si rien n'a changé.
+    """
+    if isinstance(req, dict) and req.get("action") == "negotiate":
+        return restrict_offer(req), None
+    if not isinstance(req, dict) or req.get("action") not in SEND_ACTIONS:
+        return req, None
+
+    rules = rule_file.rules  # une seule lecture : un rechargement en cours n'a pas d'effet ici
+    if req["action"] == "send_message":
+        modified, keyword = filter_text(rules, req)
+        return (None, keyword) if keyword is not None else (modified, None)
 
-def modify_payload(data):
+    # envoi groupé : un seul mot interdit bloque tout le lot
+    items = req.get("messages")
+    if not isinstance(items, list):
+        return req, None
+    filtered = []
+    for item in items:
+        modified, keyword = filter_text(rules, item)
+        if keyword is not None:
+            return None, keyword
+        filtered.append(modified)
+    if all(new is old for new, old in zip(filtered, items)):
+        return req, None
+    return dict(req, messages=filtered), None
+
+def may_need_filtering(buffer, start, end, flags=0):
+    """
+    Indique, sans décoder le JSON, si une requête peut être un envoi de messages
+    ('send_message' est aussi le début de 'send_messages') ou une négociation d'encodage.
+    Une séquence d'échappement \\u pourrait masquer le nom de l'action : la requête
+    est alors décodée par précaution. Une trame compressée est toujours décodée.
+    :param buffer: Tampon contenant la requête.
+    :param start: Début de la requête dans le tampon.
+    :param end: Fin de la requête dans le tampon.
+    :param flags: Indicateurs d'encodage de la trame.
+    :return: True si la requête doit être décodée et filtrée.
     """
-    Modifie le payload JSON selon les règles définies.
-    :param data: Données à modifier.
-    :return: Données modifiées ou None si bloquées.
+    if flags & COMPRESSION_FLAGS:
+        return True
+    return (buffer.find(b"send_message", start, end) != -1 or buffer.find(b"negotiate", start, end) != -1
+            or buffer.find(b"\\u", start, end) != -1)
+
+def rewrite_request(payload, flags=None):
+    """
+    Décode une requête et lui applique les règles : partie coûteuse du filtrage,
+    exécutée dans un processus de réécriture si REWRITE_WORKERS > 0.
+    :param payload: Contenu brut de la requête.
+    :param flags: Indicateurs d'encodage de la trame (None : requête historique en JSON).
+    :return: (requête décodée, requête à transmettre ou None si bloquée, mot interdit),
+             ou None si la requête est illisible.
     """
     try:
-        req = json.loads(data)
-    except:
-        return data, None  # non JSON
-
-    if req.get("action") == "send_message":
-        msg = req.get("message", "")
-        for keyword in BLOCKED_KEYWORDS:
-            if keyword in msg.lower():
-                return None, keyword  # bloqué
-        for k, v in MODIFICATIONS.items():
-            msg = msg.replace(k, v)
-        req["message"] = msg
-        return json.dumps(req), None
+        req = decode_payload(payload, flags or 0)
+    except ProtocolError as e:
+        logging.warning(f"Requête non filtrée : {e}")
+        return None  # encodage illisible par le proxy
+    except ValueError:
+        return None  # contenu invalide
+    modified, blocked_reason = modify_payload(req)
+    return req, modified, blocked_reason
 
-    return data, None
+def filter_request(rewritten):
+    """
+    Journalise et compte une requête passée par rewrite_request.
+    :param rewritten: Résultat de rewrite_request.
+    :return: Requête à transmettre à sa place (dict), ou None pour la transmettre telle quelle.
+    """
+    if rewritten is None:
+        filtered_requests.inc(result="unchanged")
+        return None
+    req, modified, blocked_reason = rewritten
+    log_packet("Requête client", req, modified, blocked_reason)
+    filtered_requests.inc(result="blocked" if modified is None else "unchanged" if modified is req else "modified")
+    if modified is None:
+        # le client attend une réponse par requête : la requête bloquée
+        # est remplacée par un ping pour qu'il reçoive un "ok" à sa place
+        modified = {"action": "ping"}
+        if isinstance(req, dict) and "id" in req:
+            modified["id"] = req["id"]
+    elif modified is req:
+        return None
+    return modified
 
+def start_rewrite_worker():
+    """
+    Initialise un processus de réécriture : il surveille lui-même le fichier de règles.
+    """
+    rule_file.start()
 
-def handle_connection(client_conn, addr):
+def start_rewrite_pool(count):
     """
-    Gère la connexion entre le client et le serveur.
-    :param client_conn: Connexion du client.
-    :param addr: Adresse du client.
+    Démarre les processus de réécriture (REWRITE_WORKERS).
+    :param count: Nombre de processus (0 : filtrage dans la boucle du proxy).
+    :return: Pool de processus, ou None.
     """
-    try:
-        server_conn = socket.create_connection((REAL_SERVER, REAL_PORT))
-    except Exception as e:
-        logging.error(f"Connexion au serveur échouée : {e}")
-        client_conn.close()
-        return
+    if not count:
+        return None
+    pool = ProcessPoolExecutor(count, mp_context=multiprocessing.get_context("fork"),
+                               initializer=start_rewrite_worker)
+    pool.submit(int).result()  # les processus sont créés maintenant, avant la boucle d'événements
+    logging.info(f"{count} processus de réécriture démarrés")
+    return pool
+
+async def rewrite_part(part):
+    """
+    Filtre une requête découpée par RequestRelay.
+    :param part: (requête d'origine, contenu, indicateurs d'encodage).
+    :return: Octets à transmettre au serveur.
+    """
+    original, payload, flags = part
+    if rewrite_pool is None:
+        rewritten = rewrite_request(payload, flags)
+    else:
+        loop = asyncio.get_running_loop()
+        rewritten = await loop.run_in_executor(rewrite_pool, rewrite_request, payload, flags)
+    replacement = filter_request(rewritten)
+    if replacement is None:
+        return original
+    if flags is None:
+        return json.dumps(replacement).encode()
+    # même encodage que la trame d'origine (compressée quelle que soit sa taille)
+    return Codec(flags, threshold=0).encode_frame(replacement)
+
+
+class RequestRelay:
+    """
+    Découpe le flux client → serveur en requêtes complètes, quel que soit le
+    découpage en segments TCP. Seules les requêtes susceptibles d'être des
+    envois de messages sont à filtrer ; les autres sont transmises d'un bloc
+    avec leurs voisines.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.framed = None
+        self.legacy_done = False
 
-    def from_client():
+    def feed(self, data):
         """
-        Gère le transfert de données du client vers le serveur.
+        Découpe les requêtes complètes reçues jusqu'ici.
+        :param data: Octets reçus du client.
+        :return: Morceaux à transmettre dans l'ordre : bytes à recopier tels quels, ou
+                 (requête d'origine, contenu, indicateurs d'encodage) pour une requête à
+                 filtrer (indicateurs None en mode historique).
         """
-        while True:
-            try:
-                data = client_conn.recv(8192)
-                if not data:
+        if self.framed is None:
+            self.framed = not is_legacy(data[:1])
+        if self.legacy_done:
+            return [data]
+        self.buffer += data
+        if self.framed:
+            parts, consumed = self._split_frames()
+        else:
+            parts, consumed = self._split_legacy(data)
+        del self.buffer[:consumed]
+        return parts
+
+    def _split_frames(self):
+        """
+        Découpe les trames complètes du tampon. Les trames consécutives qui
+        n'ont pas besoin d'être filtrées forment un seul morceau.
+        :return: (morceaux, nombre d'octets consommés).
+        """
+        buffer = self.buffer
+        parts = []
+        position = passthrough = 0
+        with memoryview(buffer) as view:
+            while len(buffer) - position >= HEADER.size:
+                flags, size = split_header(HEADER.unpack_from(buffer, position)[0])
+                start = position + HEADER.size
+                end = start + size
+                if end > len(buffer):
                     break
-                data_str = data.decode()
-                modified, blocked_reason = modify_payload(data_str)
-                log_packet("Requête client", data_str, modified, blocked_reason)
-                if modified is not None:
-                    server_conn.sendall(modified.encode())
-            except Exception as e:
-                logging.error(f"Erreur client → serveur : {e}")
-                break
+                if may_need_filtering(buffer, start, end, flags):
+                    if passthrough < position:
+                        parts.append(bytes(view[passthrough:position]))
+                    parts.append((bytes(view[position:end]), bytes(view[start:end]), flags))
+                    passthrough = end
+                else:
+                    filtered_requests.inc(result="passthrough")
+                position = end
+            if passthrough < position:
+                parts.append(bytes(view[passthrough:position]))
+        return parts, position
+
+    def _split_legacy(self, data):
+        """
+        Mode historique : attend que l'objet JSON soit complet avant de le filtrer,
+        puis recopie tel quel ce qui suit.
+        :param data: Derniers octets reçus.
+        :return: (morceaux, nombre d'octets consommés).
+        """
+        if b"}" not in data and len(self.buffer) <= MAX_FRAME_SIZE:
+            return [], 0  # l'objet ne peut pas être complet
+        try:
+            json.loads(self.buffer)
+        except ValueError:
+            if len(self.buffer) <= MAX_FRAME_SIZE:
+                return [], 0  # objet incomplet : on attend la suite
+        self.legacy_done = True
+        request = bytes(self.buffer)
+        return [(request, request, None)], len(request)
+
+    def close(self):
+        """
+        Fin du flux client : une requête historique incomplète est transmise telle quelle.
+        :return: Morceaux restant à transmettre.
+        """
+        parts = [bytes(self.buffer)] if self.buffer and not self.framed else []
+        self.buffer.clear()
+        return parts
+
+
+class Link:
+    """
+    Connexion relayée : identifiant, flux vers le client et vers le serveur, dernière activité.
+    """
+
+    def __init__(self, connection, client_writer, server_writer):
+        self.connection = connection
+        self.client_writer = client_writer
+        self.server_writer = server_writer
+        self.last_activity = time.monotonic()
 
-    def from_server():
+    def touch(self):
         """
-        Gère le transfert de données du serveur vers le client.
+        Note une activité dans un sens ou dans l'autre.
         """
+        self.last_activity = time.monotonic()
+
+    def abort(self):
+        """
+        Coupe les deux connexions sans attendre l'envoi des données en attente.
+        """
+        self.client_writer.transport.abort()
+        self.server_writer.transport.abort()
+
+
+async def relay_requests(reader, writer, link, first=b""):
+    """
+    Relaie le flux client → serveur, requête par requête, jusqu'à sa fin ;
+    le serveur voit ensuite la fin de flux du client (demi-fermeture).
+    :param reader: Flux du client.
+    :param writer: Flux vers le serveur.
+    :param link: Connexion relayée.
+    :param first: Octets déjà lus sur le flux du client.
+    """
+    relay = RequestRelay()
+    try:
+        data = first or await reader.read(RELAY_BUFFER_SIZE)
+        while data:
+            link.touch()
+            start = time.perf_counter()
+            relayed_bytes.inc(len(data), direction="client_to_server")
+            for part in relay.feed(data):
+                if not isinstance(part, bytes):
+                    part = await rewrite_part(part)
+                writer.write(part)
+                if capture is not None:
+                    capture.record(link.connection, CLIENT_TO_SERVER, part)
+            relay_seconds.observe(time.perf_counter() - start, direction="client_to_server")
+            await writer.drain()
+            data = await reader.read(RELAY_BUFFER_SIZE)
+        for part in relay.close():
+            writer.write(part)
+            if capture is not None:
+                capture.record(link.connection, CLIENT_TO_SERVER, part)
+        writer.write_eof()
+        await writer.drain()
+    except Exception as e:
+        logging.error(f"Erreur client → serveur : {e}")
+        link.abort()
+
+async def relay_responses(reader, writer, link):
+    """
+    Relaie le flux serveur → client jusqu'à sa fin, puis le ferme côté client.
+    Les réponses ne sont ni filtrées ni journalisées : elles sont recopiées telles quelles.
+    :param reader: Flux du serveur.
+    :param writer: Flux vers le client.
+    :param link: Connexion relayée.
+    """
+    try:
         while True:
-            try:
-                data = server_conn.recv(8192)
-                if not data:
-                    break
-                data_str = data.decode()
-                log_packet("Réponse serveur", data_str)
-                client_conn.sendall(data)
-            except Exception as e:
-                logging.error(f"Erreur serveur → client : {e}")
+            data = await reader.read(RELAY_BUFFER_SIZE)
+            if not data:
                 break
+            link.touch()
+            start = time.perf_counter()
+            relayed_bytes.inc(len(data), direction="server_to_client")
+            writer.write(data)
+            if capture is not None:
+                capture.record(link.connection, SERVER_TO_CLIENT, data)
+            relay_seconds.observe(time.perf_counter() - start, direction="server_to_client")
+            await writer.drain()
+        writer.write_eof()
+        await writer.drain()
+    except Exception as e:
+        logging.error(f"Erreur serveur → client : {e}")
+        link.abort()
 
-    threading.Thread(target=from_client, daemon=True).start()
-    threading.Thread(target=from_server, daemon=True).start()
+async def read_legacy(reader, data):
+    """
+    Lit la suite d'une requête historique, jusqu'à ce que l'objet JSON soit complet.
+    :param reader: Flux du client.
+    :param data: Début de la requête, déjà lu.
+    :return: (contenu brut, requête décodée ou None si elle est incomplète ou invalide).
+    """
+    while len(data) <= MAX_FRAME_SIZE:
+        try:
+            return data, json.loads(data)
+        except ValueError:
+            pass  # objet incomplet : on attend la suite
+        chunk = await reader.read(RELAY_BUFFER_SIZE)
+        if not chunk:
+            return data, None
+        data += chunk
+    return data, None
+
+async def forward_legacy(connection, data, req, writer):
+    """
+    Transmet une requête historique sur une connexion partagée au serveur et
+    renvoie la réponse au client, qui ferme ensuite sa connexion.
+    :param connection: Identifiant de la connexion cliente.
+    :param data: Contenu brut de la requête.
+    :param req: Requête décodée.
+    :param writer: Flux vers le client.
+    """
+    start = time.perf_counter()
+    relayed_bytes.inc(len(data), direction="client_to_server")
+    sent = await rewrite_part((data, data, None))
+    relay_seconds.observe(time.perf_counter() - start, direction="client_to_server")
+    if capture is not None:
+        capture.record(connection, CLIENT_TO_SERVER, sent)
+    try:
+        response = await upstream_pool.request(req if sent is data else json.loads(sent))
+    except OSError as e:
+        logging.error(f"Requête historique non transmise : {e}")
+        upstream_errors.inc()
+        response = {"status": "error", "message": "server unavailable"}
+    body = json.dumps(response).encode()
+    relayed_bytes.inc(len(body), direction="server_to_client")
+    writer.write(body)
+    if capture is not None:
+        capture.record(connection, SERVER_TO_CLIENT, body)
+    await writer.drain()
+
+async def close_idle_links(links):
+    """
+    Coupe les connexions sans activité depuis IDLE_TIMEOUT secondes.
+    :param links: Connexions relayées ouvertes.
+    """
+    interval = min(max(IDLE_TIMEOUT / 10, 1), 30)
+    while True:
+        await asyncio.sleep(interval)
+        deadline = time.monotonic() - IDLE_TIMEOUT
+        for link in [link for link in links if link.last_activity < deadline]:
+            idle_timeouts.inc()
+            link.abort()
+
+async def serve_proxy():
+    """
+    Boucle principale du proxy : toutes les connexions, côté client comme côté
+    serveur, sont relayées par une seule boucle asyncio. Au-delà de MAX_CONNECTIONS
+    connexions, les nouvelles sont refusées.
+    Un client tramé reçoit une connexion de la réserve (voir upstream.py) ; une requête
+    historique brève (MULTIPLEXED_ACTIONS) est multiplexée sur une connexion partagée.
+    """
+    global upstream_pool
+    upstream_pool = UpstreamPool(Resolver(REAL_SERVER, REAL_PORT, DNS_REFRESH), UPSTREAM_SPARES, UPSTREAM_SHARED,
+                                 POOL_CHECK_INTERVAL, CONNECT_TIMEOUT, UPSTREAM_MAX_PENDING)
+    upstream_pool.start()
+    links = set()
+    active = 0
+    connection_ids = itertools.count(1)
+
+    async def relay(connection, client_reader, client_writer, first):
+        if is_legacy(first[:1]):
+            server_reader, server_writer = await upstream_pool.connect("direct")
+        else:
+            server_reader, server_writer = await upstream_pool.take()
+        link = Link(connection, client_writer, server_writer)
+        links.add(link)
+        try:
+            await asyncio.gather(relay_requests(client_reader, server_writer, link, first),
+                                 relay_responses(server_reader, client_writer, link))
+        finally:
+            links.discard(link)
+            server_writer.close()
+
+    async def handle(client_reader, client_writer):
+        nonlocal active
+        if active >= MAX_CONNECTIONS:
+            rejected_connections.inc()
+            client_writer.transport.abort()
+            return
+        active += 1
+        connections.inc()
+        connection = next(connection_ids)
+        if capture is not None:
+            capture.record(connection, OPEN, str(client_writer.get_extra_info("peername")).encode())
+        try:
+            first = await asyncio.wait_for(client_reader.read(RELAY_BUFFER_SIZE), IDLE_TIMEOUT)
+            if not first:
+                return
+            if is_legacy(first[:1]) and UPSTREAM_SHARED:
+                first, req = await asyncio.wait_for(read_legacy(client_reader, first), LEGACY_READ_TIMEOUT)
+                if isinstance(req, dict) and req.get("action") in MULTIPLEXED_ACTIONS:
+                    await forward_legacy(connection, first, req, client_writer)
+                    return
+            await relay(connection, client_reader, client_writer, first)
+        except asyncio.TimeoutError:
+            logging.debug("Connexion cliente fermée : requête incomplète")
+        except OSError as e:
+            logging.error(f"Connexion au serveur échouée : {e}")
+            upstream_errors.inc()
+        finally:
+            active -= 1
+            connections.dec()
+            client_writer.close()
+            if capture is not None:
+                capture.record(connection, CLOSE)
+
+    server = await asyncio.start_server(handle, '0.0.0.0', PROXY_PORT, backlog=min(MAX_CONNECTIONS, 4096))
+    print(f"MITM proxy en écoute sur le port {PROXY_PORT}...", flush=True)
+    logging.info(f"MITM proxy démarré sur {PROXY_PORT} ({MAX_CONNECTIONS} connexions max, "
+                 f"{REWRITE_WORKERS} processus de réécriture)")
+    sweeper = asyncio.create_task(close_idle_links(links))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        sweeper.cancel()
 
 def start_proxy():
     """
     Démarre le proxy MITM.
     """
-    print(f"MITM proxy en écoute sur le port {PROXY_PORT}...", flush=True)
-    logging.info(f"MITM proxy démarré sur {PROXY_PORT}")
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind(('0.0.0.0', PROXY_PORT))
-        s.listen()
-        while True:
-            client_conn, addr = s.accept()
-            threading.Thread(target=handle_connection, args=(client_conn, addr), daemon=True).start()
+    asyncio.run(serve_proxy())
 
 def interactive_attacker():
     """
@@ -160,17 +608,25 @@ def interactive_attacker():
         }
 
         try:
-            with socket.create_connection((REAL_SERVER, REAL_PORT)) as s:
-                s.sendall(json.dumps(fake_data).encode())
-                response = s.recv(8192).decode()
-                log_packet("Message injecté par MITM", json.dumps(fake_data))
-                logging.info(f"Réponse serveur à injection : {response}")
-                print(f"[MITM] Injecté : {message}")
+            # requête transmise sur une connexion partagée du proxy (voir upstream.py)
+            response = asyncio.run_coroutine_threadsafe(upstream_pool.request(fake_data),
+                                                        upstream_pool.loop).result(CONNECT_TIMEOUT * 2)
+            log_packet("Message injecté par MITM", fake_data)
+            logging.info(f"Réponse serveur à injection : {json.dumps(response)}")
+            print(f"[MITM] Injecté : {message}")
         except Exception as e:
             logging.error(f"[MITM] Erreur injection : {e}")
             print(f"[MITM] Erreur envoi : {e}")
 
 
 if __name__ == "__main__":
+    rewrite_pool = start_rewrite_pool(REWRITE_WORKERS)  # avant les autres threads
+    if CAPTURE_FILE:
+        capture = CaptureWriter(CAPTURE_FILE)
+        atexit.register(capture.close)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # arrêt propre : fin de capture écrite (atexit)
+    rule_file.start()
+    start_metrics_server(METRICS_PORT, METRICS_HOST)
+    start_stats_dump(STATS_INTERVAL)
     threading.Thread(target=interactive_attacker, daemon=True).start()
     start_proxy()
@@ -0,0 +1,128 @@
+import os
+import re
+import json
+import threading
+import time
+import logging
+
+def trie_pattern(words):
+    """
+    Construit une expression régulière équivalente à l'alternative des mots,
+    factorisée en arbre de préfixes : à chaque position du texte, le moteur ne
+    suit qu'une branche au lieu d'essayer chaque mot un par un.
+    :param words: Mots à reconnaître.
+    :return: Motif, ou None si la liste est vide.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}  # fin de mot
+
+    def build(node):
+        ends = '' in node
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        if len(branches) == 1 and not ends:
+            return branches[0]
+        group = '(?:' + '|'.join(branches) + ')'
+        # quantificateur gourmand : le mot le plus long l'emporte
+        return group + '?' if ends else group
+
+    return build(trie) if trie else None
+
+
+class RuleSet:
+    """
+    Règles de filtrage compilées une fois : une expression pour les mots bloqués
+    (insensible à la casse), une pour les remplacements (appliqués en une passe,
+    le plus long mot reconnu l'emporte).
+    """
+
+    def __init__(self, blocked, modifications):
+        self.blocked = {word.lower(): word for word in blocked if word}
+        self.modifications = {k: v for k, v in modifications.items() if k}
+        pattern = trie_pattern(self.blocked)
+        # comparaison sur le texte en minuscules : plus rapide que re.IGNORECASE
+        self._blocked_re = re.compile(pattern) if pattern else None
+        pattern = trie_pattern(self.modifications)
+        self._modifications_re = re.compile(pattern) if pattern else None
+
+    def blocked_keyword(self, text):
+        """
+        Cherche un mot interdit dans un texte.
+        :param text: Texte à analyser.
+        :return: Mot interdit trouvé, ou None.
+        """
+        if self._blocked_re is None:
+            return None
+        match = self._blocked_re.search(text.lower())
+        return self.blocked[match.group(0)] if match else None
+
+    def rewrite(self, text):
+        """
+        Applique les remplacements à un texte.
+        :param text: Texte à modifier.
+        :return: Texte modifié.
+        """
+        if self._modifications_re is None:
+            return text
+        return self._modifications_re.sub(lambda m: self.modifications[m.group(0)], text)
+
+
+class RuleFile:
+    """
+    Règles lues dans un fichier JSON ({"blocked": [...], "modifications": {...}})
+    et rechargées à chaud quand le fichier change. Sans fichier, les règles par
+    défaut s'appliquent.
+    """
+
+    def __init__(self, path, default_blocked, default_modifications, interval=2.0):
+        self.path = path
+        self.interval = interval
+        self.default = RuleSet(default_blocked, default_modifications)
+        self.rules = self.default
+        self._mtime = None
+        self.reload()
+
+    def reload(self):
+        """
+        Relit le fichier s'il a changé depuis la dernière lecture.
+        Un fichier invalide est ignoré : les règles précédentes restent actives.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        if mtime is None:
+            self.rules = self.default
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            rules = RuleSet(data.get("blocked", []), data.get("modifications", {}))
+        except (OSError, ValueError, AttributeError) as e:
+            logging.error(f"Règles invalides dans {self.path} : {e}")
+            return
+        self.rules = rules
+        logging.info(f"Règles chargées depuis {self.path} : {len(rules.blocked)} mots bloqués, "
+                     f"{len(rules.modifications)} remplacements")
+
+    def _watch(self):
+        """
+        Surveille le fichier de règles.
+        """
+        while True:
+            time.sleep(self.interval)
+            self.reload()
+
+    def start(self):
+        """
+        Démarre le rechargement à chaud.
+        """
+        threading.Thread(target=self._watch, daemon=True).start()
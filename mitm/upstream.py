@@ -0,0 +1,348 @@
+"""
+Connexions du proxy vers le serveur.
+
+* Resolver : les adresses du serveur sont résolues une fois puis rafraîchies
+  périodiquement, au lieu d'une résolution DNS par connexion ;
+* UpstreamPool :
+  - connexions de réserve, ouvertes à l'avance et passées en mode tramé (un "ping") :
+    chacune est remise à une connexion cliente tramée, qui économise ainsi la poignée
+    de main TCP. Une connexion remise n'est pas réutilisée ensuite : l'encodage
+    négocié par le client lui est propre ;
+  - quelques connexions partagées sur lesquelles les requêtes historiques brèves (une
+    requête par connexion cliente) sont multiplexées : le proxy renumérote les requêtes
+    ("id") et rend chaque réponse à son client. Le serveur traitant les trames d'une
+    connexion l'une après l'autre, une requête y attend celles qui la précèdent : au-delà
+    de `max_pending` requêtes en cours sur chaque connexion partagée, les suivantes
+    passent par une connexion ouverte pour elles seules.
+  Les connexions de réserve sont vérifiées par un "ping" toutes les `check_interval`
+  secondes, ce qui les garde aussi ouvertes côté serveur (IDLE_TIMEOUT).
+"""
+import time
+import socket
+import asyncio
+import logging
+from collections import deque
+
+from protocol import HEADER, PLAIN, ProtocolError, decode_payload, split_header
+from metrics import REGISTRY
+
+PING_ID = "pool"
+
+upstream_connects = REGISTRY.counter("proxy_upstream_connects_total", "Connexions ouvertes vers le serveur", ["use"])
+spare_requests = REGISTRY.counter("proxy_pool_spare_requests_total", "Connexions de réserve demandées", ["result"])
+spare_connections = REGISTRY.gauge("proxy_pool_spare_connections", "Connexions de réserve disponibles")
+dns_resolutions = REGISTRY.counter("proxy_dns_resolutions_total", "Résolutions du nom du serveur", ["result"])
+multiplexed_requests = REGISTRY.counter("proxy_multiplexed_requests_total",
+                                        "Requêtes historiques transmises sur une connexion partagée", ["result"])
+
+
+async def read_frame_async(reader):
+    """
+    Lit une trame sur un flux asyncio.
+    :param reader: Flux de lecture.
+    :return: (contenu de la trame, indicateurs d'encodage), ou None si la connexion est fermée.
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ProtocolError("connexion fermée au milieu d'une trame")
+        return None
+    flags, size = split_header(HEADER.unpack(header)[0])
+    try:
+        return await reader.readexactly(size), flags
+    except asyncio.IncompleteReadError:
+        raise ProtocolError("connexion fermée au milieu d'une trame")
+
+
+class Resolver:
+    """
+    Adresses d'un serveur, gardées en cache entre deux résolutions.
+    """
+
+    def __init__(self, host, port, refresh=30.0):
+        self.host = host
+        self.port = port
+        self.refresh = refresh
+        self.addresses = []
+        self.resolved_at = None
+
+    def expired(self):
+        """
+        :return: True si les adresses doivent être résolues à nouveau.
+        """
+        return self.resolved_at is None or time.monotonic() - self.resolved_at >= self.refresh
+
+    async def resolve(self):
+        """
+        Résout le nom du serveur. En cas d'échec, les adresses connues restent utilisées.
+        :return: Adresses connues.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            infos = await loop.getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)
+        except OSError as e:
+            dns_resolutions.inc(result="error")
+            logging.warning(f"Résolution de {self.host} échouée : {e}")
+            if not self.addresses:
+                raise
+            return self.addresses
+        dns_resolutions.inc(result="ok")
+        addresses = list(dict.fromkeys(sockaddr[0] for _, _, _, _, sockaddr in infos))
+        if addresses != self.addresses:
+            logging.info(f"Adresses de {self.host} : {', '.join(addresses)}")
+        self.addresses = addresses
+        self.resolved_at = time.monotonic()
+        return addresses
+
+    async def connect(self, timeout):
+        """
+        Ouvre une connexion vers la première adresse connue qui répond.
+        Si aucune ne répond, la prochaine connexion résout à nouveau le nom.
+        :param timeout: Délai de connexion par adresse, en secondes.
+        :return: (reader, writer).
+        :raise ConnectionError: Aucune adresse ne répond.
+        """
+        if not self.addresses:
+            await self.resolve()
+        error = None
+        for address in self.addresses:
+            try:
+                return await asyncio.wait_for(asyncio.open_connection(address, self.port), timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                error = e
+        self.addresses = []
+        raise ConnectionError(f"{self.host}:{self.port} injoignable ({error or 'aucune adresse'})")
+
+
+class SharedUpstream:
+    """
+    Connexion tramée sur laquelle plusieurs requêtes sont en cours à la fois :
+    chaque réponse est rendue à la requête de même identifiant.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}  # identifiant → future de la réponse
+        self.next_id = 0
+        self.closed = False
+        self.task = asyncio.create_task(self._read_responses())
+
+    async def _read_responses(self):
+        """
+        Lit les réponses du serveur jusqu'à la fermeture de la connexion.
+        """
+        try:
+            while True:
+                frame = await read_frame_async(self.reader)
+                if frame is None:
+                    break
+                response = decode_payload(*frame)
+                future = self.pending.pop(response.pop("id", None), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (OSError, ProtocolError, ValueError, AttributeError) as e:
+            logging.warning(f"Connexion partagée au serveur interrompue : {e}")
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Ferme la connexion ; les requêtes en cours échouent.
+        """
+        self.closed = True
+        self.writer.close()
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("connexion au serveur perdue"))
+        self.pending.clear()
+
+    async def request(self, req):
+        """
+        Envoie une requête et attend sa réponse.
+        :param req: Requête (dict) ; son champ "id" est remplacé le temps de l'échange.
+        :return: Réponse, sans champ "id".
+        """
+        self.next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.next_id] = future
+        self.writer.write(PLAIN.encode_frame(dict(req, id=self.next_id)))
+        await self.writer.drain()
+        return await future
+
+
+class UpstreamPool:
+    """
+    Connexions vers le serveur : réserve pour les clients tramés, connexions
+    partagées pour les requêtes historiques.
+    """
+
+    def __init__(self, resolver, spares=8, shared=4, check_interval=30.0, connect_timeout=5.0, max_pending=8):
+        self.resolver = resolver
+        self.spares = spares
+        self.shared = shared
+        self.max_pending = max_pending
+        self.check_interval = check_interval
+        self.connect_timeout = connect_timeout
+        self.spare = deque()  # (reader, writer, dernière vérification)
+        self.upstreams = []
+        self.opening = None  # ouverture en cours d'une connexion partagée
+        self.wanted = None
+        self.loop = None
+
+    def start(self):
+        """
+        Démarre l'entretien de la réserve dans la boucle courante.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.wanted = asyncio.Event()
+        self.loop.create_task(self._maintain())
+
+    async def connect(self, use):
+        """
+        Ouvre une nouvelle connexion vers le serveur.
+        :param use: Usage, pour les métriques ("spare", "shared", "direct").
+        :return: (reader, writer).
+        """
+        connection = await self.resolver.connect(self.connect_timeout)
+        upstream_connects.inc(use=use)
+        return connection
+
+    async def _ping(self, reader, writer):
+        """
+        Vérifie une connexion de réserve (et la passe en mode tramé).
+        :return: True si le serveur a répondu.
+        """
+        try:
+            writer.write(PLAIN.encode_frame({"action": "ping", "id": PING_ID}))
+            await writer.drain()
+            frame = await asyncio.wait_for(read_frame_async(reader), self.connect_timeout)
+            return frame is not None and decode_payload(*frame).get("id") == PING_ID
+        except (OSError, ProtocolError, ValueError, AttributeError, asyncio.TimeoutError):
+            return False
+
+    async def take(self):
+        """
+        Fournit une connexion tramée pour un client, de préférence depuis la réserve.
+        :return: (reader, writer).
+        """
+        while self.spare:
+            reader, writer, _ = self.spare.popleft()
+            if reader.at_eof() or writer.is_closing():
+                writer.close()
+                continue
+            spare_requests.inc(result="hit")
+            spare_connections.set(len(self.spare))
+            self.wanted.set()
+            return reader, writer
+        spare_requests.inc(result="miss")
+        self.wanted.set()
+        return await self.connect("direct")
+
+    async def _open_shared(self):
+        """
+        Ouvre une connexion partagée supplémentaire.
+        :return: Connexion ouverte.
+        """
+        try:
+            upstream = SharedUpstream(*await self.connect("shared"))
+            self.upstreams.append(upstream)
+            return upstream
+        finally:
+            self.opening = None
+
+    async def _shared(self):
+        """
+        Choisit la connexion partagée la moins chargée. Une connexion de plus est
+        ouverte (une seule à la fois) si toutes sont occupées et que la limite le permet.
+        :return: Connexion partagée.
+        """
+        self.upstreams = [upstream for upstream in self.upstreams if not upstream.closed]
+        upstream = min(self.upstreams, key=lambda u: len(u.pending), default=None)
+        if self.opening is None and (upstream is None or (upstream.pending and len(self.upstreams) < self.shared)):
+            self.opening = asyncio.ensure_future(self._open_shared())
+            # l'erreur est remontée aux requêtes qui attendent, sinon ignorée
+            self.opening.add_done_callback(lambda task: task.cancelled() or task.exception())
+        if upstream is None:
+            return await asyncio.shield(self.opening)
+        return upstream
+
+    async def _exclusive_request(self, req):
+        """
+        Transmet une requête sur une connexion ouverte pour elle seule.
+        :param req: Requête (dict).
+        :return: Réponse.
+        """
+        reader, writer = await self.connect("direct")
+        try:
+            writer.write(PLAIN.encode_frame(req))
+            await writer.drain()
+            frame = await read_frame_async(reader)
+            if frame is None:
+                raise ConnectionError("connexion fermée par le serveur")
+            return decode_payload(*frame)
+        except (ProtocolError, ValueError) as e:
+            raise ConnectionError(f"réponse invalide du serveur : {e}")
+        finally:
+            writer.close()
+
+    async def request(self, req):
+        """
+        Transmet une requête sur une connexion partagée, ou sur une connexion à part
+        si toutes les connexions partagées ont max_pending requêtes en cours.
+        :param req: Requête (dict).
+        :return: Réponse, avec l'identifiant d'origine de la requête.
+        :raise OSError: Serveur injoignable ou connexion perdue pendant l'échange.
+        """
+        upstream = await self._shared()
+        saturated = self.max_pending and len(upstream.pending) >= self.max_pending
+        try:
+            response = await (self._exclusive_request(req) if saturated else upstream.request(req))
+        except OSError:
+            multiplexed_requests.inc(result="error")
+            raise
+        multiplexed_requests.inc(result="exclusive" if saturated else "ok")
+        if "id" in req:
+            response["id"] = req["id"]
+        return response
+
+    async def _maintain(self):
+        """
+        Rafraîchit la résolution, complète la réserve et vérifie les connexions inactives.
+        """
+        while True:
+            try:
+                if self.resolver.expired():
+                    await self.resolver.resolve()
+                await self._check_spares()
+                while len(self.spare) < self.spares:
+                    reader, writer = await self.connect("spare")
+                    if not await self._ping(reader, writer):
+                        writer.close()
+                        break
+                    self.spare.append((reader, writer, time.monotonic()))
+            except (OSError, asyncio.TimeoutError) as e:
+                logging.warning(f"Réserve de connexions au serveur incomplète : {e}")
+            spare_connections.set(len(self.spare))
+            self.wanted.clear()
+            try:
+                await asyncio.wait_for(self.wanted.wait(), min(self.check_interval, self.resolver.refresh))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _check_spares(self):
+        """
+        Vérifie les connexions de réserve inactives depuis check_interval secondes.
+        """
+        deadline = time.monotonic() - self.check_interval
+        for _ in range(len(self.spare)):
+            if not self.spare:
+                break  # connexions remises à des clients pendant la vérification
+            reader, writer, checked = self.spare.popleft()
+            if checked < deadline:
+                if not await self._ping(reader, writer):
+                    writer.close()
+                    continue
+                checked = time.monotonic()
+            self.spare.append((reader, writer, checked))
@@ -0,0 +1,226 @@
+import os
+import json
+import struct
+import threading
+import logging
+from urllib.parse import quote, unquote
+
+OFFSET = struct.Struct("<Q")
+
+class History:
+    """
+    Historique local des conversations d'un utilisateur.
+    Chaque conversation est un journal JSONL en ajout seul (messages envoyés et reçus,
+    dans l'ordre d'arrivée), accompagné d'un index binaire donnant la position de
+    chaque message. Un ajout coûte une écriture dans chacun des deux fichiers, et la
+    lecture des N derniers messages ne lit que ces N lignes.
+    """
+
+    def __init__(self, folder, owner):
+        self.folder = folder
+        self.owner = owner
+        self.user_folder = os.path.join(folder, quote(owner, safe=''))
+        self.lock = threading.Lock()
+        self._counts = {}  # partenaire → nombre de messages indexés
+        os.makedirs(self.user_folder, exist_ok=True)
+
+    def _paths(self, partner):
+        """
+        Chemins du journal et de l'index d'une conversation.
+        :param partner: Partenaire de conversation.
+        :return: (journal, index).
+        """
+        base = os.path.join(self.user_folder, quote(partner, safe=''))
+        return base + '.jsonl', base + '.idx'
+
+    def _open(self, partner):
+        """
+        Prépare une conversation à sa première utilisation : import des anciens
+        fichiers JSON, puis vérification de l'index.
+        :param partner: Partenaire de conversation.
+        :return: Nombre de messages.
+        """
+        count = self._counts.get(partner)
+        if count is None:
+            log_path, index_path = self._paths(partner)
+            if not os.path.exists(log_path):
+                self._migrate(partner)
+            count = self._repair(log_path, index_path)
+            self._counts[partner] = count
+        return count
+
+    def _migrate(self, partner):
+        """
+        Importe l'historique au format précédent ({a}_to_{b}.json, un fichier par sens),
+        fusionné par horodatage. Les anciens fichiers sont renommés en .migrated.
+        :param partner: Partenaire de conversation.
+        """
+        legacy = [os.path.join(self.folder, f"{self.owner}_to_{partner}.json"),
+                  os.path.join(self.folder, f"{partner}_to_{self.owner}.json")]
+        messages = []
+        for path in legacy:
+            try:
+                with open(path, 'r') as f:
+                    messages.extend(json.load(f))
+            except (OSError, ValueError):
+                continue
+        if not messages:
+            return
+        messages.sort(key=lambda m: m.get("timestamp", 0))
+        log_path, index_path = self._paths(partner)
+        self._write(log_path, index_path, 0, messages)
+        for path in legacy:
+            if os.path.exists(path):
+                os.replace(path, path + '.migrated')
+        logging.info(f"Historique avec {partner} importé ({len(messages)} messages)")
+
+    def _repair(self, log_path, index_path):
+        """
+        Remet l'index en accord avec le journal après un arrêt brutal : une dernière
+        ligne incomplète est tronquée, les messages écrits mais pas encore indexés
+        sont ajoutés à l'index.
+        :param log_path: Chemin du journal.
+        :param index_path: Chemin de l'index.
+        :return: Nombre de messages.
+        """
+        if not os.path.exists(log_path):
+            return 0
+        log_size = os.path.getsize(log_path)
+        offsets = []
+        with open(index_path, 'a+b') as index:
+            count = index.tell() // OFFSET.size
+            with open(log_path, 'rb') as log:
+                offset = 0
+                if count:
+                    index.seek((count - 1) * OFFSET.size)
+                    (last,) = OFFSET.unpack(index.read(OFFSET.size))
+                    if last < log_size:
+                        log.seek(last)
+                        line = log.readline()
+                        if line.endswith(b'\n'):
+                            offset = last + len(line)
+                    if not offset:
+                        count = 0  # index incohérent : reconstruit entièrement
+                log.seek(offset)
+                for line in log:
+                    if not line.endswith(b'\n'):
+                        logging.warning(f"Historique {log_path} : dernière ligne incomplète tronquée")
+                        break
+                    offsets.append(offset)
+                    offset += len(line)
+            index.truncate(count * OFFSET.size)
+            index.seek(0, os.SEEK_END)
+            index.write(b''.join(OFFSET.pack(o) for o in offsets))
+        if offset != log_size:
+            with open(log_path, 'r+b') as f:
+                f.truncate(offset)
+        return count + len(offsets)
+
+    def _write(self, log_path, index_path, count, messages):
+        """
+        Ajoute des messages au journal puis à l'index (dans cet ordre : un arrêt entre
+        les deux écritures est rattrapé par _repair).
+        :return: Nouveau nombre de messages.
+        """
+        data = [(json.dumps(m, ensure_ascii=False) + '\n').encode() for m in messages]
+        with open(log_path, 'ab') as log:
+            offset = log.tell()
+            log.write(b''.join(data))
+        offsets = []
+        for line in data:
+            offsets.append(OFFSET.pack(offset))
+            offset += len(line)
+        with open(index_path, 'ab') as index:
+            index.truncate(count * OFFSET.size)
+            index.write(b''.join(offsets))
+        return count + len(messages)
+
+    def append(self, partner, sender, timestamp, text):
+        """
+        Ajoute un message (envoyé ou reçu) à une conversation.
+        :param partner: Partenaire de conversation.
+        :param sender: Expéditeur du message.
+        :param timestamp: Horodatage du message.
+        :param text: Contenu du message.
+        """
+        self.append_many(partner, [{"timestamp": timestamp, "sender": sender, "text": text}])
+
+    def append_many(self, partner, messages):
+        """
+        Ajoute plusieurs messages à une conversation, en une écriture par fichier.
+        :param partner: Partenaire de conversation.
+        :param messages: Messages (timestamp, sender, text), dans l'ordre de la conversation.
+        """
+        if not messages:
+            return
+        with self.lock:
+            count = self._open(partner)
+            log_path, index_path = self._paths(partner)
+            self._counts[partner] = self._write(log_path, index_path, count, messages)
+
+    def partners(self):
+        """
+        Liste les partenaires ayant un historique, y compris au format précédent.
+        :return: Noms des partenaires.
+        """
+        names = set()
+        for name in os.listdir(self.user_folder):
+            if name.endswith('.jsonl'):
+                names.add(unquote(name[:-len('.jsonl')]))
+        prefix, suffix = f"{self.owner}_to_", f"_to_{self.owner}.json"
+        for name in os.listdir(self.folder):
+            if name.startswith(prefix) and name.endswith('.json'):
+                names.add(name[len(prefix):-len('.json')])
+            elif name.endswith(suffix):
+                names.add(name[:-len(suffix)])
+        return sorted(names)
+
+    def count(self, partner):
+        """
+        Retourne le nombre de messages d'une conversation.
+        :param partner: Partenaire de conversation.
+        """
+        with self.lock:
+            return self._open(partner)
+
+    def page(self, partner, before, size):
+        """
+        Lit les messages qui précèdent une position, dans l'ordre de la conversation.
+        :param partner: Partenaire de conversation.
+        :param before: Position du premier message à exclure (count() pour les derniers).
+        :param size: Nombre maximal de messages.
+        :return: (messages, position du premier message lu, à passer à l'appel suivant).
+        """
+        with self.lock:
+            count = self._open(partner)
+            end = min(before, count)
+            start = max(end - size, 0)
+            if start >= end:
+                return [], start
+            log_path, index_path = self._paths(partner)
+            with open(index_path, 'rb') as index:
+                index.seek(start * OFFSET.size)
+                (first,) = OFFSET.unpack(index.read(OFFSET.size))
+                last = None
+                if end < count:
+                    index.seek(end * OFFSET.size)
+                    (last,) = OFFSET.unpack(index.read(OFFSET.size))
+            with open(log_path, 'rb') as log:
+                log.seek(first)
+                data = log.read(last - first) if last is not None else log.read()
+        messages = []
+        for line in data.splitlines():
+            try:
+                messages.append(json.loads(line))
+            except ValueError:
+                continue
+        return messages, start
+
+    def last(self, partner, size):
+        """
+        Lit les derniers messages d'une conversation.
+        :param partner: Partenaire de conversation.
+        :param size: Nombre maximal de messages.
+        :return: (messages, position du premier message lu).
+        """
+        return self.page(partner, float('inf'), size)
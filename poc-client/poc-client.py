@@ -8,6 +8,12 @@ import sys
 from datetime import datetime
 import logging
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+from protocol import PLAIN, Codec, ProtocolError, decode_payload, encoding_offer, read_frame
+from history import History
+from sync import SyncEngine
+
 LOG_FOLDER = "logs"
 HISTORY_FOLDER = "history"
 os.makedirs(LOG_FOLDER, exist_ok=True)
@@ -25,30 +31,144 @@ logging.basicConfig(
 
 HOST = os.environ.get("HOST", "poc-server")
 PORT = 5000
+SYNC_LIMIT = 200
+WAIT_TIMEOUT = 20
+HISTORY_PAGE = 20
+POLL_ACTIONS = {"get_messages", "wait_messages"}
+NEGOTIATE_ENCODING = os.environ.get("NEGOTIATE_ENCODING", "1") != "0"
 
 session_token = None
 username = ""
-running = True
+history = None
+sync = None
+
+class ServerConnection:
+    """
+    Connexion persistante au serveur en protocole tramé.
+    Les requêtes sont numérotées : plusieurs requêtes peuvent partir à la suite
+    sur la même socket avant la lecture des réponses.
+    À l'ouverture, une requête "negotiate" part avec les premières requêtes : les
+    suivantes utilisent l'encodage retenu par le serveur (JSON simple si le serveur
+    ne connaît pas cette action).
+    """
+
+    def __init__(self):
+        self.sock = None
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.pending = {}  # réponses lues en avance, par identifiant
+        self.codec = PLAIN
+        self.negotiation = None  # identifiant de la requête "negotiate" en cours
+        self.interrupted = False
+
+    def close(self):
+        """
+        Ferme la connexion (elle sera rouverte à la requête suivante).
+        """
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.pending.clear()
+        self.codec = PLAIN
+        self.negotiation = None
+
+    def interrupt(self):
+        """
+        Interrompt depuis un autre fil la requête en cours (attente longue) : elle échoue
+        sans être rejouée, comme toutes les suivantes.
+        """
+        self.interrupted = True
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _exchange(self, requests):
+        """
+        Envoie des requêtes en une seule écriture puis lit leurs réponses.
+        :param requests: Requêtes à envoyer.
+        :return: Réponses, dans l'ordre des requêtes.
+        """
+        frames = []
+        if self.sock is None:
+            self.sock = socket.create_connection((HOST, PORT))
+            if NEGOTIATE_ENCODING:
+                self.next_id += 1
+                self.negotiation = self.next_id
+                frames.append(PLAIN.encode_frame(dict(encoding_offer(), action="negotiate", id=self.next_id)))
+        ids = []
+        for request in requests:
+            self.next_id += 1
+            ids.append(self.next_id)
+            frames.append(self.codec.encode_frame(dict(request, id=self.next_id)))
+        self.sock.sendall(b"".join(frames))
+        responses = []
+        for req_id in ids:
+            while req_id not in self.pending:
+                frame = read_frame(self.sock)
+                if frame is None:
+                    raise ProtocolError("connexion fermée par le serveur")
+                response = decode_payload(*frame)
+                response_id = response.pop("id", None)
+                if response_id is not None and response_id == self.negotiation:
+                    self.negotiation = None
+                    self.codec = Codec.from_encoding(response.get("encoding"))
+                    continue
+                self.pending[response_id] = response
+            responses.append(self.pending.pop(req_id))
+        return responses
+
+    def request_many(self, requests):
+        """
+        Envoie plusieurs requêtes en pipeline.
+        Une connexion réutilisée a pu être fermée par le serveur entre-temps :
+        dans ce cas l'échange est rejoué une fois sur une nouvelle connexion.
+        :param requests: Requêtes à envoyer.
+        :return: Réponses, dans l'ordre des requêtes.
+        """
+        with self.lock:
+            if self.interrupted:
+                raise ConnectionError("connexion interrompue")
+            reused = self.sock is not None
+            try:
+                return self._exchange(requests)
+            except (OSError, ProtocolError):
+                self.close()
+                if not reused or self.interrupted:
+                    raise
+            return self._exchange(requests)
+
+    def request(self, data):
+        """
+        Envoie une requête et attend sa réponse.
+        :param data: Requête.
+        :return: Réponse du serveur.
+        """
+        return self.request_many([data])[0]
 
-def send_request(data):
+
+connection = ServerConnection()
+
+def send_request(data, conn=None):
     """
     Envoie une requête au serveur et retourne la réponse.
     :param data: Données à envoyer.
-    :return: Réponse du serveur.
+    :param conn: Connexion à utiliser (par défaut la connexion principale).
+    :return: Réponse du serveur (dict).
     """
     try:
-        if data.get("action") != "get_messages":
+        if data.get("action") not in POLL_ACTIONS:
             logging.info(f"Envoi requête : {json.dumps(data)}")
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((HOST, PORT))
-            s.sendall(json.dumps(data).encode())
-            response = s.recv(8192).decode()
-            if data.get("action") != "get_messages":
-                logging.info(f"Réponse : {response}")
-            return response
+        response = (conn or connection).request(data)
+        if data.get("action") not in POLL_ACTIONS:
+            logging.info(f"Réponse : {json.dumps(response)}")
+        return response
     except Exception as e:
         logging.error(f"Erreur envoi requête : {e}")
-        return json.dumps({"status": "error", "message": str(e)})
+        (conn or connection).close()
+        return {"status": "error", "message": str(e)}
 
 
 def create_account():
@@ -58,8 +178,7 @@ def create_account():
     global username
     username = input("Créer un nom d'utilisateur : ").strip()
     password = getpass.getpass("Créer un mot de passe : ").strip()
-    response = send_request({"action": "register", "username": username, "password": password})
-    result = json.loads(response)
+    result = send_request({"action": "register", "username": username, "password": password})
     if result.get("status") == "ok":
         print("[INFO] Compte créé avec succès.")
     else:
@@ -70,14 +189,15 @@ def login():
     Connecte l'utilisateur.
     :return: True si la connexion est réussie, sinon False.
     """
-    global username, session_token
+    global username, session_token, history
     username = input("Nom d'utilisateur : ").strip()
     password = getpass.getpass("Mot de passe : ").strip()
     logging.info(f"Tentative de connexion : {username}")
-    response = send_request({"action": "login", "username": username, "password": password})
-    result = json.loads(response)
+    result = send_request({"action": "login", "username": username, "password": password})
     if result.get("status") == "ok":
         session_token = result.get("token")
+        history = History(HISTORY_FOLDER, username)
+        start_sync()
         logging.info(f"Connexion réussie : {username}")
         return True
     else:
@@ -92,142 +212,183 @@ def logout():
     """
     global session_token
     logging.info(f"Déconnexion de {username}")
+    stop_sync()
     send_request({"action": "logout", "token": session_token})
     session_token = None
 
-def save_sent_message(recipient, timestamp, text):
+def print_history(messages):
     """
-    Enregistre un message envoyé dans l'historique.
-    :param recipient: Destinataire du message.
-    :param timestamp: Horodatage du message.
-    :param text: Contenu du message.
+    Affiche des messages de l'historique.
+    :param messages: Messages à afficher.
     """
-    logging.info(f"Message envoyé à {recipient} à {timestamp} : {text}")
-    path = os.path.join(HISTORY_FOLDER, f"{username}_to_{recipient}.json")
-    try:
-        with open(path, 'r') as f:
-            data = json.load(f)
-    except:
-        data = []
-    data.append({"timestamp": timestamp, "sender": username, "text": text})
-    with open(path, 'w') as f:
-        json.dump(data, f)
-
-def save_received_message(sender, timestamp, text):
-    """
-    Enregistre un message reçu dans l'historique.
-    :param sender: Expéditeur du message.
-    :param timestamp: Horodatage du message.
-    :param text: Contenu du message.
-    """
-    logging.info(f"Message reçu de {sender} à {timestamp} : {text}")
-    path = os.path.join(HISTORY_FOLDER, f"{sender}_to_{username}.json")
-    try:
-        with open(path, 'r') as f:
-            data = json.load(f)
-    except:
-        data = []
-    data.append({"timestamp": timestamp, "sender": sender, "text": text})
-    with open(path, 'w') as f:
-        json.dump(data, f)
+    for msg in messages:
+        t = datetime.fromtimestamp(msg["timestamp"]).strftime("%H:%M")
+        print(f"[{t}] {msg['sender']} : {msg['text']}")
 
-def load_sent_messages(recipient):
+def get_messages(since=0, sender=None, limit=None, conn=None, mark_read=True):
     """
-    Charge l'historique des messages envoyés à un destinataire.
-    :param recipient: Destinataire des messages.
-    :return: Liste des messages envoyés.
+    Récupère les messages du serveur postérieurs à un curseur.
+    :param since: Curseur (identifiant du dernier message déjà reçu).
+    :param sender: Ne récupère que les messages de cet expéditeur.
+    :param limit: Nombre maximal de messages.
+    :param conn: Connexion à utiliser (par défaut la connexion principale).
+    :param mark_read: Le serveur marque lus les messages remis (False : voir mark_read).
+    :return: (liste des messages, curseur suivant).
     """
-    path = os.path.join(HISTORY_FOLDER, f"{username}_to_{recipient}.json")
-    try:
-        with open(path, 'r') as f:
-            return json.load(f)
-    except:
-        return []
+    request = {"action": "get_messages", "token": session_token, "since": since}
+    if sender is not None:
+        request["from"] = sender
+    if limit is not None:
+        request["limit"] = limit
+    if not mark_read:
+        request["mark_read"] = False
+    result = send_request(request, conn)
+    if result.get("status") != "ok":
+        return [], since
+    return result.get("messages", []), result.get("cursor", since)
 
-def load_received_messages(sender):
+def wait_messages(conn, since=0, sender=None, limit=None, timeout=WAIT_TIMEOUT, mark_read=True):
     """
-    Charge l'historique des messages reçus d'un expéditeur.
-    :param sender: Expéditeur des messages.
-    :return: Liste des messages reçus.
+    Attend de nouveaux messages côté serveur (long-poll).
+    :param conn: Connexion dédiée à l'attente (la connexion principale resterait bloquée).
+    :param since: Curseur (identifiant du dernier message déjà reçu).
+    :param sender: Ne récupère que les messages de cet expéditeur.
+    :param limit: Nombre maximal de messages.
+    :param timeout: Attente maximale côté serveur, en secondes.
+    :param mark_read: Le serveur marque lus les messages remis (False : voir mark_read).
+    :return: (liste des messages, curseur suivant), ou None si le serveur ne gère pas l'attente.
     """
-    path = os.path.join(HISTORY_FOLDER, f"{sender}_to_{username}.json")
-    try:
-        with open(path, 'r') as f:
-            return json.load(f)
-    except:
-        return []
+    request = {"action": "wait_messages", "token": session_token, "since": since, "timeout": timeout}
+    if sender is not None:
+        request["from"] = sender
+    if limit is not None:
+        request["limit"] = limit
+    if not mark_read:
+        request["mark_read"] = False
+    result = send_request(request, conn)
+    if result.get("status") != "ok":
+        if result.get("message") == "unknown action":
+            return None
+        time.sleep(1)  # serveur injoignable : on évite de boucler sans pause
+        return [], since
+    return result.get("messages", []), result.get("cursor", since)
 
-def get_messages():
+def search_messages(text, partner=None):
     """
-    Récupère les messages du serveur.
-    :return: Liste des messages.
+    Cherche des messages côté serveur (première page de résultats).
+    :param text: Mots cherchés.
+    :param partner: Restreint la recherche à la conversation avec ce partenaire.
+    :return: (résultats par pertinence, True s'il y a d'autres résultats).
     """
-    response = send_request({"action": "get_messages", "token": session_token})
-    result = json.loads(response)
+    request = {"action": "search_messages", "token": session_token, "query": text}
+    if partner is not None:
+        request["with"] = partner
+    result = send_request(request)
+    if result.get("status") != "ok":
+        return [], False
+    return result.get("results", []), result.get("next") is not None
+
+def mark_read(partner, cursor):
+    """
+    Signale au serveur qu'une conversation est affichée : ses messages ne sont plus
+    comptés comme non lus dans list_conversations.
+    :param partner: Partenaire de conversation.
+    :param cursor: Identifiant du dernier message reçu de ce partenaire et affiché.
+    """
+    send_request({"action": "mark_read", "token": session_token, "with": partner, "cursor": cursor})
+
+def get_conversations():
+    """
+    Récupère les résumés des conversations de l'utilisateur sur le serveur.
+    :return: Liste de résumés (partner, timestamp, sender, preview, unread), vide en cas d'erreur.
+    """
+    result = send_request({"action": "list_conversations", "token": session_token})
     if result.get("status") != "ok":
         return []
-    return result.get("messages", [])
+    return result.get("conversations", [])
 
-def get_conversation_partners():
+def start_sync():
     """
-    Récupère la liste des partenaires de conversation.
-    :return: Liste des partenaires de conversation.
+    Démarre la synchronisation des messages de la session, sur une connexion dédiée
+    (voir sync.py). Chaque requête reste en attente côté serveur jusqu'à l'arrivée d'un
+    message, quel que soit son expéditeur. Les résumés du serveur complètent le menu
+    tant que l'historique local ne connaît pas une conversation. Les messages remis ne
+    sont marqués lus côté serveur qu'à l'affichage de leur conversation.
     """
-    messages = get_messages()
-    partners = set()
-    for msg in messages:
-        partners.add(msg.get("sender"))
-    return sorted(partners)
-
-def fetch_live_messages(target):
-    """
-    Récupère les messages en temps réel pour une conversation donnée.
-    :param target: Destinataire de la conversation.
-    """
-    global running
-    seen = set()
-    while running:
-        messages = get_messages()
-        for msg in messages:
-            sender = msg.get("sender")
-            timestamp = msg.get("timestamp")
-            text = msg.get("message")
-            key = f"{sender}:{timestamp}:{text}"
-            if key in seen or sender != target:
-                continue
-            seen.add(key)
-            t = datetime.fromtimestamp(timestamp).strftime("%H:%M")
-            sys.stdout.write('\r' + ' ' * 80 + '\r')
-            print(f"[{t}] {sender} : {text}")
-            sys.stdout.write(f"{username} > ")
-            sys.stdout.flush()
-            save_received_message(sender, timestamp, text)
-        time.sleep(1)
+    global sync
+    conn = ServerConnection()
+    long_poll = True
+
+    def fetch(since):
+        nonlocal long_poll
+        result = wait_messages(conn, since, limit=SYNC_LIMIT, mark_read=False) if long_poll else None
+        if result is None:
+            long_poll = False  # ancien serveur : retour à l'interrogation périodique
+            result = get_messages(since, limit=SYNC_LIMIT, conn=conn, mark_read=False)
+            if len(result[0]) < SYNC_LIMIT:
+                time.sleep(1)
+        return result
+
+    sync = SyncEngine(history, fetch, interrupt=conn.interrupt, mark_read=mark_read)
+    sync.set_remote(get_conversations())
+    sync.start()
+
+def stop_sync():
+    """
+    Arrête la synchronisation et écrit l'historique en attente.
+    """
+    global sync
+    if sync is not None:
+        sync.stop()
+        sync = None
 
 def chat_session(target):
     """
     Gère une session de chat avec un partenaire.
+    Les messages viennent du cache de la synchronisation : ouvrir une conversation ne
+    coûte aucune requête au serveur.
     :param target: Nom du partenaire de conversation.
     """
-    global running
-    print(f"\n[Conversation avec {target}] (tape 'exit' pour quitter)")
+    print(f"\n[Conversation avec {target}] (tape 'exit' pour quitter, '/plus' pour les messages précédents, "
+          f"'/cherche mots' pour chercher dans la conversation)")
 
-    messages = load_sent_messages(target) + load_received_messages(target)
-    messages.sort(key=lambda m: m["timestamp"])
-    for msg in messages:
-        t = datetime.fromtimestamp(msg["timestamp"]).strftime("%H:%M")
-        sender = msg["sender"]
-        print(f"[{t}] {sender} : {msg['text']}")
+    def show_message(partner, msg):
+        sys.stdout.write('\r' + ' ' * 80 + '\r')
+        if partner == target:
+            print_history([msg])
+        else:
+            print(f"[INFO] Nouveau message de {partner}")
+        sys.stdout.write(f"{username} > ")
+        sys.stdout.flush()
 
-    running = True
-    listener = threading.Thread(target=fetch_live_messages, args=(target,), daemon=True)
-    listener.start()
+    messages, position = sync.open_conversation(target, HISTORY_PAGE)
+    print_history(messages)
+    sync.on_message = show_message
 
     try:
         while True:
             msg = input(f"{username} > ").strip()
             if msg.lower() == 'exit':
                 break
+            if msg == '/plus':
+                older, position = sync.page(target, position, HISTORY_PAGE)
+                if older:
+                    print(f"--- {len(older)} messages précédents ---")
+                    print_history(older)
+                    print("---")
+                else:
+                    print("[INFO] Début de la conversation.")
+                continue
+            if msg.startswith('/cherche '):
+                results, more = search_messages(msg[len('/cherche '):], target)
+                for hit in results:
+                    t = datetime.fromtimestamp(hit["timestamp"]).strftime("%d/%m %H:%M")
+                    print(f"[{t}] {hit['sender']} : {hit['snippet']}")
+                if not results:
+                    print("[INFO] Aucun message trouvé.")
+                elif more:
+                    print("[INFO] D'autres messages correspondent : précise la recherche.")
+                continue
             now = int(time.time())
             send_request({
                 "action": "send_message",
@@ -235,20 +396,28 @@ def chat_session(target):
                 "to": target,
                 "message": msg
             })
-            save_sent_message(target, now, msg)
+            logging.info(f"Message envoyé à {target} à {now} : {msg}")
+            sync.record_sent(target, now, msg)
     finally:
-        running = False
-        listener.join()
+        sync.on_message = None
+        sync.close_conversation()
 
 def discussion_menu():
     """
-    Affiche le menu des discussions.
+    Affiche le menu des discussions (depuis le cache de la synchronisation).
     """
     while True:
         print("\n--- DISCUSSIONS ---")
-        partners = get_conversation_partners()
-        for i, p in enumerate(partners):
-            print(f"{i + 1}. {p}")
+        conversations = sync.summaries()
+        partners = [c["partner"] for c in conversations]
+        for i, c in enumerate(conversations):
+            line = f"{i + 1}. {c['partner']}"
+            if c.get("unread"):
+                line += f" ({c['unread']} non lu{'s' if c['unread'] > 1 else ''})"
+            if c.get("preview") is not None:
+                t = datetime.fromtimestamp(c["timestamp"]).strftime("%H:%M")
+                line += f" — [{t}] {c['sender']} : {c['preview']}"
+            print(line)
         print("c. Nouvelle conversation")
         print("q. Retour")
         choice = input("> ").strip().lower()
@@ -297,4 +466,8 @@ def user_menu():
             break
 
 if __name__ == '__main__':
-    main_menu()
+    try:
+        main_menu()
+    finally:
+        stop_sync()
+        connection.close()
@@ -0,0 +1,335 @@
+import os
+import json
+import time
+import threading
+import logging
+
+FLUSH_INTERVAL = 1.0
+FLUSH_SIZE = 100
+CACHE_SIZE = 500
+CACHE_PAGE = 20
+PREVIEW_LENGTH = 50
+
+class Conversation:
+    """
+    Messages d'une conversation gardés en mémoire : une suite continue de l'historique
+    local (la fin, complétée à la demande par les pages précédentes), suivie des messages
+    pas encore écrits.
+    :param partner: Partenaire de conversation.
+    :param messages: Derniers messages de l'historique.
+    :param start: Position dans l'historique du premier message en mémoire.
+    """
+
+    def __init__(self, partner, messages, start):
+        self.partner = partner
+        self.messages = messages
+        self.start = start
+
+    def end(self):
+        """
+        Retourne la position qui suit le dernier message en mémoire.
+        """
+        return self.start + len(self.messages)
+
+
+class SyncEngine:
+    """
+    Synchronisation des messages d'une session, pour toutes les conversations à la fois.
+    Un seul fil attend les nouveaux messages (sans filtre d'expéditeur) et les range par
+    partenaire dans un cache en mémoire ; un second fil les ajoute à l'historique par lots,
+    au plus tard après FLUSH_INTERVAL secondes, puis enregistre l'état de la session
+    (curseur de synchronisation, messages non lus). Le menu et les conversations sont
+    servis depuis le cache, sans requête au serveur ; les résumés du serveur, demandés
+    une fois à l'ouverture de session (set_remote), complètent le menu tant que le
+    cache ne connaît pas une conversation.
+    L'état est écrit après l'historique : après un arrêt brutal, les derniers messages
+    sont redemandés au serveur plutôt que perdus.
+    :param history: Historique local de l'utilisateur.
+    :param fetch: fetch(since) → (messages reçus après le curseur, curseur suivant) ;
+                  peut rester en attente (wait_messages).
+    :param interrupt: Interrompt un fetch en cours depuis un autre fil (optionnel).
+    :param mark_read: mark_read(partenaire, curseur) signale au serveur les messages affichés,
+                      que fetch ne marque pas lus (optionnel).
+    """
+
+    def __init__(self, history, fetch, interrupt=None, mark_read=None):
+        self.history = history
+        self.fetch = fetch
+        self.interrupt = interrupt
+        self.mark_read = mark_read
+        self.state_path = os.path.join(history.folder, f"{history.owner}_sync.json")
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.conversations = {}  # partenaire → Conversation
+        self.pending = {}  # partenaire → messages pas encore écrits dans l'historique
+        self.pending_count = 0
+        self.cursor = 0
+        self.unread = {}
+        self.skip = {}  # curseurs par partenaire du format précédent, voir _load_state
+        self.remote = {}  # partenaire → résumé du serveur, voir set_remote
+        self.saved_state = None
+        self.open = None  # conversation affichée
+        self.on_message = None  # on_message(partenaire, message), appelé par le fil de synchronisation
+        self.stopped = threading.Event()
+        self.full = threading.Event()
+        self._load_state()
+        for partner in history.partners():
+            self._conversation(partner)
+        self.threads = [threading.Thread(target=self._run_sync, daemon=True),
+                        threading.Thread(target=self._run_writer, daemon=True)]
+
+    def _load_state(self):
+        """
+        Charge l'état de la session précédente. Les curseurs de l'ancien client (un par
+        partenaire, {owner}_cursors.json) sont repris pour ignorer les messages déjà
+        enregistrés, jusqu'à ce que la synchronisation les ait dépassés.
+        """
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+            legacy_path = os.path.join(self.history.folder, f"{self.history.owner}_cursors.json")
+            try:
+                with open(legacy_path, 'r') as f:
+                    state["skip"] = json.load(f)
+                os.replace(legacy_path, legacy_path + '.migrated')
+            except (OSError, ValueError):
+                pass
+        self.cursor = state.get("cursor", 0)
+        self.unread = state.get("unread", {})
+        self.skip = state.get("skip", {})
+        self.saved_state = state
+
+    def _save_state(self):
+        """
+        Enregistre l'état de la session s'il a changé (remplacement atomique du fichier).
+        """
+        with self.lock:
+            state = {"cursor": self.cursor, "unread": dict(self.unread), "skip": dict(self.skip)}
+        if state == self.saved_state:
+            return
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.state_path)
+        self.saved_state = state
+
+    def _conversation(self, partner):
+        """
+        Retourne la conversation en cache, chargée depuis la fin de l'historique à sa
+        première utilisation (à appeler avec le verrou).
+        :param partner: Partenaire de conversation.
+        """
+        conversation = self.conversations.get(partner)
+        if conversation is None:
+            messages, start = self.history.last(partner, CACHE_PAGE)
+            conversation = self.conversations[partner] = Conversation(partner, messages, start)
+        return conversation
+
+    def _add(self, partner, message):
+        """
+        Ajoute un message au cache et à la file d'écriture (à appeler avec le verrou).
+        Les messages les plus anciens d'une conversation non affichée sont retirés du
+        cache au-delà de CACHE_SIZE ; ils restent lisibles dans l'historique.
+        :param partner: Partenaire de conversation.
+        :param message: Message (timestamp, sender, text).
+        """
+        conversation = self._conversation(partner)
+        conversation.messages.append(message)
+        excess = len(conversation.messages) - CACHE_SIZE
+        if excess > 0 and partner != self.open:
+            del conversation.messages[:excess]
+            conversation.start += excess
+        self.pending.setdefault(partner, []).append(message)
+        self.pending_count += 1
+        if self.pending_count >= FLUSH_SIZE:
+            self.full.set()
+
+    def start(self):
+        """
+        Démarre la synchronisation et l'écriture de l'historique.
+        """
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """
+        Arrête la synchronisation et écrit ce qui reste en mémoire. Les messages
+        d'une attente interrompue sont ignorés : ils seront redemandés à la session suivante.
+        """
+        self.stopped.set()
+        self.full.set()
+        if self.interrupt is not None:
+            self.interrupt()
+        self.threads[1].join()
+        self.flush()
+
+    def _run_sync(self):
+        """
+        Fil de synchronisation : demande les messages qui suivent le curseur, en boucle.
+        """
+        while not self.stopped.is_set():
+            try:
+                messages, cursor = self.fetch(self.cursor)
+            except Exception as e:
+                logging.error(f"Synchronisation des messages : {e}")
+                time.sleep(1)
+                continue
+            if self.stopped.is_set():
+                break
+            self._receive(messages, cursor)
+
+    def _receive(self, messages, cursor):
+        """
+        Range les messages reçus par partenaire et avance le curseur.
+        :param messages: Messages du serveur (id, sender, timestamp, message).
+        :param cursor: Curseur suivant.
+        """
+        received = []
+        shown = 0  # dernier message de la conversation affichée
+        with self.lock:
+            for msg in messages:
+                sender = msg.get("sender")
+                if msg.get("id", 0) <= self.skip.get(sender, 0):
+                    continue  # déjà enregistré par l'ancien client
+                message = {"timestamp": msg.get("timestamp"), "sender": sender, "text": msg.get("message")}
+                logging.info(f"Message reçu de {sender} à {message['timestamp']} : {message['text']}")
+                self._add(sender, message)
+                if sender != self.open:
+                    self.unread[sender] = self.unread.get(sender, 0) + 1
+                else:
+                    shown = max(shown, msg.get("id", 0))
+                received.append((sender, message))
+            self.cursor = max(self.cursor, cursor)
+            if self.skip and self.cursor >= max(self.skip.values()):
+                self.skip = {}
+            on_message = self.on_message
+            partner = self.open
+        if on_message is not None:
+            for sender, message in received:
+                on_message(sender, message)
+        if shown and self.mark_read is not None:
+            self.mark_read(partner, shown)
+
+    def _run_writer(self):
+        """
+        Fil d'écriture de l'historique.
+        """
+        while not self.stopped.is_set():
+            self.full.wait(FLUSH_INTERVAL)
+            self.full.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Écrit dans l'historique les messages en attente, puis l'état de la session.
+        """
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                self.pending_count = 0
+            try:
+                for partner, messages in pending.items():
+                    self.history.append_many(partner, messages)
+                self._save_state()
+            except OSError as e:
+                logging.error(f"Écriture de l'historique échouée : {e}")
+
+    def record_sent(self, partner, timestamp, text):
+        """
+        Ajoute un message envoyé à une conversation.
+        :param partner: Destinataire du message.
+        :param timestamp: Horodatage du message.
+        :param text: Contenu du message.
+        """
+        with self.lock:
+            self._add(partner, {"timestamp": timestamp, "sender": self.history.owner, "text": text})
+
+    def set_remote(self, summaries):
+        """
+        Enregistre les résumés de conversation du serveur (list_conversations). Ils
+        comblent un cache froid (nouvel appareil, historique effacé) et les conversations
+        plus récentes sur le serveur (messages envoyés depuis un autre client).
+        :param summaries: Résumés (partner, timestamp, sender, preview, unread).
+        """
+        with self.lock:
+            self.remote = {s["partner"]: s for s in summaries if s.get("partner")}
+
+    def summaries(self):
+        """
+        Résume les conversations en cache, complétées par les résumés du serveur,
+        la plus récente en premier.
+        :return: Liste de résumés (partner, unread, et timestamp, sender, preview si la
+                 conversation n'est pas vide).
+        """
+        with self.lock:
+            summaries = []
+            for partner, conversation in self.conversations.items():
+                summary = {"partner": partner, "unread": self.unread.get(partner, 0)}
+                if conversation.messages:
+                    last = conversation.messages[-1]
+                    summary.update(timestamp=last["timestamp"], sender=last["sender"],
+                                   preview=(last["text"] or "")[:PREVIEW_LENGTH])
+                remote = self.remote.get(partner)
+                if remote is not None and remote["timestamp"] > summary.get("timestamp", 0):
+                    summary.update(timestamp=remote["timestamp"], sender=remote["sender"], preview=remote["preview"])
+                summaries.append(summary)
+            for partner, remote in self.remote.items():
+                if partner not in self.conversations:
+                    # messages non lus : comptés par le serveur jusqu'à leur synchronisation
+                    summaries.append({"partner": partner, "unread": remote.get("unread", 0),
+                                      "timestamp": remote["timestamp"], "sender": remote["sender"],
+                                      "preview": remote["preview"]})
+        summaries.sort(key=lambda s: s.get("timestamp") or 0, reverse=True)
+        return summaries
+
+    def open_conversation(self, partner, size):
+        """
+        Affiche une conversation : ses messages ne sont plus comptés comme non lus,
+        ici et côté serveur (tous les messages reçus jusqu'au curseur sont en cache
+        ou dans l'historique).
+        :param partner: Partenaire de conversation.
+        :param size: Nombre maximal de messages.
+        :return: (derniers messages, position du premier, à passer à page()).
+        """
+        with self.lock:
+            self.open = partner
+            unread = self.unread.pop(partner, 0)
+            remote = self.remote.get(partner)
+            if remote is not None:
+                unread += remote.get("unread", 0)
+                remote["unread"] = 0
+            conversation = self._conversation(partner)
+            end = conversation.end()
+            cursor = self.cursor
+        if unread and cursor and self.mark_read is not None:
+            self.mark_read(partner, cursor)
+        return self.page(partner, end, size)
+
+    def close_conversation(self):
+        """
+        Quitte la conversation affichée.
+        """
+        with self.lock:
+            self.open = None
+
+    def page(self, partner, before, size):
+        """
+        Lit les messages qui précèdent une position, depuis le cache ; les messages plus
+        anciens sont lus dans l'historique et ajoutés au cache.
+        :param partner: Partenaire de conversation.
+        :param before: Position du premier message à exclure.
+        :param size: Nombre maximal de messages.
+        :return: (messages, position du premier message lu).
+        """
+        with self.lock:
+            conversation = self._conversation(partner)
+            end = min(before, conversation.end())
+            first = max(end - size, 0)
+            if first < conversation.start:
+                older, start = self.history.page(partner, conversation.start, conversation.start - first)
+                conversation.messages[:0] = older
+                conversation.start = start
+                first = max(first, start)
+            return conversation.messages[first - conversation.start:end - conversation.start], first
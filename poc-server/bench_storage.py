@@ -0,0 +1,134 @@
+"""
+Compare les moteurs de stockage sur des boîtes pré-remplies.
+
+Usage : python bench_storage.py [--sizes 10000,100000,1000000] [--backends json,log,sqlite]
+                                [--users 1000] [--seed 42] [--budget 2]
+
+Pour chaque taille, les messages sont répartis aléatoirement (graine fixe) entre
+les utilisateurs, puis chaque opération est répétée au plus --repeat fois ou
+pendant --budget secondes. Les temps affichés sont la médiane et le p95 en ms.
+"""
+import argparse
+import os
+import sys
+import random
+import shutil
+import statistics
+import tempfile
+import time
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+from storage import JsonStore, open_store, save_json
+
+def generate(total, users, rng):
+    """
+    Génère des boîtes de réception aléatoires.
+    :param total: Nombre total de messages.
+    :param users: Nombre d'utilisateurs.
+    :param rng: Générateur aléatoire.
+    :return: Dictionnaire destinataire → messages.
+    """
+    names = [f"user{i}" for i in range(users)]
+    mailboxes = {name: [] for name in names}
+    for i in range(total):
+        recipient = rng.choice(names)
+        mailboxes[recipient].append({
+            "sender": rng.choice(names),
+            "timestamp": 1700000000 + i,
+            "message": f"message {i} " + "x" * rng.randint(5, 60),
+        })
+    return mailboxes
+
+def populate(backend, folder, mailboxes):
+    """
+    Remplit un stockage (écriture groupée par boîte).
+    :param backend: Nom du moteur.
+    :param folder: Dossier des données.
+    :param mailboxes: Boîtes à importer.
+    """
+    if backend == 'json':
+        # une seule écriture : append_messages réécrirait le fichier pour chaque boîte
+        save_json(os.path.join(folder, 'messages.json'), {
+            recipient: [dict(entry, id=i) for i, entry in enumerate(entries, 1)]
+            for recipient, entries in mailboxes.items()
+        })
+        JsonStore(folder, flush_interval=0)  # crée users.json et sessions.json
+        return
+    store = open_store(backend, folder)  # résumés écrits une seule fois, à la fermeture
+    for recipient, entries in mailboxes.items():
+        if entries:
+            store.append_messages(recipient, entries)
+    store.close()
+
+def measure(func, repeat, budget):
+    """
+    Chronomètre une opération.
+    :param func: Opération (sans argument).
+    :param repeat: Nombre maximal de répétitions.
+    :param budget: Durée maximale en secondes.
+    :return: (médiane, p95) en millisecondes.
+    """
+    samples = []
+    deadline = time.perf_counter() + budget
+    while len(samples) < repeat and (not samples or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1 if len(samples) > 1 else 0]
+
+def run(backend, total, users, seed, repeat, budget):
+    """
+    Mesure les opérations d'un moteur pour une taille donnée.
+    :return: Liste de (opération, médiane, p95).
+    """
+    rng = random.Random(seed)
+    mailboxes = generate(total, users, rng)
+    folder = tempfile.mkdtemp(prefix=f"bench-{backend}-")
+    try:
+        populate(backend, folder, mailboxes)
+        start = time.perf_counter()
+        # réglages du serveur : écriture différée des utilisateurs, sessions et résumés
+        store = open_store(backend, folder)
+        store.start()
+        results = [("ouverture", (time.perf_counter() - start) * 1000, None)]
+        names = list(mailboxes)
+        store.create_user("bench", "hash")
+        sizes = {name: len(entries) for name, entries in mailboxes.items()}
+        ops = {
+            "envoi": lambda: store.append_message(rng.choice(names), {
+                "sender": "bench", "timestamp": int(time.time()), "message": "bench"}),
+            "lecture incrémentale": lambda: store.get_messages(
+                (r := rng.choice(names)), max(sizes[r] - 20, 0)),
+            "lecture par expéditeur": lambda: store.get_messages(rng.choice(names), 0, 20, rng.choice(names)),
+            "partenaires": lambda: store.partners(rng.choice(names)),
+            "conversations": lambda: store.list_conversations(rng.choice(names)),
+            "conversation": lambda: store.conversation(rng.choice(names), rng.choice(names)),
+            "connexion": lambda: store.login("bench", "hash", str(uuid.uuid4())),
+        }
+        for name, op in ops.items():
+            median, p95 = measure(op, repeat, budget)
+            results.append((name, median, p95))
+        store.close()
+        return results
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Banc d'essai des moteurs de stockage")
+    parser.add_argument('--sizes', default='10000,100000,1000000', help="nombres de messages stockés")
+    parser.add_argument('--backends', default='json,sqlite', help="moteurs à comparer")
+    parser.add_argument('--users', type=int, default=1000, help="nombre d'utilisateurs")
+    parser.add_argument('--seed', type=int, default=42, help="graine aléatoire")
+    parser.add_argument('--repeat', type=int, default=200, help="répétitions maximales par opération")
+    parser.add_argument('--budget', type=float, default=2.0, help="durée maximale par opération (s)")
+    args = parser.parse_args()
+
+    print(f"{'messages':>9} {'moteur':<7} {'opération':<24} {'médiane ms':>11} {'p95 ms':>9}")
+    for size in [int(x) for x in args.sizes.split(',')]:
+        for backend in args.backends.split(','):
+            for op, median, p95 in run(backend, size, args.users, args.seed, args.repeat, args.budget):
+                p95_text = f"{p95:9.3f}" if p95 is not None else f"{'':>9}"
+                print(f"{size:>9} {backend:<7} {op:<24} {median:11.3f} {p95_text}", flush=True)
@@ -0,0 +1,195 @@
+import time
+import threading
+import logging
+from collections import OrderedDict
+
+from metrics import REGISTRY
+
+MAX_KEYS = 100000
+BUSY_RETRY_AFTER = 0.5
+# attente longue : bornée par les connexions, pas par le plafond des requêtes en cours
+UNCOUNTED_ACTIONS = {"wait_messages"}
+
+rejected_requests = REGISTRY.counter("server_rejected_requests_total", "Requêtes refusées par le contrôle d'admission",
+                                     ["reason"])
+shed_connections = REGISTRY.counter("server_shed_connections_total",
+                                    "Connexions fermées dès l'acceptation (adresse au-delà de sa limite)")
+
+def parse_rate(spec):
+    """
+    Lit une limite "débit:rafale" (requêtes par seconde ; rafale égale au débit si absente).
+    :param spec: Texte de configuration.
+    :return: (débit, rafale), ou None si la limite est désactivée (vide ou 0).
+    """
+    rate, _, burst = spec.strip().partition(":")
+    try:
+        rate = float(rate or 0)
+        burst = float(burst) if burst else max(rate, 1.0)
+    except ValueError:
+        logging.warning(f"Limite de débit ignorée : {spec}")
+        return None
+    return (rate, max(burst, 1.0)) if rate > 0 else None
+
+def parse_action_rates(spec):
+    """
+    Lit des limites par action "action=débit:rafale,action=débit:rafale".
+    :param spec: Texte de configuration.
+    :return: {action : (débit, rafale)}.
+    """
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        action, _, rate = item.partition("=")
+        limit = parse_rate(rate)
+        if limit is not None:
+            rates[action.strip()] = limit
+    return rates
+
+
+class RateLimiter:
+    """
+    Seaux à jetons indexés par clé : chaque clé dispose de `burst` requêtes, regagnées
+    au rythme de `rate` par seconde. Une vérification coûte O(1) ; au-delà de max_keys
+    clés, les moins récemment utilisées sont oubliées (elles repartent d'un seau plein).
+    :param rate: Débit autorisé, en requêtes par seconde.
+    :param burst: Nombre de requêtes admises d'affilée.
+    :param max_keys: Nombre maximal de seaux gardés en mémoire.
+    """
+
+    def __init__(self, rate, burst, max_keys=MAX_KEYS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()  # clé → [jetons, instant de la dernière mise à jour]
+
+    def _bucket(self, key, now):
+        """
+        Retourne le seau d'une clé, rempli selon le temps écoulé (appelé avec self.lock tenu).
+        """
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    def take(self, key):
+        """
+        Prélève une requête dans le seau d'une clé.
+        :param key: Clé (jeton de session, adresse, action).
+        :return: 0 si la requête est admise, sinon le délai en secondes avant qu'elle le soit.
+        """
+        with self.lock:
+            bucket = self._bucket(key, time.monotonic())
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / self.rate
+
+    def check(self, key):
+        """
+        Comme take(), sans rien prélever.
+        """
+        with self.lock:
+            tokens = self._bucket(key, time.monotonic())[0]
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+
+class AdmissionControl:
+    """
+    Admission des requêtes avant leur traitement :
+    * seaux à jetons par session, par adresse source (sauf adresses de confiance,
+      comme celle du proxy qui relaie tous les clients) et par action (débit total de
+      l'action, tous clients confondus). Seul un jeton de session valide a son propre
+      seau : une requête sans jeton ou avec un jeton inconnu (login, register, jetons
+      inventés à chaque requête) puise dans le seau anonyme de son adresse ;
+    * plafond des requêtes en cours de traitement, hors attentes longues.
+    Une requête refusée reçoit aussitôt une erreur indiquant quand réessayer, sans
+    attendre son tour : la surcharge ne s'accumule pas dans une file.
+    Les limites s'appliquent par processus (WORKERS).
+    :param token_rate: (débit, rafale) par session, ou None.
+    :param anonymous_rate: (débit, rafale) par adresse pour les requêtes sans session valide, ou None.
+    :param session_user: session_user(jeton) → utilisateur, ou None si le jeton est inconnu ou expiré.
+    :param address_rate: (débit, rafale) par adresse, ou None.
+    :param action_rates: {action : (débit, rafale)}.
+    :param max_in_flight: Requêtes traitées simultanément (0 : illimité).
+    :param trusted: Adresses exemptées de la limite par adresse.
+    """
+
+    def __init__(self, token_rate=None, address_rate=None, action_rates=None, max_in_flight=0, trusted=(),
+                 anonymous_rate=None, session_user=None):
+        self.tokens = RateLimiter(*token_rate) if token_rate else None
+        self.anonymous = RateLimiter(*anonymous_rate) if anonymous_rate else None
+        self.session_user = session_user
+        self.addresses = RateLimiter(*address_rate) if address_rate else None
+        self.actions = {action: RateLimiter(*rate, max_keys=1) for action, rate in (action_rates or {}).items()}
+        self.max_in_flight = max_in_flight
+        self.trusted = set(trusted)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        REGISTRY.gauge("server_requests_in_flight", "Requêtes en cours de traitement (hors attentes longues)",
+                       function=lambda: self.in_flight)
+
+    def shed_connection(self, address):
+        """
+        Indique si une nouvelle connexion doit être fermée sans être servie : son adresse
+        a épuisé sa limite, inutile de lui consacrer un thread.
+        :param address: Adresse source.
+        """
+        if self.addresses is None or address in self.trusted or not self.addresses.check(address):
+            return False
+        shed_connections.inc()
+        return True
+
+    def admit(self, req, address=None):
+        """
+        Décide de l'admission d'une requête décodée. Les limites du client (jeton,
+        adresse) passent avant celles de l'action : un client qui dépasse la sienne
+        n'entame pas le débit des autres.
+        :param req: Requête du client.
+        :param address: Adresse source.
+        :return: None si la requête est admise (release() à appeler après son traitement),
+                 sinon la réponse d'erreur à envoyer.
+        """
+        token = req.get("token")
+        action = req.get("action")
+        if not isinstance(action, str):
+            action = None
+        checks = []
+        valid = isinstance(token, str) and self.session_user is not None and self.session_user(token) is not None
+        if valid:
+            if self.tokens is not None:
+                checks.append(("token", self.tokens, token))
+        elif self.anonymous is not None and address is not None:
+            checks.append(("anonymous", self.anonymous, address))
+        if self.addresses is not None and address is not None and address not in self.trusted:
+            checks.append(("address", self.addresses, address))
+        if action in self.actions:
+            checks.append(("action", self.actions[action], action))
+        for reason, limiter, key in checks:
+            retry_after = limiter.take(key)
+            if retry_after:
+                rejected_requests.inc(reason=reason)
+                return {"status": "error", "message": "rate limited", "retry_after": round(retry_after, 3)}
+        if action in UNCOUNTED_ACTIONS:
+            return None
+        with self.lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                rejected_requests.inc(reason="in_flight")
+                return {"status": "error", "message": "server busy", "retry_after": BUSY_RETRY_AFTER}
+            self.in_flight += 1
+        return None
+
+    def release(self, req):
+        """
+        Signale la fin du traitement d'une requête admise.
+        :param req: Requête du client.
+        """
+        action = req.get("action")
+        if not (isinstance(action, str) and action in UNCOUNTED_ACTIONS):
+            with self.lock:
+                self.in_flight -= 1
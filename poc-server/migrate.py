@@ -0,0 +1,69 @@
+"""
+Importe les données au format historique (users.json, sessions.json, messages.json)
+dans un moteur de stockage.
+
+Usage : python migrate.py [--source data] [--target data] [--backend log] [--force]
+"""
+import argparse
+import os
+import sys
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+from storage import load_json, open_store
+
+def load_legacy(folder, name):
+    """
+    Charge un fichier JSON historique s'il existe.
+    :param folder: Dossier des données historiques.
+    :param name: Nom du fichier.
+    :return: Données chargées, ou un dictionnaire vide.
+    """
+    path = os.path.join(folder, name)
+    if not os.path.exists(path):
+        return {}
+    return load_json(path)
+
+def migrate(source, target, backend, force=False):
+    """
+    Copie utilisateurs, sessions et messages vers le moteur cible.
+    Les boîtes déjà présentes dans la cible sont ignorées, sauf avec force.
+    :param source: Dossier des fichiers historiques.
+    :param target: Dossier du moteur cible.
+    :param backend: Nom du moteur cible.
+    :param force: Importe même dans une boîte non vide.
+    :return: Nombre de messages importés.
+    """
+    same_folder = os.path.abspath(source) == os.path.abspath(target)
+    messages = load_legacy(source, 'messages.json')
+    store = open_store(backend, target)
+    try:
+        if not same_folder or backend not in ('json', 'log'):
+            for username, password_hash in load_legacy(source, 'users.json').items():
+                store.create_user(username, password_hash)
+            for token, session in load_legacy(source, 'sessions.json').items():
+                store.create_session(token, session["user"] if isinstance(session, dict) else session)
+        imported = 0
+        for recipient, entries in messages.items():
+            if store.get_messages(recipient, limit=1)[0] and not force:
+                print(f"Boîte de {recipient} déjà présente, ignorée (--force pour importer)")
+                continue
+            store.append_messages(recipient, entries)
+            imported += len(entries)
+    finally:
+        store.close()
+    if same_folder and backend != 'json' and messages:
+        os.replace(os.path.join(source, 'messages.json'), os.path.join(source, 'messages.json.migrated'))
+    return imported
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
+    parser = argparse.ArgumentParser(description="Migration des fichiers JSON vers un moteur de stockage")
+    parser.add_argument('--source', default='data', help="dossier des fichiers historiques")
+    parser.add_argument('--target', default=None, help="dossier du moteur cible (par défaut : la source)")
+    parser.add_argument('--backend', default=os.environ.get("STORAGE_BACKEND", "log"), help="moteur cible")
+    parser.add_argument('--force', action='store_true', help="importe même dans une boîte non vide")
+    args = parser.parse_args()
+    count = migrate(args.source, args.target or args.source, args.backend, args.force)
+    print(f"{count} messages importés vers le stockage {args.backend}")
@@ -0,0 +1,176 @@
+import os
+import socket
+import threading
+import time
+import logging
+
+class MailboxNotifier:
+    """
+    Réveille les requêtes en attente de nouveaux messages (long-poll).
+    Chaque boîte a sa propre condition, toutes partagent le même verrou :
+    un envoi ne réveille que les requêtes qui attendent ce destinataire.
+    Les attentes qui ne bloquent pas de thread (boucle asyncio) s'abonnent
+    avec une fonction de rappel.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conditions = {}  # destinataire → condition
+        self._waiters = {}     # destinataire → nombre de requêtes en attente
+        self._versions = {}    # destinataire → compteur d'envois
+        self._callbacks = {}   # destinataire → fonctions de rappel abonnées
+
+    def version(self, recipient):
+        """
+        Retourne le compteur d'envois d'une boîte, à lire avant de consulter le stockage.
+        :param recipient: Destinataire.
+        :return: Valeur du compteur.
+        """
+        with self._lock:
+            return self._versions.get(recipient, 0)
+
+    def notify(self, recipient):
+        """
+        Signale un nouveau message dans une boîte.
+        :param recipient: Destinataire.
+        """
+        with self._lock:
+            self._versions[recipient] = self._versions.get(recipient, 0) + 1
+            condition = self._conditions.get(recipient)
+            if condition is not None:
+                condition.notify_all()
+            callbacks = list(self._callbacks.get(recipient, ()))
+        for callback in callbacks:
+            callback()
+
+    def subscribe(self, recipient, callback):
+        """
+        Appelle callback à chaque envoi vers une boîte, jusqu'au désabonnement.
+        Le rappel est exécuté dans le thread de l'envoi : il doit rester bref.
+        :param recipient: Destinataire.
+        :param callback: Fonction sans argument.
+        """
+        with self._lock:
+            self._callbacks.setdefault(recipient, set()).add(callback)
+
+    def unsubscribe(self, recipient, callback):
+        """
+        Retire un abonnement.
+        :param recipient: Destinataire.
+        :param callback: Fonction passée à subscribe.
+        """
+        with self._lock:
+            callbacks = self._callbacks.get(recipient)
+            if callbacks is not None:
+                callbacks.discard(callback)
+                if not callbacks:
+                    del self._callbacks[recipient]
+
+    def wait(self, recipient, version, timeout):
+        """
+        Attend un envoi vers une boîte, sauf si le compteur a déjà changé.
+        :param recipient: Destinataire.
+        :param version: Compteur lu avant la dernière consultation du stockage.
+        :param timeout: Attente maximale en secondes.
+        :return: True si un message est arrivé, False si le délai a expiré.
+        """
+        with self._lock:
+            if self._versions.get(recipient, 0) != version:
+                return True
+            condition = self._conditions.setdefault(recipient, threading.Condition(self._lock))
+            self._waiters[recipient] = self._waiters.get(recipient, 0) + 1
+            try:
+                return condition.wait_for(lambda: self._versions.get(recipient, 0) != version, timeout)
+            finally:
+                self._waiters[recipient] -= 1
+                if not self._waiters[recipient]:
+                    del self._waiters[recipient]
+                    del self._conditions[recipient]
+
+
+class ProcessNotifier(MailboxNotifier):
+    """
+    Notificateur partagé par les processus du mode multi-processus.
+    Chaque processus écoute une socket Unix datagramme dans folder ; un envoi
+    réveille les attentes locales puis est diffusé aux autres processus.
+    """
+
+    def __init__(self, folder, refresh_interval=1.0):
+        super().__init__()
+        self.folder = folder
+        self.refresh_interval = refresh_interval
+        self.path = os.path.join(folder, f"{os.getpid()}.sock")
+        self._peers = []
+        self._peers_at = 0
+        os.makedirs(folder, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._inbox = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._inbox.bind(self.path)
+        self._outbox = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._outbox.setblocking(False)
+        threading.Thread(target=self._listen, daemon=True).start()
+
+    def _peer_paths(self):
+        """
+        Liste les sockets des autres processus (relue au plus une fois par refresh_interval).
+        :return: Chemins des sockets.
+        """
+        now = time.monotonic()
+        if now - self._peers_at >= self.refresh_interval:
+            self._peers = [os.path.join(self.folder, name) for name in os.listdir(self.folder)
+                           if name.endswith('.sock') and os.path.join(self.folder, name) != self.path]
+            self._peers_at = now
+        return self._peers
+
+    def notify(self, recipient):
+        """
+        Réveille les attentes locales et prévient les autres processus.
+        Un processus saturé peut perdre la notification : ses attentes se
+        terminent alors à l'expiration de leur délai.
+        :param recipient: Destinataire.
+        """
+        super().notify(recipient)
+        data = recipient.encode()
+        for path in self._peer_paths():
+            try:
+                self._outbox.sendto(data, path)
+            except BlockingIOError:
+                logging.debug(f"Notification perdue pour {path} (file pleine) : {recipient}")
+            except (ConnectionRefusedError, FileNotFoundError):
+                # processus arrêté sans avoir supprimé sa socket
+                logging.info(f"Socket de notification abandonnée retirée : {path}")
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                self._peers_at = 0
+            except OSError as e:
+                logging.warning(f"Notification vers {path} échouée : {e}")
+
+    def _listen(self):
+        """
+        Reçoit les notifications des autres processus.
+        """
+        while True:
+            try:
+                data = self._inbox.recv(4096)
+            except OSError as e:
+                logging.debug(f"Écoute des notifications arrêtée : {e}")
+                return
+            try:
+                recipient = data.decode()
+            except UnicodeDecodeError:
+                logging.warning(f"Notification illisible ignorée ({len(data)} octets)")
+                continue
+            MailboxNotifier.notify(self, recipient)
+
+    def close(self):
+        """
+        Ferme la socket d'écoute et la retire du dossier partagé.
+        """
+        self._inbox.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
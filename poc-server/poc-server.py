@@ -6,162 +6,764 @@ import uuid
 import hashlib
 import time
 import logging
+import signal
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+from protocol import (HEADER, MAX_FRAME_SIZE, PLAIN, Codec, ProtocolError, choose_encoding, decode_payload, is_legacy,
+                      read_frame, read_legacy_request, split_header)
+from storage import open_store
+from notifier import MailboxNotifier, ProcessNotifier
+from limits import AdmissionControl, parse_action_rates, parse_rate
+from metrics import REGISTRY, start_metrics_server, start_stats_dump
+from journal import log_event, setup_logging, stop_logging
 
 LOG_FOLDER = "logs"
+LOG_ASYNC = os.environ.get("LOG_ASYNC", "1") != "0"
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+LOG_SAMPLING = os.environ.get("LOG_SAMPLING", "get_messages=0,wait_messages=0")
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH = int(os.environ.get("LOG_BATCH", "256"))
 os.makedirs(LOG_FOLDER, exist_ok=True)
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='[%(asctime)s] [%(levelname)s] %(message)s',
-    handlers=[logging.FileHandler(os.path.join(LOG_FOLDER, "server.log"))]
-)
+setup_logging(os.path.join(LOG_FOLDER, "server.log"), structured=LOG_FORMAT == "json", use_queue=LOG_ASYNC,
+              queue_size=LOG_QUEUE_SIZE, batch=LOG_BATCH, sampling=LOG_SAMPLING)
 
 HOST = '0.0.0.0'
-PORT = 5000
+PORT = int(os.environ.get("PORT", "5000"))
 DATA_FOLDER = 'data'
-USERS_FILE = os.path.join(DATA_FOLDER, 'users.json')
-SESSIONS_FILE = os.path.join(DATA_FOLDER, 'sessions.json')
-MESSAGES_FILE = os.path.join(DATA_FOLDER, 'messages.json')
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "log")
+FLUSH_INTERVAL = float(os.environ.get("FLUSH_INTERVAL", "1.0"))
+FLUSH_BATCH = int(os.environ.get("FLUSH_BATCH", "100"))
+MAX_MESSAGES_PER_REQUEST = 500
+MAX_RECIPIENTS = 100
+MAX_WAIT_TIMEOUT = 60
+SEARCH_PAGE = 20
+MAX_SEARCH_RESULTS = 100
+SEARCH_REBUILD = os.environ.get("SEARCH_REBUILD", "0") != "0"
+IDLE_TIMEOUT = int(os.environ.get("IDLE_TIMEOUT", "300"))
+LEGACY_READ_TIMEOUT = 5
+COMPRESSION_THRESHOLD = int(os.environ.get("COMPRESSION_THRESHOLD", "1024"))
+SERVER_MODE = os.environ.get("SERVER_MODE", "threads")
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", "1000"))
+EXECUTOR_WORKERS = int(os.environ.get("EXECUTOR_WORKERS", "16"))
+EXECUTOR_QUEUE = int(os.environ.get("EXECUTOR_QUEUE", "256"))
+WORKERS = int(os.environ.get("WORKERS", "1"))
+SESSION_TTL = int(os.environ.get("SESSION_TTL", "86400"))
+SESSION_IDLE_TTL = int(os.environ.get("SESSION_IDLE_TTL", "3600"))
+MAX_SESSIONS_PER_USER = int(os.environ.get("MAX_SESSIONS_PER_USER", "10"))
+RETENTION_MAX_AGE = int(os.environ.get("RETENTION_MAX_AGE", "0"))
+RETENTION_MAX_COUNT = int(os.environ.get("RETENTION_MAX_COUNT", "0"))
+RETENTION_INTERVAL = float(os.environ.get("RETENTION_INTERVAL", "60"))
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))
+STATS_INTERVAL = float(os.environ.get("STATS_INTERVAL", "0"))
+RATE_LIMIT_TOKEN = os.environ.get("RATE_LIMIT_TOKEN", "50:100")
+RATE_LIMIT_ANONYMOUS = os.environ.get("RATE_LIMIT_ANONYMOUS", "200:2000")
+RATE_LIMIT_ADDRESS = os.environ.get("RATE_LIMIT_ADDRESS", "0")
+RATE_LIMIT_ACTIONS = os.environ.get("RATE_LIMIT_ACTIONS", "")
+RATE_LIMIT_TRUSTED = os.environ.get("RATE_LIMIT_TRUSTED", "")
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", "1000"))
+ACTIONS = {"register", "login", "logout", "send_message", "get_messages", "list_partners",
+           "list_conversations", "wait_messages", "ack_messages", "send_messages", "search_messages", "negotiate",
+           "mark_read", "ping"}
+
+store = open_store(STORAGE_BACKEND, DATA_FOLDER, flush_interval=FLUSH_INTERVAL, flush_batch=FLUSH_BATCH,
+                   session_ttl=SESSION_TTL or None, session_idle_ttl=SESSION_IDLE_TTL or None,
+                   max_sessions=MAX_SESSIONS_PER_USER or None, retention_max_age=RETENTION_MAX_AGE or None,
+                   retention_max_count=RETENTION_MAX_COUNT or None, retention_interval=RETENTION_INTERVAL,
+                   search_rebuild=SEARCH_REBUILD)
+
+if STORAGE_BACKEND != "json" and os.path.exists(os.path.join(DATA_FOLDER, "messages.json")):
+    logging.warning("messages.json ignoré par le stockage actuel : lancer migrate.py pour importer les messages")
+
+notifier = MailboxNotifier()
+
+admission = AdmissionControl(token_rate=parse_rate(RATE_LIMIT_TOKEN), address_rate=parse_rate(RATE_LIMIT_ADDRESS),
+                             action_rates=parse_action_rates(RATE_LIMIT_ACTIONS), max_in_flight=MAX_IN_FLIGHT,
+                             trusted=filter(None, (a.strip() for a in RATE_LIMIT_TRUSTED.split(","))),
+                             anonymous_rate=parse_rate(RATE_LIMIT_ANONYMOUS), session_user=store.get_session)
+
+requests_total = REGISTRY.counter("server_requests_total", "Requêtes traitées", ["action", "status"])
+request_seconds = REGISTRY.histogram("server_request_duration_seconds", "Durée de traitement des requêtes", ["action"])
+connections = REGISTRY.gauge("server_connections", "Connexions clientes ouvertes")
+REGISTRY.gauge("server_threads", "Threads actifs", function=threading.active_count)
+
+def observe_request(req, response, start):
+    """
+    Comptabilise une requête traitée.
+    :param req: Requête du client.
+    :param response: Réponse envoyée.
+    :param start: Instant de début du traitement (time.perf_counter).
+    """
+    action = req.get("action")
+    action = action if isinstance(action, str) and action in ACTIONS else "unknown"  # le client choisit l'action : nombre de séries borné
+    requests_total.inc(action=action, status=response.get("status"))
+    request_seconds.observe(time.perf_counter() - start, action=action)
+
+def parse_recipients(to):
+    """
+    Lit le ou les destinataires d'un message.
+    :param to: Nom d'un destinataire, ou liste de noms.
+    :return: Destinataires sans doublon, dans l'ordre, ou None si le champ est invalide.
+    """
+    recipients = [to] if isinstance(to, str) else to
+    if not isinstance(recipients, list) or not 0 < len(recipients) <= MAX_RECIPIENTS:
+        return None
+    if not all(isinstance(r, str) and r for r in recipients):
+        return None
+    return list(dict.fromkeys(recipients))
+
+def store_messages(batch):
+    """
+    Enregistre des messages en une écriture et réveille leurs destinataires.
+    :param batch: Liste de (destinataires, message (sender, timestamp, message)).
+    :return: Pour chaque message, {destinataire : identifiant attribué}.
+    """
+    results = store.append_batch(batch)
+    for recipient in dict.fromkeys(r for recipients, _ in batch for r in recipients):
+        notifier.notify(recipient)
+    return results
+
+def parse_message_query(req):
+    """
+    Lit les paramètres de lecture d'une boîte : curseur, limite et expéditeur.
+    :param req: Requête du client.
+    :return: (since, limit, sender), ou None si les paramètres sont invalides.
+    """
+    try:
+        since = max(int(req.get("since", 0)), 0)
+        limit = req.get("limit")
+        limit = min(max(int(limit), 1), MAX_MESSAGES_PER_REQUEST) if limit is not None else None
+    except (TypeError, ValueError):
+        return None
+    return since, limit, req.get("from")
+
+def parse_wait_request(req):
+    """
+    Authentifie et lit les paramètres d'une requête wait_messages.
+    :param req: Requête du client.
+    :return: ((user, query, timeout), None), ou (None, réponse d'erreur).
+    """
+    user = store.get_session(req.get("token"))
+    if not user:
+        return None, {"status": "error", "message": "unauthorized"}
+    query = parse_message_query(req)
+    try:
+        timeout = min(max(float(req.get("timeout", 0)), 0), MAX_WAIT_TIMEOUT)
+    except (TypeError, ValueError):
+        query = None
+    if query is None:
+        return None, {"status": "error", "message": "invalid cursor"}
+    return (user, query, timeout), None
+
+def read_on_delivery(req):
+    """
+    Indique si les messages remis par get_messages ou wait_messages sont marqués lus.
+    C'est le cas par défaut (anciens clients) ; un client qui signale lui-même les
+    conversations affichées (action mark_read) envoie "mark_read": false.
+    :param req: Requête du client.
+    """
+    return req.get("mark_read", True) is not False
+
+def wait_messages(user, query, timeout):
+    """
+    Attend qu'au moins un message corresponde à la requête, au plus timeout secondes.
+    :param user: Destinataire.
+    :param query: (since, limit, sender) tel que retourné par parse_message_query.
+    :param timeout: Attente maximale en secondes.
+    :return: (messages, curseur suivant), éventuellement sans message à l'expiration.
+    """
+    since, limit, sender = query
+    deadline = time.monotonic() + timeout
+    while True:
+        version = notifier.version(user)
+        messages, since = store.get_messages(user, since, limit, sender)
+        remaining = deadline - time.monotonic()
+        if messages or remaining <= 0:
+            return messages, since
+        notifier.wait(user, version, remaining)
 
-os.makedirs(DATA_FOLDER, exist_ok=True)
+def process_request(req):
+    """
+    Traite une requête décodée.
+    :param req: Requête du client.
+    :return: Réponse à envoyer.
+    """
+    action = req.get("action")
+    log_event(logging.INFO, "Requête reçue", action=action, request=req)
+
+    if action == "register":
+        username = req.get("username")
+        password = req.get("password")
+        if not username or not password:
+            logging.warning("Tentative d'inscription avec champs manquants")
+            return {"status": "error", "message": "missing credentials"}
+        if not store.create_user(username, hashlib.sha256(password.encode()).hexdigest()):
+            logging.warning(f"Nom d'utilisateur déjà pris : {username}")
+            return {"status": "error", "message": "username already exists"}
+        logging.info(f"Compte créé : {username}")
+        return {"status": "ok", "message": "user created"}
+
+    elif action == "login":
+        username = req.get("username")
+        password = req.get("password")
+        hashed_input = hashlib.sha256(password.encode()).hexdigest()
+        token = str(uuid.uuid4())
+        if not store.login(username, hashed_input, token):
+            logging.warning(f"Connexion refusée pour {username} (mauvais mot de passe)")
+            return {"status": "error", "message": "invalid credentials"}
+        logging.info(f"Connexion réussie : {username} → token={token}")
+        return {"status": "ok", "token": token}
+
+    elif action == "logout":
+        token = req.get("token")
+        user = store.delete_session(token)
+        logging.info(f"Déconnexion de {user} (token={token})")
+        return {"status": "ok"}
+
+    elif action == "send_message":
+        token = req.get("token")
+        to = req.get("to")
+        message = req.get("message")
+
+        if token == "MITM_FAKE":
+            sender = req.get("sender")
+            log_event(logging.INFO, "Message injecté par MITM", action=action, sender=sender, to=to, text=message)
+        else:
+            sender = store.get_session(token)
+
+        recipients = parse_recipients(to)
+        if not sender or not recipients or not message:
+            logging.warning("Envoi de message refusé (champs manquants ou non autorisé)")
+            return {"status": "error", "message": "missing or unauthorized"}
+
+        (ids,) = store_messages([(recipients, {
+            "sender": sender,
+            "timestamp": int(time.time()),
+            "message": message
+        })])
+        log_event(logging.INFO, "Message stocké", action=action, sender=sender, to=to, text=message)
+        return {"status": "ok", "ids": ids}
+
+    elif action == "send_messages":
+        sender = store.get_session(req.get("token"))
+        if not sender:
+            return {"status": "error", "message": "unauthorized"}
+        items = req.get("messages")
+        if not isinstance(items, list) or not 0 < len(items) <= MAX_MESSAGES_PER_REQUEST:
+            return {"status": "error", "message": "invalid batch"}
+        timestamp = int(time.time())
+        batch = []
+        results = []
+        for item in items:
+            recipients = parse_recipients(item.get("to")) if isinstance(item, dict) else None
+            message = item.get("message") if isinstance(item, dict) else None
+            if not recipients or not isinstance(message, str) or not message:
+                results.append({"status": "error", "message": "missing or invalid fields"})
+                continue
+            batch.append((recipients, {"sender": sender, "timestamp": timestamp, "message": message}))
+            results.append(None)  # complété après l'écriture
+        stored = iter(store_messages(batch) if batch else [])
+        results = [result or {"status": "ok", "ids": next(stored)} for result in results]
+        log_event(logging.INFO, "Messages stockés", action=action, sender=sender, count=len(batch),
+                  rejected=len(items) - len(batch))
+        return {"status": "ok", "results": results}
+
+    elif action == "get_messages":
+        token = req.get("token")
+        user = store.get_session(token)
+        if not user:
+            return {"status": "error", "message": "unauthorized"}
+        query = parse_message_query(req)
+        if query is None:
+            return {"status": "error", "message": "invalid cursor"}
+        messages, cursor = store.get_messages(user, *query)
+        if messages and read_on_delivery(req):
+            store.mark_read(user, messages)
+        return {"status": "ok", "messages": messages, "cursor": cursor}
+
+    elif action == "list_partners":
+        user = store.get_session(req.get("token"))
+        if not user:
+            return {"status": "error", "message": "unauthorized"}
+        return {"status": "ok", "partners": store.partners(user)}
+
+    elif action == "list_conversations":
+        user = store.get_session(req.get("token"))
+        if not user:
+            return {"status": "error", "message": "unauthorized"}
+        return {"status": "ok", "conversations": store.list_conversations(user)}
 
-for file in [USERS_FILE, SESSIONS_FILE, MESSAGES_FILE]:
-    if not os.path.exists(file):
-        with open(file, 'w') as f:
-            json.dump({}, f)
+    elif action == "wait_messages":
+        wait, error = parse_wait_request(req)
+        if error:
+            return error
+        messages, cursor = wait_messages(*wait)
+        if messages and read_on_delivery(req):
+            store.mark_read(wait[0], messages)
+        return {"status": "ok", "messages": messages, "cursor": cursor}
 
-def load_json(path):
+    elif action == "ack_messages":
+        user = store.get_session(req.get("token"))
+        if not user:
+            return {"status": "error", "message": "unauthorized"}
+        try:
+            cursor = max(int(req.get("cursor")), 0)
+        except (TypeError, ValueError):
+            return {"status": "error", "message": "invalid cursor"}
+        return {"status": "ok", "acked": store.ack_messages(user, cursor)}
+
+    elif action == "mark_read":
+        user = store.get_session(req.get("token"))
+        if not user:
+            return {"status": "error", "message": "unauthorized"}
+        partner = req.get("with")
+        try:
+            cursor = max(int(req.get("cursor")), 0)
+        except (TypeError, ValueError):
+            return {"status": "error", "message": "invalid cursor"}
+        if not isinstance(partner, str):
+            return {"status": "error", "message": "invalid partner"}
+        store.mark_conversation_read(user, partner, cursor)
+        return {"status": "ok"}
+
+    elif action == "search_messages":
+        user = store.get_session(req.get("token"))
+        if not user:
+            return {"status": "error", "message": "unauthorized"}
+        text = req.get("query")
+        partner = req.get("with")
+        try:
+            offset = max(int(req.get("offset", 0)), 0)
+            limit = min(max(int(req.get("limit", SEARCH_PAGE)), 1), MAX_SEARCH_RESULTS)
+        except (TypeError, ValueError):
+            text = None
+        if not isinstance(text, str) or not text.strip() or not (partner is None or isinstance(partner, str)):
+            return {"status": "error", "message": "invalid query"}
+        # un résultat de plus pour savoir s'il reste une page
+        results = store.search_messages(user, text, offset, limit + 1, partner)
+        more = len(results) > limit
+        return {"status": "ok", "results": results[:limit], "next": offset + limit if more else None}
+
+    elif action == "negotiate":
+        # l'encodage retenu s'applique aux réponses suivantes de la connexion (voir connection_codec)
+        return {"status": "ok", "encoding": choose_encoding(req, COMPRESSION_THRESHOLD)}
+
+    elif action == "ping":
+        return {"status": "ok"}
+
+    else:
+        logging.warning(f"Action inconnue reçue : {action}")
+        return {"status": "error", "message": "unknown action"}
+
+def decode_request(data, flags=0):
     """
-    Charge les données d'un fichier JSON.
-    :param path: Chemin du fichier.
-    :return: Données chargées.
+    Décode le contenu brut d'une requête.
+    :param data: Contenu brut de la requête.
+    :param flags: Indicateurs d'encodage de la trame (JSON simple par défaut ; None pour
+                  une requête historique, hors trame).
+    :return: (requête, None), ou (None, réponse d'erreur).
     """
-    with open(path, 'r') as f:
-        return json.load(f)
+    try:
+        req = decode_payload(data, flags or 0)
+    except ProtocolError as e:
+        logging.warning(f"Requête invalide reçue ({e})")
+        return None, {"status": "error", "message": "invalid encoding"}
+    except ValueError:
+        logging.warning("Requête invalide reçue (JSONDecodeError)")
+        return None, {"status": "error", "message": "invalid json"}
+    if not isinstance(req, dict):
+        return None, {"status": "error", "message": "invalid json"}
+    return req, None
 
-def save_json(path, data):
+def with_id(req, response):
     """
-    Enregistre les données dans un fichier JSON.
-    :param path: Chemin du fichier.
-    :param data: Données à enregistrer.
+    Recopie l'identifiant de la requête dans la réponse.
+    :param req: Requête du client.
+    :param response: Réponse.
+    :return: La réponse.
     """
-    with open(path, 'w') as f:
-        json.dump(data, f, indent=2)
+    if "id" in req:
+        response["id"] = req["id"]
+    return response
+
+def respond_to(req):
+    """
+    Traite une requête décodée et construit la réponse, même en cas d'erreur interne.
+    :param req: Requête du client.
+    :return: Réponse (dict).
+    """
+    start = time.perf_counter()
+    try:
+        response = process_request(req)
+    except Exception as e:
+        logging.exception(f"Erreur de traitement ({req.get('action')}) : {e}")
+        response = {"status": "error", "message": "internal error"}
+    observe_request(req, response, start)
+    return with_id(req, response)
+
+def admit(req, address, start):
+    """
+    Soumet une requête au contrôle d'admission.
+    :param req: Requête du client.
+    :param address: Adresse source.
+    :param start: Instant de réception (time.perf_counter).
+    :return: None si la requête est admise (admission.release() à appeler après son
+             traitement), sinon la réponse de refus, comptabilisée.
+    """
+    refusal = admission.admit(req, address)
+    if refusal is None:
+        return None
+    observe_request(req, refusal, start)
+    return with_id(req, refusal)
+
+def respond(data, flags=0, address=None):
+    """
+    Décode une requête, la traite et construit la réponse ; une requête refusée par
+    le contrôle d'admission reçoit aussitôt son erreur, sans être traitée.
+    :param data: Contenu brut de la requête.
+    :param flags: Indicateurs d'encodage de la trame.
+    :param address: Adresse source du client.
+    :return: Réponse (dict).
+    """
+    req, error = decode_request(data, flags)
+    if error:
+        return error
+    refusal = admit(req, address, time.perf_counter())
+    if refusal:
+        return refusal
+    try:
+        return respond_to(req)
+    finally:
+        admission.release(req)
+
+def connection_codec(codec, response):
+    """
+    :param codec: Encodage actuel des réponses de la connexion.
+    :param response: Réponse qui vient d'être envoyée.
+    :return: Encodage des réponses suivantes : celui retenu par "negotiate", sinon l'actuel.
+    """
+    encoding = response.get("encoding")
+    return Codec.from_encoding(encoding) if encoding is not None else codec
 
 def handle_client(conn):
     """
-    Gère la connexion d'un client.
+    Gère la connexion d'un client, en mode historique (une requête puis fermeture)
+    ou en mode tramé (requêtes successives sur la même connexion).
     :param conn: La connexion du client.
     """
+    connections.inc()
     with conn:
-        data = conn.recv(8192).decode()
-        if not data:
-            return
         try:
-            req = json.loads(data)
-        except json.JSONDecodeError:
-            logging.warning("Requête invalide reçue (JSONDecodeError)")
-            conn.sendall(json.dumps({"status": "error", "message": "invalid json"}).encode())
-            return
-
-        action = req.get("action")
-        if action != "get_messages":
-            logging.info(f"Requête reçue : action={action} → {json.dumps(req)}")
-
-        if action == "register":
-            username = req.get("username")
-            password = req.get("password")
-            if not username or not password:
-                logging.warning("Tentative d'inscription avec champs manquants")
-                conn.sendall(json.dumps({"status": "error", "message": "missing credentials"}).encode())
+            address = conn.getpeername()[0]
+            first = conn.recv(1, socket.MSG_PEEK)
+            if not first:
                 return
-            users = load_json(USERS_FILE)
-            if username in users:
-                logging.warning(f"Nom d'utilisateur déjà pris : {username}")
-                conn.sendall(json.dumps({"status": "error", "message": "username already exists"}).encode())
+            if is_legacy(first):
+                conn.settimeout(LEGACY_READ_TIMEOUT)
+                data = read_legacy_request(conn)
+                if data:
+                    conn.sendall(json.dumps(respond(data, None, address)).encode())
                 return
-            users[username] = hashlib.sha256(password.encode()).hexdigest()
-            save_json(USERS_FILE, users)
-            logging.info(f"Compte créé : {username}")
-            conn.sendall(json.dumps({"status": "ok", "message": "user created"}).encode())
-
-        elif action == "login":
-            username = req.get("username")
-            password = req.get("password")
-            users = load_json(USERS_FILE)
-            hashed_input = hashlib.sha256(password.encode()).hexdigest()
-            if users.get(username) != hashed_input:
-                logging.warning(f"Connexion refusée pour {username} (mauvais mot de passe)")
-                conn.sendall(json.dumps({"status": "error", "message": "invalid credentials"}).encode())
-                return
-            sessions = load_json(SESSIONS_FILE)
-            token = str(uuid.uuid4())
-            sessions[token] = username
-            save_json(SESSIONS_FILE, sessions)
-            logging.info(f"Connexion réussie : {username} → token={token}")
-            conn.sendall(json.dumps({"status": "ok", "token": token}).encode())
-
-        elif action == "logout":
-            token = req.get("token")
-            sessions = load_json(SESSIONS_FILE)
-            user = sessions.pop(token, None)
-            save_json(SESSIONS_FILE, sessions)
-            logging.info(f"Déconnexion de {user} (token={token})")
-            conn.sendall(json.dumps({"status": "ok"}).encode())
-
-        elif action == "send_message":
-            token = req.get("token")
-            to = req.get("to")
-            message = req.get("message")
-
-            if token == "MITM_FAKE":
-                sender = req.get("sender")
-                logging.info(f"Message injecté par MITM : {sender} → {to} : {message}")
-            else:
-                sessions = load_json(SESSIONS_FILE)
-                sender = sessions.get(token)
-
-            if not sender or not to or not message:
-                logging.warning("Envoi de message refusé (champs manquants ou non autorisé)")
-                conn.sendall(json.dumps({"status": "error", "message": "missing or unauthorized"}).encode())
-                return
-
-            msgs = load_json(MESSAGES_FILE)
-            msgs.setdefault(to, []).append({
-                "sender": sender,
-                "timestamp": int(time.time()),
-                "message": message
-            })
-            save_json(MESSAGES_FILE, msgs)
-            logging.info(f"Message stocké de {sender} vers {to} : {message}")
-            conn.sendall(json.dumps({"status": "ok"}).encode())
-
-        elif action == "get_messages":
-            token = req.get("token")
-            sessions = load_json(SESSIONS_FILE)
-            user = sessions.get(token)
-            if not user:
-                conn.sendall(json.dumps({"status": "error", "message": "unauthorized"}).encode())
-                return
-            msgs = load_json(MESSAGES_FILE)
-            conn.sendall(json.dumps({"status": "ok", "messages": msgs.get(user, [])}).encode())
+            conn.settimeout(IDLE_TIMEOUT)
+            codec = PLAIN
+            while True:
+                frame = read_frame(conn)
+                if frame is None:
+                    return
+                response = respond(*frame, address=address)
+                conn.sendall(codec.encode_frame(response))
+                codec = connection_codec(codec, response)
+        except (OSError, ProtocolError) as e:
+            logging.debug(f"Connexion interrompue : {e}")
+        finally:
+            connections.dec()
 
-        else:
-            logging.warning(f"Action inconnue reçue : {action}")
-            conn.sendall(json.dumps({"status": "error", "message": "unknown action"}).encode())
-
-def start_server():
+def start_server(reuse_port=False):
     """
     Démarre le serveur et écoute les connexions entrantes.
+    :param reuse_port: Partage le port avec les autres processus (SO_REUSEPORT).
     """
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         s.bind((HOST, PORT))
         s.listen()
         print(f"Démarré sur {HOST}:{PORT}")
-        logging.info(f"Démarré sur {HOST}:{PORT}")
+        logging.info(f"Démarré sur {HOST}:{PORT} (stockage {STORAGE_BACKEND})")
         while True:
-            conn, _ = s.accept()
+            conn, (address, _) = s.accept()
+            if admission.shed_connection(address):
+                conn.close()  # adresse au-delà de sa limite : pas de thread pour elle
+                continue
             threading.Thread(target=handle_client, args=(conn,), daemon=True).start()
 
+async def read_legacy_request_async(reader, first):
+    """
+    Lit une requête historique (objet JSON brut) sur un flux asyncio.
+    :param reader: Flux de lecture.
+    :param first: Premier octet déjà lu.
+    :return: Contenu brut de la requête.
+    """
+    data = first
+    while len(data) <= MAX_FRAME_SIZE:
+        try:
+            json.loads(data)
+            return data
+        except ValueError:
+            pass  # objet incomplet : on attend la suite
+        chunk = await reader.read(65536)
+        if not chunk:
+            return data
+        data += chunk
+    raise ProtocolError("requête trop grande")
+
+async def read_frame_async(reader, first=b""):
+    """
+    Lit une trame sur un flux asyncio.
+    :param reader: Flux de lecture.
+    :param first: Début d'en-tête déjà lu.
+    :return: (contenu de la trame, indicateurs d'encodage), ou None si la connexion est fermée.
+    """
+    try:
+        header = first + await reader.readexactly(HEADER.size - len(first))
+    except asyncio.IncompleteReadError as e:
+        if e.partial or first:
+            raise ProtocolError("connexion fermée au milieu d'une trame")
+        return None
+    flags, size = split_header(HEADER.unpack(header)[0])
+    try:
+        return await reader.readexactly(size), flags
+    except asyncio.IncompleteReadError:
+        raise ProtocolError("connexion fermée au milieu d'une trame")
+
+async def wait_messages_async(run_blocking, user, query, timeout):
+    """
+    Équivalent de wait_messages qui n'occupe aucun thread pendant l'attente :
+    la boucle est réveillée par un abonnement au notificateur.
+    :param run_blocking: Exécute un appel bloquant dans le pool de threads.
+    :param user: Destinataire.
+    :param query: (since, limit, sender).
+    :param timeout: Attente maximale en secondes.
+    :return: (messages, curseur suivant).
+    """
+    loop = asyncio.get_running_loop()
+    since, limit, sender = query
+    deadline = loop.time() + timeout
+    woken = asyncio.Event()
+    callback = lambda: loop.call_soon_threadsafe(woken.set)
+    notifier.subscribe(user, callback)
+    try:
+        while True:
+            woken.clear()
+            messages, since = await run_blocking(store.get_messages, user, since, limit, sender)
+            remaining = deadline - loop.time()
+            if messages or remaining <= 0:
+                return messages, since
+            try:
+                await asyncio.wait_for(woken.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        notifier.unsubscribe(user, callback)
+
+async def serve_async(reuse_port=False):
+    """
+    Boucle principale du mode asyncio.
+    Les appels au stockage passent par un pool de EXECUTOR_WORKERS threads ; au-delà
+    de EXECUTOR_QUEUE appels en attente, les connexions ne sont plus lues (le client
+    est freiné par TCP). Au-delà de MAX_CONNECTIONS connexions, les nouvelles
+    reçoivent immédiatement une erreur "server busy".
+    :param reuse_port: Partage le port avec les autres processus (SO_REUSEPORT).
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix="store")
+    pending = asyncio.Semaphore(EXECUTOR_QUEUE)
+    active = 0
+
+    async def run_blocking(func, *args):
+        async with pending:
+            return await loop.run_in_executor(executor, func, *args)
+
+    async def answer(data, flags, address):
+        req, error = decode_request(data, flags)
+        if error:
+            return error
+        start = time.perf_counter()
+        refusal = admit(req, address, start)  # avant le pool : un refus n'y attend pas son tour
+        if refusal:
+            return refusal
+        try:
+            return await serve_request(req, start)
+        finally:
+            admission.release(req)
+
+    async def serve_request(req, start):
+        if req.get("action") != "wait_messages":
+            return await run_blocking(respond_to, req)
+        wait, error = await run_blocking(parse_wait_request, req)
+        if error:
+            observe_request(req, error, start)
+            return with_id(req, error)
+        messages, cursor = await wait_messages_async(run_blocking, *wait)
+        if messages and read_on_delivery(req):
+            await run_blocking(store.mark_read, wait[0], messages)
+        response = {"status": "ok", "messages": messages, "cursor": cursor}
+        observe_request(req, response, start)
+        return with_id(req, response)
+
+    async def handle(reader, writer):
+        nonlocal active
+        active += 1
+        connections.inc()
+        busy = active > MAX_CONNECTIONS
+        address = writer.get_extra_info("peername")[0]
+        try:
+            if admission.shed_connection(address):
+                return
+            first = await asyncio.wait_for(reader.read(1), LEGACY_READ_TIMEOUT)
+            if not first:
+                return
+            if is_legacy(first):
+                data = await asyncio.wait_for(read_legacy_request_async(reader, first), LEGACY_READ_TIMEOUT)
+                response = {"status": "error", "message": "server busy"} if busy else await answer(data, None, address)
+                writer.write(json.dumps(response).encode())
+                await writer.drain()
+                return
+            codec = PLAIN
+            while True:
+                frame = await asyncio.wait_for(read_frame_async(reader, first), IDLE_TIMEOUT)
+                first = b""
+                if frame is None:
+                    return
+                if busy:
+                    req, _ = decode_request(*frame)
+                    writer.write(codec.encode_frame(with_id(req or {}, {"status": "error", "message": "server busy"})))
+                    await writer.drain()
+                    return
+                response = await answer(*frame, address)
+                writer.write(codec.encode_frame(response))
+                codec = connection_codec(codec, response)
+                await writer.drain()
+        except (OSError, ProtocolError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            logging.debug(f"Connexion interrompue : {e}")
+        finally:
+            active -= 1
+            connections.dec()
+            writer.close()
+
+    server = await asyncio.start_server(handle, HOST, PORT, backlog=MAX_CONNECTIONS, reuse_port=reuse_port)
+    print(f"Démarré sur {HOST}:{PORT} (asyncio)")
+    logging.info(f"Démarré sur {HOST}:{PORT} (asyncio, stockage {STORAGE_BACKEND}, "
+                 f"{MAX_CONNECTIONS} connexions max, {EXECUTOR_WORKERS} threads de stockage)")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        executor.shutdown(wait=False)
+
+def start_async_server(reuse_port=False):
+    """
+    Démarre le serveur en mode asyncio (SERVER_MODE=asyncio).
+    :param reuse_port: Partage le port avec les autres processus (SO_REUSEPORT).
+    """
+    asyncio.run(serve_async(reuse_port))
+
+def serve(reuse_port=False):
+    """
+    Démarre le serveur dans le mode choisi par SERVER_MODE.
+    :param reuse_port: Partage le port avec les autres processus (SO_REUSEPORT).
+    """
+    if SERVER_MODE == "asyncio":
+        start_async_server(reuse_port)
+    else:
+        start_server(reuse_port)
+
+def start_monitoring(metrics_port):
+    """
+    Démarre l'exposition des métriques et leur résumé périodique dans les logs.
+    :param metrics_port: Port local des métriques (0 : désactivé).
+    """
+    start_metrics_server(metrics_port, METRICS_HOST)
+    start_stats_dump(STATS_INTERVAL)
+
+def run_worker(slot):
+    """
+    Corps d'un processus de travail : les attentes de messages sont réveillées
+    par les envois traités dans les autres processus.
+    :param slot: Rang du processus (ses métriques sont sur METRICS_PORT + slot).
+    """
+    global notifier
+    notifier = ProcessNotifier(os.path.join(DATA_FOLDER, "notify"))
+    start_monitoring(METRICS_PORT + slot if METRICS_PORT else 0)
+    store.start()
+    try:
+        serve(reuse_port=True)
+    finally:
+        notifier.close()
+        store.close()
+
+def start_workers(count):
+    """
+    Mode multi-processus : lance count processus qui écoutent tous sur PORT
+    (SO_REUSEPORT, le noyau répartit les connexions) et les relance s'ils s'arrêtent.
+    Les données doivent être partagées entre processus : seul le stockage sqlite convient.
+    Un processus relancé reprend le rang du processus arrêté.
+    :param count: Nombre de processus.
+    """
+    if STORAGE_BACKEND != "sqlite":
+        sys.exit(f"WORKERS={count} nécessite STORAGE_BACKEND=sqlite (stockage partagé entre processus)")
+    children = {}  # pid → rang
+
+    def spawn(slot):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+            code = 0
+            try:
+                run_worker(slot)
+            except SystemExit:
+                pass
+            except BaseException as e:
+                logging.exception(f"Arrêt du processus {os.getpid()} : {e}")
+                code = 1
+            finally:
+                stop_logging()
+                os._exit(code)
+        children[pid] = slot
+
+    def stop(*_):
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        sys.exit(0)
+
+    for slot in range(count):
+        spawn(slot)
+    signal.signal(signal.SIGTERM, stop)
+    print(f"{count} processus démarrés sur {HOST}:{PORT}")
+    logging.info(f"{count} processus démarrés sur {HOST}:{PORT} (SO_REUSEPORT)")
+    while True:
+        pid, status = os.wait()
+        slot = children.pop(pid, None)
+        if slot is None:
+            continue
+        logging.warning(f"Processus {pid} arrêté (statut {status}), relance")
+        time.sleep(1)
+        spawn(slot)
+
 if __name__ == '__main__':
-    start_server()
+    # docker stop envoie SIGTERM : on sort proprement pour écrire les données en attente
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    if WORKERS > 1:
+        start_workers(WORKERS)
+    start_monitoring(METRICS_PORT)
+    store.start()
+    try:
+        serve()
+    finally:
+        store.close()
@@ -0,0 +1,255 @@
+import os
+import re
+import sqlite3
+import threading
+import logging
+
+from metrics import REGISTRY
+
+WORD = re.compile(r"\w+")
+MAX_QUERY_WORDS = 16
+SNIPPET_TOKENS = 12
+
+# index inversé FTS5 : texte du message, participants (jetons r<destinataire>
+# et s<expéditeur> en hexadécimal), puis les champs rendus avec les résultats et le
+# texte partagé par les copies d'un message à plusieurs destinataires (body, NULL sinon)
+SCHEMA = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(
+        message, owners, recipient UNINDEXED, id UNINDEXED, sender UNINDEXED, timestamp UNINDEXED, body UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+    );
+"""
+
+INSERT = "INSERT INTO search (message, owners, recipient, id, sender, timestamp, body) VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+# pertinence BM25 sur le seul texte (poids nul pour les participants), puis les plus
+# récents ; parmi les copies d'un même message, celle de la boîte de l'utilisateur d'abord.
+# Les lignes sont lues au fil de l'eau : les extraits ne sont calculés que pour celles lues
+QUERY = """
+    SELECT recipient, id, sender, timestamp, body, snippet(search, 0, '[', ']', '…', ?) FROM search
+    WHERE search MATCH ? AND rank MATCH 'bm25(1.0, 0.0)'
+    ORDER BY rank, timestamp DESC, recipient = ? DESC
+"""
+
+indexed_messages = REGISTRY.counter("search_indexed_messages_total", "Messages ajoutés à l'index de recherche")
+
+def owner_token(role, user):
+    """
+    Jeton d'un participant dans la colonne owners : un seul mot quel que soit le nom.
+    :param role: "r" (destinataire) ou "s" (expéditeur).
+    :param user: Nom de l'utilisateur.
+    """
+    return role + user.encode().hex()
+
+def outdated(db):
+    """
+    :param db: Connexion SQLite.
+    :return: True si la table search existe dans un format précédent (à reconstruire).
+    """
+    columns = [row[1] for row in db.execute("PRAGMA table_info(search)")]
+    return bool(columns) and "body" not in columns
+
+def document(recipient, msg_id, entry, body=None):
+    """
+    :param recipient: Destinataire.
+    :param msg_id: Identifiant du message dans la boîte.
+    :param entry: Message (sender, timestamp, message).
+    :param body: Identifiant du texte partagé par les copies d'un message à plusieurs destinataires.
+    :return: Ligne de la table search.
+    """
+    owners = f"{owner_token('r', recipient)} {owner_token('s', entry['sender'])}"
+    return entry["message"], owners, recipient, msg_id, entry["sender"], entry["timestamp"], body
+
+def match_expression(user, text, partner=None):
+    """
+    Construit l'expression FTS5 d'une recherche : tous les mots saisis doivent être
+    présents, le dernier pouvant n'être que le début d'un mot ; seuls les messages
+    envoyés ou reçus par l'utilisateur (échangés avec partner, s'il est donné) sont retenus.
+    :param user: Utilisateur qui cherche.
+    :param text: Texte saisi.
+    :param partner: Restreint la recherche à une conversation.
+    :return: Expression, ou None si le texte ne contient aucun mot.
+    """
+    words = WORD.findall(text)[:MAX_QUERY_WORDS]
+    if not words:
+        return None
+    terms = " ".join(f'"{word}"' for word in words) + "*"
+    if partner is None:
+        owners = f'"{owner_token("r", user)}" OR "{owner_token("s", user)}"'
+    else:
+        owners = (f'("{owner_token("r", user)}" "{owner_token("s", partner)}") OR '
+                  f'("{owner_token("r", partner)}" "{owner_token("s", user)}")')
+    return f"owners : ({owners}) AND message : ({terms})"
+
+def search(db, user, text, offset=0, limit=20, partner=None):
+    """
+    Cherche dans les messages d'un utilisateur.
+    :param db: Connexion SQLite contenant la table search.
+    :param user: Utilisateur qui cherche.
+    :param text: Texte saisi.
+    :param offset: Nombre de résultats à sauter (pagination).
+    :param limit: Nombre maximal de résultats.
+    :param partner: Restreint la recherche à une conversation.
+    :return: Résultats du plus pertinent au moins pertinent (recipient, id, sender, timestamp, snippet).
+             Un message envoyé à plusieurs destinataires est indexé une fois par boîte, avec
+             le même body : il n'apparaît qu'une fois (offset compte les résultats ainsi
+             dédoublonnés).
+    """
+    expression = match_expression(user, text, partner)
+    if expression is None or limit <= 0:
+        return []
+    results = []
+    seen = set()
+    rows = db.execute(QUERY, (SNIPPET_TOKENS, expression, user))
+    try:
+        for r, i, s, t, body, snippet in rows:
+            key = ("body", body) if body is not None else (r, i)
+            if key in seen:
+                continue  # autre copie d'un message déjà retenu
+            seen.add(key)
+            if len(seen) > offset:
+                results.append({"recipient": r, "id": i, "sender": s, "timestamp": t, "snippet": snippet})
+                if len(results) >= limit:
+                    break
+    finally:
+        rows.close()
+    return results
+
+def remove(db, archived):
+    """
+    Retire de l'index les messages archivés.
+    :param db: Connexion SQLite contenant la table search.
+    :param archived: Destinataire → dernier identifiant archivé.
+    """
+    for recipient, last in archived.items():
+        db.execute("DELETE FROM search WHERE rowid IN (SELECT rowid FROM search WHERE search MATCH ? AND id <= ?)",
+                   (f'owners : "{owner_token("r", recipient)}"', last))
+
+
+class SearchIndex:
+    """
+    Index de recherche des stockages sur fichiers, dans search.db : l'index inversé est
+    sur disque et seul le cache de pages de SQLite est gardé en mémoire, quel que soit
+    le nombre de messages. Les messages envoyés sont mis en attente par add() et écrits
+    avec les autres données en différé (flush) ; la table indexed garde pour chaque
+    boîte le dernier identifiant indexé, pour compléter l'index au démarrage.
+    Supprimer search.db (ou rebuild=True) le fait reconstruire depuis les boîtes.
+    :param path: Chemin de search.db.
+    :param rebuild: Supprime l'index existant.
+    """
+
+    def __init__(self, path, rebuild=False):
+        self.path = path
+        if not rebuild and os.path.exists(path):
+            db = sqlite3.connect(path)
+            try:
+                rebuild = outdated(db)
+            finally:
+                db.close()
+            if rebuild:
+                logging.info("Index de recherche d'un format précédent")
+        if rebuild:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            logging.info("Index de recherche supprimé, reconstruction depuis les boîtes")
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._pending = []
+        self._cursors = {}  # destinataire → dernier identifiant en attente
+        self.db.executescript(SCHEMA + """
+            CREATE TABLE IF NOT EXISTS indexed (
+                recipient TEXT PRIMARY KEY,
+                last_id INTEGER NOT NULL
+            ) WITHOUT ROWID;
+        """)
+
+    @property
+    def db(self):
+        """
+        Connexion propre au thread courant, ouverte à la première utilisation.
+        """
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def indexed(self):
+        """
+        :return: Destinataire → dernier identifiant indexé.
+        """
+        return dict(self.db.execute("SELECT recipient, last_id FROM indexed"))
+
+    def add(self, recipient, ids, entries, bodies=None):
+        """
+        Met des messages en attente d'indexation.
+        :param recipient: Destinataire.
+        :param ids: Identifiants attribués aux messages.
+        :param entries: Messages (sender, timestamp, message).
+        :param bodies: Identifiants des textes partagés (None pour un message à un seul destinataire).
+        :return: Nombre de messages en attente.
+        """
+        bodies = bodies or [None] * len(ids)
+        with self._lock:
+            self._pending.extend(document(recipient, msg_id, entry, body)
+                                 for msg_id, entry, body in zip(ids, entries, bodies))
+            if ids:
+                self._cursors[recipient] = max(self._cursors.get(recipient, 0), ids[-1])
+            return len(self._pending)
+
+    def flush(self):
+        """
+        Écrit les messages en attente et les curseurs de leurs boîtes, en une transaction.
+        """
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+                cursors, self._cursors = self._cursors, {}
+            if not pending:
+                return
+            db = self.db
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.executemany(INSERT, pending)
+                db.executemany("""
+                    INSERT INTO indexed (recipient, last_id) VALUES (?, ?)
+                    ON CONFLICT (recipient) DO UPDATE SET last_id = MAX(last_id, excluded.last_id)
+                """, cursors.items())
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+            indexed_messages.inc(len(pending))
+
+    def search(self, user, text, offset=0, limit=20, partner=None):
+        """
+        Cherche dans les messages indexés d'un utilisateur (voir search()).
+        """
+        return search(self.db, user, text, offset, limit, partner)
+
+    def remove(self, archived):
+        """
+        Retire de l'index les messages archivés.
+        :param archived: Destinataire → dernier identifiant archivé.
+        """
+        with self._write_lock:
+            db = self.db
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                remove(db, archived)
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def close(self):
+        """
+        Ferme la connexion du thread courant.
+        """
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
@@ -0,0 +1,1807 @@
+import os
+import gzip
+import json
+import sqlite3
+import threading
+import time
+import heapq
+import logging
+from bisect import bisect_right
+from contextlib import contextmanager
+from urllib.parse import quote, unquote
+from metrics import REGISTRY
+import search
+
+PREVIEW_LENGTH = 50
+REAP_MAX_WAIT = 60  # attente maximale du nettoyeur de sessions, en secondes
+
+io_seconds = REGISTRY.histogram("storage_io_seconds", "Durée des lectures et écritures de fichiers", ["operation"])
+
+def load_json(path):
+    """
+    Charge les données d'un fichier JSON.
+    :param path: Chemin du fichier.
+    :return: Données chargées.
+    """
+    with io_seconds.time(operation="load_json"), open(path, 'r') as f:
+        return json.load(f)
+
+def save_json(path, data):
+    """
+    Enregistre les données dans un fichier JSON.
+    Écrit dans un fichier temporaire puis le renomme : un arrêt brutal
+    ne laisse jamais un fichier tronqué.
+    :param path: Chemin du fichier.
+    :param data: Données à enregistrer.
+    """
+    tmp = path + '.tmp'
+    with io_seconds.time(operation="save_json"):
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+def select_messages(entries, since=0, limit=None, sender=None):
+    """
+    Filtre une suite de messages triés par identifiant croissant.
+    :param entries: Messages (chacun avec un champ id).
+    :param since: Curseur : seuls les messages d'identifiant supérieur sont retenus.
+    :param limit: Nombre maximal de messages retournés.
+    :param sender: Ne retient que les messages de cet expéditeur.
+    :return: (messages retenus, curseur à utiliser pour la requête suivante).
+    """
+    selected = []
+    cursor = since
+    for entry in entries:
+        if entry["id"] <= since:
+            continue
+        if limit is not None and len(selected) >= limit:
+            break
+        cursor = entry["id"]
+        if sender is None or entry.get("sender") == sender:
+            selected.append(entry)
+    return selected, cursor
+
+
+def record_summaries(conversations, recipient, entries, ids):
+    """
+    Met à jour les résumés de conversation après l'ajout de messages, en O(1) par message :
+    côté destinataire (un message non lu de plus) et côté expéditeur.
+    :param conversations: Résumés : utilisateur → partenaire → résumé.
+    :param recipient: Destinataire des messages.
+    :param entries: Messages (sender, timestamp, message).
+    :param ids: Identifiants attribués aux messages.
+    """
+    for msg_id, entry in zip(ids, entries):
+        sender = entry["sender"]
+        last = {"timestamp": entry["timestamp"], "sender": sender, "preview": entry["message"][:PREVIEW_LENGTH]}
+        received = conversations.setdefault(recipient, {}).setdefault(
+            sender, {"timestamp": 0, "unread": 0, "last_id": 0, "read_id": 0})
+        if entry["timestamp"] >= received["timestamp"]:
+            received.update(last)
+        received["unread"] += 1
+        received["last_id"] = max(received["last_id"], msg_id)
+        sent = conversations.setdefault(sender, {}).setdefault(
+            recipient, {"timestamp": 0, "unread": 0, "last_id": 0, "read_id": 0})
+        if entry["timestamp"] >= sent["timestamp"]:
+            sent.update(last)
+
+
+def retention_cut(entries, count, acked=0, cutoff=None, max_count=None):
+    """
+    Sélectionne les messages à archiver en tête d'une boîte : acquittés, antérieurs
+    à cutoff, ou en excès au-delà des max_count plus récents. La sélection s'arrête
+    au premier message conservé : seul le début de la boîte est lu.
+    :param entries: Messages de la boîte par identifiant croissant (itérable).
+    :param count: Nombre de messages de la boîte.
+    :param acked: Curseur acquitté par le destinataire.
+    :param cutoff: Horodatage limite (None : pas de limite d'âge).
+    :param max_count: Nombre maximal de messages conservés (None : illimité).
+    :return: Messages à archiver.
+    """
+    excess = count - max_count if max_count else 0
+    archived = []
+    for index, entry in enumerate(entries):
+        if entry["id"] <= acked or index < excess or (cutoff is not None and entry["timestamp"] < cutoff):
+            archived.append(entry)
+        else:
+            break
+    return archived
+
+def write_segment(folder, recipient, entries):
+    """
+    Écrit des messages archivés dans un segment compressé (JSONL gzip),
+    nommé d'après les identifiants du premier et du dernier message.
+    :param folder: Dossier des archives.
+    :param recipient: Destinataire.
+    :param entries: Messages archivés, par identifiant croissant.
+    :return: Chemin du segment.
+    """
+    mailbox = os.path.join(folder, quote(recipient, safe=''))
+    os.makedirs(mailbox, exist_ok=True)
+    path = os.path.join(mailbox, f"{entries[0]['id']:012d}-{entries[-1]['id']:012d}.jsonl.gz")
+    tmp = path + '.tmp'
+    with io_seconds.time(operation="archive"):
+        with open(tmp, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                f.write(b"".join((json.dumps(entry) + '\n').encode() for entry in entries))
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp, path)
+    return path
+
+def session_expiry(created, seen, ttl=None, idle_ttl=None):
+    """
+    Calcule l'échéance d'une session.
+    :param created: Création de la session (secondes epoch).
+    :param seen: Dernière activité connue.
+    :param ttl: Durée de vie maximale (None : illimitée).
+    :param idle_ttl: Inactivité maximale (None : illimitée).
+    :return: Échéance, ou None si la session n'expire pas.
+    """
+    limits = [start + delay for start, delay in ((created, ttl), (seen, idle_ttl)) if delay]
+    return min(limits) if limits else None
+
+def touch_interval(idle_ttl):
+    """
+    Délai minimal entre deux mises à jour de la dernière activité d'une session :
+    un dixième de l'inactivité maximale, pour ne pas écrire à chaque requête.
+    :param idle_ttl: Inactivité maximale (None : pas de suivi).
+    """
+    return max(int(idle_ttl) // 10, 1) if idle_ttl else None
+
+class FileStore:
+    """
+    Base des stockages sur fichiers : utilisateurs, sessions et résumés de conversation
+    dans des fichiers JSON. Les fichiers sont chargés une seule fois en mémoire ; les modifications
+    sont écrites en différé, toutes les flush_interval secondes ou dès que
+    flush_batch modifications sont en attente (flush_interval=0 : écriture immédiate).
+    Les sessions expirent après session_ttl secondes, ou session_idle_ttl secondes
+    sans activité ; un tas trié par échéance permet au nettoyeur de ne visiter que
+    les sessions arrivées à échéance. Au-delà de max_sessions sessions pour un même
+    utilisateur, la plus ancienne est fermée.
+    Toutes les retention_interval secondes, les messages acquittés, plus vieux que
+    retention_max_age ou au-delà des retention_max_count plus récents d'une boîte
+    sont déplacés dans des segments compressés (dossier archive) ; retention.json
+    garde pour chaque boîte le curseur acquitté et le dernier identifiant archivé.
+    La recherche passe par un index FTS5 dans search.db (voir search.SearchIndex),
+    écrit en différé comme le reste et reconstruit au démarrage avec search_rebuild.
+    Les sous-classes fournissent le stockage des messages.
+    """
+
+    def __init__(self, folder, flush_interval=1.0, flush_batch=100, session_ttl=None, session_idle_ttl=None,
+                 max_sessions=None, retention_max_age=None, retention_max_count=None, retention_interval=60,
+                 search_rebuild=False):
+        self.folder = folder
+        self.users_file = os.path.join(folder, 'users.json')
+        self.sessions_file = os.path.join(folder, 'sessions.json')
+        self.conversations_file = os.path.join(folder, 'conversations.json')
+        self.retention_file = os.path.join(folder, 'retention.json')
+        self.archive_folder = os.path.join(folder, 'archive')
+        self.retention_max_age = retention_max_age
+        self.retention_max_count = retention_max_count
+        self.retention_interval = retention_interval
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.session_ttl = session_ttl
+        self.session_idle_ttl = session_idle_ttl
+        self.session_touch = touch_interval(session_idle_ttl)
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._retention_lock = threading.Lock()  # un seul passage de rétention à la fois
+        self._flush_needed = threading.Event()
+        self._stop = threading.Event()
+        self._dirty = set()
+        self._pending = 0
+        os.makedirs(folder, exist_ok=True)
+        for path in [self.users_file, self.sessions_file]:
+            if not os.path.exists(path):
+                save_json(path, {})
+        self._users = load_json(self.users_file)
+        self._sessions = {}       # token → {"user", "created", "seen"}
+        self._user_sessions = {}  # utilisateur → tokens, du plus ancien au plus récent
+        self._expiry = []         # tas (échéance, token), échéances éventuellement dépassées
+        self._load_sessions()
+        self._conversations = {}  # chargés par _load_conversations, une fois les messages accessibles
+        # destinataire → {"acked", "archived"}
+        self._retention = load_json(self.retention_file) if os.path.exists(self.retention_file) else {}
+        self.search = search.SearchIndex(os.path.join(folder, 'search.db'), rebuild=search_rebuild)
+
+    def _load_sessions(self):
+        """
+        Charge les sessions et construit l'index par utilisateur et le tas des échéances.
+        Les sessions au format précédent (token → utilisateur) démarrent maintenant.
+        """
+        now = int(time.time())
+        sessions = load_json(self.sessions_file)
+        ordered = sorted(((token, entry if isinstance(entry, dict) else {"user": entry, "created": now, "seen": now})
+                          for token, entry in sessions.items()), key=lambda item: item[1]["created"])
+        for token, session in ordered:
+            self._sessions[token] = session
+            self._user_sessions.setdefault(session["user"], {})[token] = None
+            self._schedule(token, session)
+
+    def _load_conversations(self):
+        """
+        Charge les résumés de conversation. En leur absence (données antérieures),
+        ils sont reconstruits en parcourant une fois toutes les boîtes ; les messages
+        existants sont alors considérés comme lus.
+        """
+        if os.path.exists(self.conversations_file):
+            self._conversations = load_json(self.conversations_file)
+            return
+        conversations = {}
+        for recipient, messages in self.mailboxes():
+            record_summaries(conversations, recipient, messages, [m["id"] for m in messages])
+        for summaries in conversations.values():
+            for summary in summaries.values():
+                summary["unread"] = 0
+                summary["read_id"] = summary["last_id"]
+        self._conversations = conversations
+        save_json(self.conversations_file, conversations)
+
+    def _load_search(self):
+        """
+        Complète l'index de recherche avec les messages qu'il ne contient pas : toutes
+        les boîtes s'il vient d'être créé, sinon les messages écrits après sa dernière
+        écriture (arrêt brutal avant l'écriture différée).
+        """
+        count = 0
+        for recipient, messages in self.mailboxes(self.search.indexed()):
+            if messages and self.search.add(recipient, [m["id"] for m in messages], messages,
+                                            [m.get("ref") for m in messages]) >= 10000:
+                self.search.flush()
+            count += len(messages)
+        self.search.flush()
+        if count:
+            logging.info(f"Index de recherche : {count} messages indexés")
+
+    def _mark_dirty(self, path):
+        """
+        Signale une modification à écrire (appelé avec self.lock tenu).
+        :param path: Fichier concerné.
+        """
+        self._dirty.add(path)
+        self._pending += 1
+        if self._pending >= self.flush_batch:
+            self._flush_needed.set()
+
+    def _after_write(self):
+        """
+        Écrit immédiatement si l'écriture différée est désactivée.
+        """
+        if not self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Écrit sur disque les fichiers modifiés depuis la dernière écriture.
+        """
+        with self._flush_lock:
+            with self.lock:
+                snapshots = {}
+                if self.users_file in self._dirty:
+                    snapshots[self.users_file] = dict(self._users)
+                if self.sessions_file in self._dirty:
+                    snapshots[self.sessions_file] = {token: dict(session) for token, session in self._sessions.items()}
+                if self.retention_file in self._dirty:
+                    snapshots[self.retention_file] = {r: dict(state) for r, state in self._retention.items()}
+                if self.conversations_file in self._dirty:
+                    snapshots[self.conversations_file] = {
+                        user: {partner: dict(summary) for partner, summary in summaries.items()}
+                        for user, summaries in self._conversations.items()}
+                self._dirty.clear()
+                self._pending = 0
+                self._flush_needed.clear()
+            for path, data in snapshots.items():
+                save_json(path, data)
+            self.search.flush()
+
+    def _flush_loop(self):
+        """
+        Écrit périodiquement les modifications en attente jusqu'à l'arrêt du stockage.
+        """
+        while not self._stop.is_set():
+            self._flush_needed.wait(self.flush_interval)
+            try:
+                self.flush()
+            except (OSError, sqlite3.Error) as e:
+                logging.error(f"Erreur d'écriture différée : {e}")
+
+    def _reap_loop(self):
+        """
+        Supprime les sessions expirées, en dormant jusqu'à la prochaine échéance.
+        """
+        while not self._stop.is_set():
+            with self.lock:
+                now = int(time.time())
+                expired = self._reap(now)
+                delay = self._expiry[0][0] - now if self._expiry else REAP_MAX_WAIT
+            if expired:
+                logging.info(f"{expired} sessions expirées supprimées")
+                self._after_write()
+            self._stop.wait(min(max(delay, 1), REAP_MAX_WAIT))
+
+    def _retention_loop(self):
+        """
+        Applique périodiquement la politique de rétention jusqu'à l'arrêt du stockage.
+        """
+        while not self._stop.wait(self.retention_interval):
+            try:
+                self.apply_retention()
+            except (OSError, sqlite3.Error) as e:
+                logging.error(f"Erreur d'archivage : {e}")
+
+    def start(self):
+        """
+        Démarre l'écriture différée, le nettoyage des sessions expirées et l'archivage.
+        """
+        if self.flush_interval:
+            threading.Thread(target=self._flush_loop, daemon=True).start()
+        if self.session_ttl or self.session_idle_ttl:
+            threading.Thread(target=self._reap_loop, daemon=True).start()
+        if self.retention_interval:
+            threading.Thread(target=self._retention_loop, daemon=True).start()
+
+    def _archived(self, recipient):
+        """
+        :return: Dernier identifiant archivé de la boîte (appelé avec self.lock tenu) ;
+                 les identifiants suivants continuent après lui.
+        """
+        return self._retention.get(recipient, {}).get("archived", 0)
+
+    def ack_messages(self, recipient, cursor):
+        """
+        Enregistre l'acquittement des messages d'une boîte jusqu'à un curseur :
+        ils seront archivés au prochain passage de la rétention.
+        :param recipient: Destinataire.
+        :param cursor: Identifiant du dernier message reçu (borné au dernier message de la boîte).
+        :return: Curseur acquitté.
+        """
+        with self.lock:
+            state = self._retention.setdefault(recipient, {"acked": 0, "archived": 0})
+            cursor = min(cursor, self._last_id(recipient))
+            changed = cursor > state["acked"]
+            if changed:
+                state["acked"] = cursor
+                self._mark_dirty(self.retention_file)
+            acked = state["acked"]
+        if changed:
+            self._after_write()
+        return acked
+
+    def apply_retention(self, now=None):
+        """
+        Archive les messages sortis de la politique de rétention. Seule la sélection
+        des messages se fait sous self.lock ; les segments sont compressés et
+        synchronisés sur disque hors du verrou, avant que retention.json ne soit mis
+        à jour et les messages retirés des boîtes : un arrêt brutal ne perd ni ne
+        renumérote aucun message.
+        :param now: Instant de référence (défaut : maintenant).
+        :return: Nombre de messages archivés.
+        """
+        now = time.time() if now is None else now
+        cutoff = now - self.retention_max_age if self.retention_max_age else None
+        archived = {}  # destinataire → dernier identifiant archivé
+        count = 0
+        with self._retention_lock:
+            with self.lock:
+                recipients = self._recipients()
+            for recipient in recipients:
+                with self.lock:
+                    acked = self._retention.get(recipient, {}).get("acked", 0)
+                    total, entries = self._head(recipient)
+                    try:
+                        batch = retention_cut(entries, total, acked, cutoff, self.retention_max_count)
+                    finally:
+                        entries.close()  # lecture interrompue au premier message conservé
+                if not batch:
+                    continue
+                # seule la rétention retire les messages de tête : la sélection reste valable hors du verrou
+                write_segment(self.archive_folder, recipient, batch)
+                with self.lock:
+                    self._retention.setdefault(recipient, {"acked": 0, "archived": 0})["archived"] = batch[-1]["id"]
+                    self._mark_dirty(self.retention_file)
+                archived[recipient] = batch[-1]["id"]
+                count += len(batch)
+            if archived:
+                self.flush()
+                self._drop(archived)
+                self.search.remove(archived)
+                logging.info(f"{count} messages archivés ({len(archived)} boîtes)")
+        return count
+
+    def close(self):
+        """
+        Arrête les tâches de fond et écrit les modifications en attente.
+        """
+        self._stop.set()
+        self._flush_needed.set()
+        self.flush()
+
+    def get_user(self, username):
+        """
+        Retourne l'empreinte du mot de passe d'un utilisateur.
+        :param username: Nom de l'utilisateur.
+        :return: Empreinte, ou None si l'utilisateur n'existe pas.
+        """
+        with self.lock:
+            return self._users.get(username)
+
+    def create_user(self, username, password_hash):
+        """
+        Crée un utilisateur.
+        :param username: Nom de l'utilisateur.
+        :param password_hash: Empreinte du mot de passe.
+        :return: False si le nom est déjà pris, sinon True.
+        """
+        with self.lock:
+            if username in self._users:
+                return False
+            self._users[username] = password_hash
+            self._mark_dirty(self.users_file)
+        self._after_write()
+        return True
+
+    def _schedule(self, token, session):
+        """
+        Inscrit l'échéance d'une session dans le tas (appelé avec self.lock tenu).
+        """
+        expiry = session_expiry(session["created"], session["seen"], self.session_ttl, self.session_idle_ttl)
+        if expiry is not None:
+            heapq.heappush(self._expiry, (expiry, token))
+
+    def _add_session(self, token, username):
+        """
+        Crée une session, en fermant la plus ancienne de l'utilisateur s'il a
+        atteint max_sessions (appelé avec self.lock tenu).
+        :param token: Token de la session.
+        :param username: Utilisateur associé.
+        """
+        self._remove_session(token)
+        tokens = self._user_sessions.setdefault(username, {})
+        while self.max_sessions and len(tokens) >= self.max_sessions:
+            self._remove_session(next(iter(tokens)))
+        now = int(time.time())
+        session = self._sessions[token] = {"user": username, "created": now, "seen": now}
+        self._user_sessions.setdefault(username, {})[token] = None
+        self._schedule(token, session)
+        self._mark_dirty(self.sessions_file)
+
+    def _remove_session(self, token):
+        """
+        Supprime une session ; son entrée dans le tas est ignorée à l'échéance
+        (appelé avec self.lock tenu).
+        :return: Utilisateur associé, ou None.
+        """
+        session = self._sessions.pop(token, None)
+        if session is None:
+            return None
+        tokens = self._user_sessions[session["user"]]
+        del tokens[token]
+        if not tokens:
+            del self._user_sessions[session["user"]]
+        self._mark_dirty(self.sessions_file)
+        return session["user"]
+
+    def _reap(self, now):
+        """
+        Supprime les sessions arrivées à échéance (appelé avec self.lock tenu).
+        Une session restée active depuis son inscription est réinscrite à sa nouvelle échéance.
+        :param now: Instant courant.
+        :return: Nombre de sessions supprimées.
+        """
+        expired = 0
+        while self._expiry and self._expiry[0][0] <= now:
+            _, token = heapq.heappop(self._expiry)
+            session = self._sessions.get(token)
+            if session is None:
+                continue  # déjà fermée
+            expiry = session_expiry(session["created"], session["seen"], self.session_ttl, self.session_idle_ttl)
+            if expiry is None:
+                continue
+            if expiry > now:
+                heapq.heappush(self._expiry, (expiry, token))
+                continue
+            self._remove_session(token)
+            expired += 1
+        return expired
+
+    def create_session(self, token, username):
+        """
+        Enregistre une session.
+        :param token: Token de la session.
+        :param username: Utilisateur associé.
+        """
+        with self.lock:
+            self._add_session(token, username)
+        self._after_write()
+
+    def get_session(self, token):
+        """
+        Retourne l'utilisateur associé à un token, si la session n'a pas expiré.
+        La dernière activité n'est enregistrée qu'une fois par session_touch secondes.
+        :param token: Token de la session.
+        :return: Nom de l'utilisateur, ou None.
+        """
+        with self.lock:
+            session = self._sessions.get(token) if isinstance(token, str) else None
+            if session is None:
+                return None
+            now = int(time.time())
+            expiry = session_expiry(session["created"], session["seen"], self.session_ttl, self.session_idle_ttl)
+            if expiry is not None and expiry <= now:
+                self._remove_session(token)
+                user = None
+            else:
+                user = session["user"]
+                if not self.session_touch or now - session["seen"] < self.session_touch:
+                    return user
+                session["seen"] = now
+                self._mark_dirty(self.sessions_file)
+        self._after_write()
+        return user
+
+    def delete_session(self, token):
+        """
+        Supprime une session.
+        :param token: Token de la session.
+        :return: Nom de l'utilisateur qui était associé, ou None.
+        """
+        with self.lock:
+            user = self._remove_session(token) if isinstance(token, str) else None
+        self._after_write()
+        return user
+
+    def login(self, username, password_hash, token):
+        """
+        Vérifie le mot de passe et crée la session en une seule opération.
+        :param username: Nom de l'utilisateur.
+        :param password_hash: Empreinte du mot de passe fourni.
+        :param token: Token de la session à créer.
+        :return: True si la session est créée.
+        """
+        with self.lock:
+            if self._users.get(username) != password_hash:
+                return False
+            self._add_session(token, username)
+        self._after_write()
+        return True
+
+    def append_message(self, recipient, entry):
+        """
+        Ajoute un message dans la boîte d'un destinataire.
+        :param recipient: Destinataire.
+        :param entry: Message (sender, timestamp, message).
+        :return: Identifiant attribué au message dans la boîte.
+        """
+        return self.append_messages(recipient, [entry])[0]
+
+    def append_messages(self, recipient, entries):
+        """
+        Ajoute des messages dans la boîte d'un destinataire, en une seule écriture.
+        :param recipient: Destinataire.
+        :param entries: Messages (sender, timestamp, message).
+        :return: Identifiants attribués, dans l'ordre.
+        """
+        return [ids[recipient] for ids in self.append_batch([([recipient], entry) for entry in entries])]
+
+    def list_conversations(self, user):
+        """
+        Retourne les résumés des conversations d'un utilisateur, la plus récente en premier.
+        :param user: Utilisateur.
+        :return: Liste de résumés (partner, timestamp, sender, preview, unread).
+        """
+        with self.lock:
+            summaries = [{"partner": partner, "timestamp": s["timestamp"], "sender": s["sender"],
+                          "preview": s["preview"], "unread": s["unread"]}
+                         for partner, s in self._conversations.get(user, {}).items()]
+        return sorted(summaries, key=lambda s: s["timestamp"], reverse=True)
+
+    def mark_read(self, user, messages):
+        """
+        Marque comme lus des messages remis à un utilisateur.
+        :param user: Destinataire.
+        :param messages: Messages remis, par identifiant croissant.
+        """
+        changed = False
+        with self.lock:
+            summaries = self._conversations.get(user, {})
+            for msg in messages:
+                summary = summaries.get(msg["sender"])
+                if summary is None or msg["id"] <= summary["read_id"]:
+                    continue
+                summary["read_id"] = msg["id"]
+                summary["unread"] = 0 if msg["id"] >= summary["last_id"] else max(summary["unread"] - 1, 0)
+                changed = True
+            if changed:
+                self._mark_dirty(self.conversations_file)
+        if changed:
+            self._after_write()
+
+    def mark_conversation_read(self, user, partner, cursor):
+        """
+        Marque comme lus les messages d'une conversation affichée par le client.
+        :param user: Destinataire.
+        :param partner: Partenaire de conversation.
+        :param cursor: Identifiant du dernier message affiché (borné au dernier message reçu du partenaire).
+        """
+        with self.lock:
+            summary = self._conversations.get(user, {}).get(partner)
+            if summary is None:
+                return
+            last, unread = summary["last_id"], summary["unread"]
+            cursor = min(cursor, last)
+            if cursor <= summary["read_id"]:
+                return
+        # non lus restants : messages du partenaire après le curseur (lus hors du verrou)
+        later = self.get_messages(user, cursor, sender=partner)[0] if cursor < last else []
+        with self.lock:
+            if cursor <= summary["read_id"]:
+                return
+            summary["read_id"] = cursor
+            # les messages arrivés depuis la lecture sont déjà comptés par record_summaries
+            summary["unread"] = max(sum(m["id"] <= last for m in later) + summary["unread"] - unread, 0)
+            self._mark_dirty(self.conversations_file)
+        self._after_write()
+
+    def partners(self, recipient):
+        """
+        Liste les expéditeurs présents dans une boîte (parcours complet de la boîte).
+        :param recipient: Destinataire.
+        :return: Noms triés.
+        """
+        return sorted({entry["sender"] for entry in self.get_messages(recipient)[0]})
+
+    def conversation(self, user, partner, limit=50):
+        """
+        Retourne les derniers messages échangés entre deux utilisateurs, dans les deux sens.
+        :param user: Premier utilisateur.
+        :param partner: Second utilisateur.
+        :param limit: Nombre maximal de messages.
+        :return: Messages triés par date, chacun avec son destinataire.
+        """
+        received = [dict(m, recipient=user) for m in self.get_messages(user, sender=partner)[0]]
+        sent = [dict(m, recipient=partner) for m in self.get_messages(partner, sender=user)[0]]
+        return sorted(received + sent, key=lambda m: m["timestamp"])[-limit:]
+
+    def search_messages(self, user, text, offset=0, limit=20, partner=None):
+        """
+        Cherche dans les messages envoyés et reçus par un utilisateur. Les messages
+        des dernières flush_interval secondes peuvent ne pas encore être indexés.
+        :param user: Utilisateur.
+        :param text: Mots cherchés (le dernier peut être incomplet).
+        :param offset: Nombre de résultats à sauter.
+        :param limit: Nombre maximal de résultats.
+        :param partner: Restreint la recherche à la conversation avec ce partenaire.
+        :return: Résultats par pertinence (recipient, id, sender, timestamp, snippet).
+        """
+        return self.search.search(user, text, offset, limit, partner)
+
+
+class JsonStore(FileStore):
+    """
+    Stockage historique : tous les messages dans messages.json, réécrit à chaque envoi.
+    Les copies d'un message à plusieurs destinataires portent la même référence
+    ("ref" : boîte et identifiant de la première copie), qui n'est pas renvoyée aux clients.
+    """
+
+    def __init__(self, folder, **options):
+        super().__init__(folder, **options)
+        self.messages_file = os.path.join(folder, 'messages.json')
+        if not os.path.exists(self.messages_file):
+            save_json(self.messages_file, {})
+        self._retention_pass = None  # boîtes lues au début d'un passage de la rétention
+        self._load_conversations()
+        self._load_search()
+
+    def mailboxes(self, since=None):
+        """
+        Parcourt toutes les boîtes (une seule lecture du fichier).
+        :param since: Destinataire → curseur : seuls les messages suivants sont retournés.
+        :return: Générateur de (destinataire, messages).
+        """
+        since = since or {}
+        with self.lock:
+            msgs = load_json(self.messages_file)
+        for recipient, mailbox in msgs.items():
+            entries = (dict(entry, id=entry.get("id", i + 1)) for i, entry in enumerate(mailbox))
+            yield recipient, [entry for entry in entries if entry["id"] > since.get(recipient, 0)]
+
+    def append_batch(self, items):
+        """
+        Ajoute des messages, chacun pour un ou plusieurs destinataires, en une seule
+        réécriture du fichier. Ce format historique garde une copie du texte par boîte.
+        :param items: Liste de (destinataires, message (sender, timestamp, message)).
+        :return: Pour chaque message, {destinataire : identifiant attribué}.
+        """
+        results = []
+        with self.lock:
+            msgs = load_json(self.messages_file)
+            for recipients, entry in items:
+                ids = {}
+                ref = None
+                for recipient in recipients:
+                    mailbox = msgs.setdefault(recipient, [])
+                    msg_id = (mailbox[-1].get("id", len(mailbox)) if mailbox else self._archived(recipient)) + 1
+                    if ref is None and len(recipients) > 1:
+                        ref = f"{recipient}:{msg_id}"
+                    mailbox.append(dict(entry, id=msg_id) if ref is None else dict(entry, id=msg_id, ref=ref))
+                    record_summaries(self._conversations, recipient, [entry], [msg_id])
+                    self.search.add(recipient, [msg_id], [entry], [ref])
+                    ids[recipient] = msg_id
+                results.append(ids)
+            save_json(self.messages_file, msgs)
+            self._mark_dirty(self.conversations_file)
+        self._after_write()
+        return results
+
+    def get_messages(self, recipient, since=0, limit=None, sender=None):
+        """
+        Retourne les messages d'une boîte postérieurs à un curseur.
+        Les messages enregistrés avant l'ajout des identifiants sont numérotés selon leur position.
+        :param recipient: Destinataire.
+        :param since: Curseur (identifiant du dernier message déjà reçu).
+        :param limit: Nombre maximal de messages.
+        :param sender: Filtre sur l'expéditeur.
+        :return: (messages, curseur suivant).
+        """
+        with self.lock:
+            mailbox = load_json(self.messages_file).get(recipient, [])
+        entries = (dict(entry, id=entry.get("id", i + 1)) for i, entry in enumerate(mailbox))
+        messages, cursor = select_messages(entries, since, limit, sender)
+        for message in messages:
+            message.pop("ref", None)
+        return messages, cursor
+
+    def _last_id(self, recipient):
+        """
+        :return: Identifiant du dernier message de la boîte (appelé avec self.lock tenu).
+        """
+        mailbox = load_json(self.messages_file).get(recipient, [])
+        return mailbox[-1].get("id", len(mailbox)) if mailbox else self._archived(recipient)
+
+    def _recipients(self):
+        """
+        :return: Destinataires à examiner par la rétention (appelé avec self.lock tenu).
+        Le fichier lu sert aussi aux appels à _head du même passage : les messages
+        en tête de boîte n'en sont retirés que par la rétention elle-même.
+        """
+        self._retention_pass = load_json(self.messages_file)
+        return list(self._retention_pass)
+
+    def _head(self, recipient):
+        """
+        :return: (nombre de messages, messages de la boîte par identifiant croissant).
+        """
+        mailbox = self._retention_pass.get(recipient, [])
+        return len(mailbox), (dict(entry, id=entry.get("id", i + 1)) for i, entry in enumerate(mailbox))
+
+    def _drop(self, archived):
+        """
+        Retire des boîtes les messages archivés (une seule réécriture du fichier).
+        :param archived: Destinataire → dernier identifiant archivé.
+        """
+        with self.lock:
+            self._retention_pass = None
+            msgs = load_json(self.messages_file)
+            for recipient, last in archived.items():
+                entries = (dict(entry, id=entry.get("id", i + 1)) for i, entry in enumerate(msgs.get(recipient, [])))
+                msgs[recipient] = [entry for entry in entries if entry["id"] > last]
+            save_json(self.messages_file, msgs)
+
+
+class LogStore(FileStore):
+    """
+    Stockage des messages en journaux append-only, un fichier JSONL par destinataire.
+    Un index en mémoire conserve l'identifiant et la position de chaque message
+    dans son journal : un envoi ne coûte qu'une écriture en fin de fichier et
+    une lecture depuis un curseur commence directement au bon endroit.
+    Le texte d'un message envoyé à plusieurs destinataires n'est écrit qu'une fois,
+    dans bodies.log ; chaque boîte n'en garde que la référence ("ref"). Un compteur de
+    références par texte permet à la compaction de retirer de bodies.log les textes
+    que plus aucune boîte ne cite (messages archivés).
+    """
+
+    def __init__(self, folder, compact_interval=300, compact_ratio=0.25, **options):
+        super().__init__(folder, **options)
+        self.mailbox_folder = os.path.join(folder, 'mailboxes')
+        self.compact_interval = compact_interval
+        self.compact_ratio = compact_ratio
+        self._ids = {}      # destinataire → identifiants des messages, croissants
+        self._offsets = {}  # destinataire → positions des messages dans le journal
+        self._sizes = {}    # destinataire → taille utile du journal
+        self._dead = {}     # destinataire → octets illisibles à compacter
+        self.bodies_file = os.path.join(folder, 'bodies.log')
+        self._bodies = {}   # identifiant → position des textes partagés dans bodies.log
+        self._bodies_size = 0
+        self._next_body = 1  # prochain identifiant de texte, jamais réattribué
+        self._body_refs = {}  # identifiant → nombre de messages qui citent le texte
+        os.makedirs(self.mailbox_folder, exist_ok=True)
+        if os.path.exists(self.bodies_file):
+            self._scan_bodies()
+        for name in os.listdir(self.mailbox_folder):
+            if name.endswith('.log'):
+                self._scan(unquote(name[:-4]), count_refs=True)
+        self._load_conversations()
+        self._load_search()
+
+    def mailboxes(self, since=None):
+        """
+        Parcourt toutes les boîtes.
+        :param since: Destinataire → curseur : la lecture de chaque boîte commence après lui.
+        :return: Générateur de (destinataire, messages).
+        """
+        since = since or {}
+        with self.lock:
+            recipients = list(self._ids)
+        for recipient in recipients:
+            yield recipient, self._messages(recipient, since.get(recipient, 0), keep_refs=True)[0]
+
+    def _path(self, recipient):
+        """
+        Chemin du journal d'un destinataire (nom encodé pour rester un nom de fichier valide).
+        :param recipient: Destinataire.
+        :return: Chemin du fichier.
+        """
+        return os.path.join(self.mailbox_folder, quote(recipient, safe='') + '.log')
+
+    def _scan(self, recipient, count_refs=False):
+        """
+        Reconstruit l'index d'un journal en le parcourant une fois.
+        Une dernière ligne incomplète (arrêt brutal pendant une écriture) est tronquée.
+        :param recipient: Destinataire.
+        :param count_refs: Compte les références vers bodies.log (au chargement).
+        """
+        path = self._path(recipient)
+        ids = []
+        offsets = []
+        dead = 0
+        offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    logging.warning(f"Journal {path} : dernière ligne incomplète tronquée")
+                    break
+                try:
+                    entry = json.loads(line)
+                    ids.append(entry.get("id", ids[-1] + 1 if ids else 1))
+                    offsets.append(offset)
+                    if count_refs and "ref" in entry:
+                        self._add_ref(entry["ref"])
+                        self._next_body = max(self._next_body, entry["ref"] + 1)
+                except ValueError:
+                    dead += len(line)
+                offset += len(line)
+        if offset != os.path.getsize(path):
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+        self._ids[recipient] = ids
+        self._offsets[recipient] = offsets
+        self._sizes[recipient] = offset
+        self._dead[recipient] = dead
+
+    def _scan_bodies(self):
+        """
+        Reconstruit l'index des textes partagés et le prochain identifiant à attribuer ;
+        une dernière ligne incomplète est tronquée.
+        """
+        offset = 0
+        with open(self.bodies_file, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    logging.warning(f"{self.bodies_file} : dernière ligne incomplète tronquée")
+                    break
+                try:
+                    entry = json.loads(line)
+                    if "id" in entry:
+                        self._bodies[entry["id"]] = offset
+                        self._next_body = max(self._next_body, entry["id"] + 1)
+                    else:
+                        self._next_body = max(self._next_body, entry["next"])  # en-tête, voir _rewrite_bodies
+                except (ValueError, KeyError, TypeError):
+                    pass
+                offset += len(line)
+        if offset != os.path.getsize(self.bodies_file):
+            with open(self.bodies_file, 'r+b') as f:
+                f.truncate(offset)
+        self._bodies_size = offset
+
+    def _add_ref(self, ref, count=1):
+        """
+        Ajoute (ou retire, count négatif) des références vers un texte partagé
+        (appelé avec self.lock tenu).
+        :param ref: Identifiant du texte.
+        :param count: Nombre de références.
+        """
+        refs = self._body_refs.get(ref, 0) + count
+        if refs > 0:
+            self._body_refs[ref] = refs
+        else:
+            self._body_refs.pop(ref, None)
+
+    def _write_entries(self, recipient, stored, entries):
+        """
+        Ajoute des messages en fin de journal du destinataire, en une seule écriture
+        (appelé avec self.lock tenu).
+        :param recipient: Destinataire.
+        :param stored: Lignes à écrire (messages, ou références vers un texte partagé).
+        :param entries: Messages complets correspondants, pour les résumés.
+        :return: Identifiants attribués, dans l'ordre.
+        """
+        first = self._last_id(recipient) + 1
+        size = self._sizes.get(recipient, 0)
+        new_ids = []
+        new_offsets = []
+        lines = []
+        for msg_id, entry in enumerate(stored, first):
+            line = (json.dumps(dict(entry, id=msg_id)) + '\n').encode()
+            if "ref" in entry:
+                self._add_ref(entry["ref"])
+            new_ids.append(msg_id)
+            new_offsets.append(size)
+            size += len(line)
+            lines.append(line)
+        with io_seconds.time(operation="append_log"), open(self._path(recipient), 'ab') as f:
+            f.write(b"".join(lines))
+        self._ids.setdefault(recipient, []).extend(new_ids)
+        self._offsets.setdefault(recipient, []).extend(new_offsets)
+        self._sizes[recipient] = size
+        self._dead.setdefault(recipient, 0)
+        record_summaries(self._conversations, recipient, entries, new_ids)
+        self.search.add(recipient, new_ids, entries, [entry.get("ref") for entry in stored])
+        return new_ids
+
+    def append_batch(self, items):
+        """
+        Ajoute des messages, chacun pour un ou plusieurs destinataires : une écriture
+        par journal concerné, plus une dans bodies.log pour les textes partagés, écrits
+        avant les références.
+        :param items: Liste de (destinataires, message (sender, timestamp, message)).
+        :return: Pour chaque message, {destinataire : identifiant attribué}.
+        """
+        results = [{} for _ in items]
+        with self.lock:
+            pending = {}  # destinataire → [(indice du message, ligne, message complet)]
+            bodies = []
+            next_body = self._next_body
+            for index, (recipients, entry) in enumerate(items):
+                stored = entry
+                if len(recipients) > 1:
+                    line = (json.dumps({"id": next_body, "message": entry["message"]}) + '\n').encode()
+                    self._bodies[next_body] = self._bodies_size + sum(len(b) for b in bodies)
+                    bodies.append(line)
+                    stored = {"sender": entry["sender"], "timestamp": entry["timestamp"], "ref": next_body}
+                    next_body += 1
+                for recipient in recipients:
+                    pending.setdefault(recipient, []).append((index, stored, entry))
+            if bodies:
+                with io_seconds.time(operation="append_log"), open(self.bodies_file, 'ab') as f:
+                    f.write(b"".join(bodies))
+                self._bodies_size += sum(len(b) for b in bodies)
+                self._next_body = next_body
+            for recipient, batch in pending.items():
+                ids = self._write_entries(recipient, [s for _, s, _ in batch], [e for _, _, e in batch])
+                for (index, _, _), msg_id in zip(batch, ids):
+                    results[index][recipient] = msg_id
+            self._mark_dirty(self.conversations_file)
+        self._after_write()
+        return results
+
+    def _read(self, f, ids, begin, end, bodies=None, keep_refs=False):
+        """
+        Lit les messages d'un journal entre deux positions.
+        :param f: Journal ouvert (ouvert sous le verrou : une compaction
+                  concurrente remplace le fichier sans toucher à celui-ci).
+        :param ids: Identifiants des messages lisibles de la plage, dans l'ordre.
+        :param begin: Position de début.
+        :param end: Position de fin.
+        :param bodies: (bodies.log ouvert, positions de ses textes), pour les messages
+                       qui y font référence (voir _open_bodies).
+        :param keep_refs: Garde la référence ("ref") des textes partagés, pour l'index de recherche.
+        :return: Générateur de messages.
+        """
+        try:
+            with f:
+                f.seek(begin)
+                ids = iter(ids)
+                while f.tell() < end:
+                    line = f.readline()
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # ligne illisible, retirée à la prochaine compaction
+                    entry["id"] = next(ids)
+                    ref = entry.get("ref") if keep_refs else entry.pop("ref", None)
+                    if ref is not None:
+                        bodies[0].seek(bodies[1][ref])
+                        entry["message"] = json.loads(bodies[0].readline())["message"]
+                    yield entry
+        finally:
+            if bodies is not None:
+                bodies[0].close()
+
+    def _open_bodies(self):
+        """
+        Ouvre bodies.log avec l'index de ses positions (appelé avec self.lock tenu) :
+        la compaction remplace le fichier et l'index sans toucher à ceux-ci.
+        :return: (bodies.log ouvert en lecture, positions des textes), ou None s'il n'existe pas encore.
+        """
+        return (open(self.bodies_file, 'rb'), self._bodies) if self._bodies else None
+
+    def get_messages(self, recipient, since=0, limit=None, sender=None):
+        """
+        Lit les messages d'une boîte postérieurs à un curseur, en commençant
+        la lecture à la position donnée par l'index.
+        :param recipient: Destinataire.
+        :param since: Curseur (identifiant du dernier message déjà reçu).
+        :param limit: Nombre maximal de messages.
+        :param sender: Filtre sur l'expéditeur.
+        :return: (messages, curseur suivant).
+        """
+        return self._messages(recipient, since, limit, sender)
+
+    def _messages(self, recipient, since=0, limit=None, sender=None, keep_refs=False):
+        """
+        Comme get_messages ; keep_refs garde la référence des textes partagés (voir _read).
+        """
+        with self.lock:
+            ids = self._ids.get(recipient, [])
+            start = bisect_right(ids, since)
+            if start >= len(ids):
+                return [], since
+            stop = len(ids)
+            if sender is None and limit is not None:
+                stop = min(stop, start + limit)
+            begin = self._offsets[recipient][start]
+            end = self._offsets[recipient][stop] if stop < len(ids) else self._sizes[recipient]
+            ids = ids[start:stop]
+            f = open(self._path(recipient), 'rb')
+            bodies = self._open_bodies()
+        return select_messages(self._read(f, ids, begin, end, bodies, keep_refs), since, limit, sender)
+
+    def _last_id(self, recipient):
+        """
+        :return: Identifiant du dernier message de la boîte (appelé avec self.lock tenu).
+        """
+        ids = self._ids.get(recipient)
+        return ids[-1] if ids else self._archived(recipient)
+
+    def _recipients(self):
+        """
+        :return: Destinataires à examiner par la rétention (appelé avec self.lock tenu).
+        """
+        return list(self._ids)
+
+    def _head(self, recipient):
+        """
+        :return: (nombre de messages, messages de la boîte par identifiant croissant, lus à la demande).
+        """
+        ids = self._ids.get(recipient, [])
+        if not ids:
+            return 0, (entry for entry in ())
+        f = open(self._path(recipient), 'rb')
+        return len(ids), self._read(f, ids, self._offsets[recipient][0], self._sizes[recipient], self._open_bodies())
+
+    def _drop(self, archived):
+        """
+        Retire des journaux les messages archivés.
+        :param archived: Destinataire → dernier identifiant archivé.
+        """
+        for recipient, last in archived.items():
+            with self.lock:
+                self._rewrite(recipient, bisect_right(self._ids.get(recipient, []), last))
+
+    def _rewrite(self, recipient, start=0):
+        """
+        Réécrit un journal à partir de son message d'indice start, sans les lignes
+        illisibles, puis reconstruit son index (appelé avec self.lock tenu).
+        :param recipient: Destinataire.
+        :param start: Indice du premier message conservé.
+        """
+        path = self._path(recipient)
+        tmp = path + '.tmp'
+        with open(path, 'rb') as src, open(tmp, 'wb') as dst:
+            for offset in self._offsets[recipient][:start]:
+                src.seek(offset)
+                ref = json.loads(src.readline()).get("ref")
+                if ref is not None:
+                    self._add_ref(ref, -1)
+            for msg_id, offset in zip(self._ids[recipient][start:], self._offsets[recipient][start:]):
+                src.seek(offset)
+                entry = dict(json.loads(src.readline()), id=msg_id)
+                dst.write((json.dumps(entry) + '\n').encode())
+        os.replace(tmp, path)
+        self._scan(recipient)
+
+    def compact(self):
+        """
+        Réécrit les journaux dont la part d'octets illisibles dépasse le seuil.
+        """
+        with self.lock:
+            recipients = [r for r, dead in self._dead.items()
+                          if dead and dead >= self._sizes[r] * self.compact_ratio]
+        for recipient in recipients:
+            with self.lock:
+                reclaimed = self._dead[recipient]
+                self._rewrite(recipient)
+            logging.info(f"Journal de {recipient} compacté ({reclaimed} octets récupérés)")
+        with self.lock:
+            unused = len(self._bodies) - len(self._body_refs)
+            if unused and unused >= len(self._bodies) * self.compact_ratio:
+                self._rewrite_bodies()
+
+    def _rewrite_bodies(self):
+        """
+        Réécrit bodies.log avec les seuls textes encore cités par une boîte, puis
+        remplace l'index de leurs positions (appelé avec self.lock tenu). Les
+        identifiants des textes ne changent pas : les boîtes restent inchangées.
+        Une ligne d'en-tête garde le prochain identifiant, pour qu'un texte retiré ne
+        voie pas son identifiant réattribué après un redémarrage.
+        """
+        tmp = self.bodies_file + '.tmp'
+        bodies = {}
+        header = (json.dumps({"next": self._next_body}) + '\n').encode()
+        size = len(header)
+        with open(self.bodies_file, 'rb') as src, open(tmp, 'wb') as dst:
+            dst.write(header)
+            for body_id, offset in self._bodies.items():
+                if body_id not in self._body_refs:
+                    continue
+                src.seek(offset)
+                line = src.readline()
+                dst.write(line)
+                bodies[body_id] = size
+                size += len(line)
+        os.replace(tmp, self.bodies_file)
+        reclaimed = self._bodies_size - size
+        self._bodies = bodies  # nouvel objet : les lectures en cours gardent l'ancien index
+        self._bodies_size = size
+        logging.info(f"{self.bodies_file} compacté ({reclaimed} octets récupérés)")
+
+    def _compact_loop(self):
+        """
+        Compacte périodiquement les journaux jusqu'à l'arrêt du stockage.
+        """
+        while not self._stop.wait(self.compact_interval):
+            try:
+                self.compact()
+            except OSError as e:
+                logging.error(f"Erreur de compaction : {e}")
+
+    def start(self):
+        """
+        Démarre les tâches de fond communes et la compaction périodique.
+        """
+        super().start()
+        threading.Thread(target=self._compact_loop, daemon=True).start()
+
+
+class SqliteStore:
+    """
+    Stockage SQLite en mode WAL, partageable entre plusieurs processus :
+    chaque thread ouvre sa propre connexion sur data/store.db et les écritures
+    sont sérialisées par SQLite lui-même.
+    Toutes les lectures passent par un index : clé primaire (recipient, id) pour
+    les boîtes, (recipient, sender, id) pour les filtres par expéditeur, la liste
+    des partenaires et les conversations.
+    Les sessions expirent comme pour FileStore ; l'index sur expires_at tient lieu
+    de tas des échéances pour le nettoyeur. La rétention suit aussi FileStore, la
+    table mailboxes tenant lieu de retention.json.
+    Le texte d'un message envoyé à plusieurs destinataires est enregistré une fois
+    dans la table bodies ; les lignes de messages n'en gardent que l'identifiant.
+    La table FTS5 search (voir search.py) est mise à jour dans la transaction de
+    chaque envoi ; elle est remplie depuis les messages à sa création ou avec search_rebuild.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password_hash TEXT NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS sessions (
+            token TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            created_at INTEGER NOT NULL DEFAULT 0,
+            last_seen INTEGER NOT NULL DEFAULT 0,
+            expires_at INTEGER
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS messages (
+            recipient TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            sender TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            body_id INTEGER,
+            PRIMARY KEY (recipient, id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS conversations (
+            owner TEXT NOT NULL,
+            partner TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            sender TEXT NOT NULL,
+            preview TEXT NOT NULL,
+            unread INTEGER NOT NULL DEFAULT 0,
+            last_id INTEGER NOT NULL DEFAULT 0,
+            read_id INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (owner, partner)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS bodies (
+            id INTEGER PRIMARY KEY,
+            message TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS mailboxes (
+            recipient TEXT PRIMARY KEY,
+            acked_id INTEGER NOT NULL DEFAULT 0,
+            archived_id INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID;
+    """
+
+    # résumés des conversations antérieures à la table : dernier message de chaque
+    # paire dans les deux sens, messages existants considérés comme lus
+    BACKFILL_CONVERSATIONS = f"""
+        INSERT INTO conversations (owner, partner, timestamp, sender, preview, unread, last_id, read_id)
+        SELECT owner, partner, timestamp, sender, preview, 0, last_id, last_id FROM (
+            SELECT owner, partner, timestamp, sender, preview,
+                   COALESCE(MAX(received_id) OVER pair, 0) AS last_id,
+                   ROW_NUMBER() OVER (pair ORDER BY timestamp DESC) AS rank
+            FROM (
+                SELECT recipient AS owner, sender AS partner, timestamp, sender,
+                       substr(message, 1, {PREVIEW_LENGTH}) AS preview, id AS received_id FROM messages
+                UNION ALL
+                SELECT sender, recipient, timestamp, sender,
+                       substr(message, 1, {PREVIEW_LENGTH}), NULL FROM messages
+            )
+            WINDOW pair AS (PARTITION BY owner, partner)
+        ) WHERE rank = 1
+    """
+
+    INDEXES = """
+        CREATE INDEX IF NOT EXISTS sessions_by_expiry ON sessions (expires_at) WHERE expires_at IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS sessions_by_user ON sessions (username, created_at);
+        CREATE INDEX IF NOT EXISTS messages_by_sender ON messages (recipient, sender, id);
+    """
+
+    # colonnes ajoutées après la première version du schéma
+    UPGRADES = {
+        "sessions": {
+            "created_at": "INTEGER NOT NULL DEFAULT 0",
+            "last_seen": "INTEGER NOT NULL DEFAULT 0",
+            "expires_at": "INTEGER",
+        },
+        "messages": {
+            "body_id": "INTEGER",
+        },
+    }
+
+    # texte d'une ligne de messages, partagé ou non
+    TEXT = "IIF(body_id IS NULL, message, (SELECT b.message FROM bodies b WHERE b.id = body_id))"
+
+    # index de recherche des messages antérieurs à la table search
+    BACKFILL_SEARCH = f"""
+        INSERT INTO search (message, owners, recipient, id, sender, timestamp, body)
+        SELECT {TEXT}, 'r' || lower(hex(recipient)) || ' s' || lower(hex(sender)), recipient, id, sender, timestamp,
+               body_id
+        FROM messages
+    """
+
+    def __init__(self, folder, busy_timeout=5.0, session_ttl=None, session_idle_ttl=None, max_sessions=None,
+                 retention_max_age=None, retention_max_count=None, retention_interval=60, search_rebuild=False,
+                 **options):
+        self.folder = folder
+        self.path = os.path.join(folder, 'store.db')
+        self.archive_folder = os.path.join(folder, 'archive')
+        self.retention_max_age = retention_max_age
+        self.retention_max_count = retention_max_count
+        self.retention_interval = retention_interval
+        self.busy_timeout = busy_timeout
+        self.session_ttl = session_ttl
+        self.session_idle_ttl = session_idle_ttl
+        self.session_touch = touch_interval(session_idle_ttl)
+        self.max_sessions = max_sessions
+        self._local = threading.local()
+        self._stop = threading.Event()
+        os.makedirs(folder, exist_ok=True)
+        # connexion temporaire : un processus qui fork ensuite ne doit hériter d'aucune connexion
+        db = self._connect()
+        try:
+            tables = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            db.executescript(self.SCHEMA)
+            if "messages" in tables and "conversations" not in tables:
+                db.execute(self.BACKFILL_CONVERSATIONS)
+            for table, columns in self.UPGRADES.items():
+                existing = {row[1] for row in db.execute(f"PRAGMA table_info({table})")}
+                for column, definition in columns.items():
+                    if column not in existing:
+                        db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            db.executescript(self.INDEXES)
+            if (search_rebuild or search.outdated(db)) and "search" in tables:
+                db.execute("DROP TABLE search")
+                tables.discard("search")
+            db.executescript(search.SCHEMA)
+            if "search" not in tables:
+                count = db.execute(self.BACKFILL_SEARCH).rowcount
+                if count:
+                    logging.info(f"Index de recherche : {count} messages indexés")
+            if session_ttl or session_idle_ttl:
+                # sessions ouvertes sans durée de vie : elles démarrent maintenant
+                now = int(time.time())
+                db.execute("UPDATE sessions SET created_at = ?, last_seen = ?, expires_at = ? WHERE expires_at IS NULL",
+                           (now, now, session_expiry(now, now, session_ttl, session_idle_ttl)))
+        finally:
+            db.close()
+
+    def _connect(self):
+        """
+        Ouvre une connexion configurée (WAL, mode autocommit).
+        :return: Connexion SQLite.
+        """
+        db = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    @property
+    def db(self):
+        """
+        Connexion propre au thread courant, ouverte à la première utilisation.
+        """
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = self._connect()
+        return db
+
+    @contextmanager
+    def transaction(self, write=False):
+        """
+        Ouvre une transaction sur la connexion du thread courant.
+        :param write: Prend le verrou d'écriture dès le début (BEGIN IMMEDIATE),
+                      pour qu'une lecture suivie d'une écriture reste cohérente.
+        :return: Gestionnaire de contexte fournissant la connexion.
+        """
+        db = self.db
+        with io_seconds.time(operation="sqlite_write" if write else "sqlite_read"):
+            db.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def _reap_loop(self):
+        """
+        Supprime les sessions expirées, en dormant jusqu'à la prochaine échéance.
+        """
+        while not self._stop.is_set():
+            try:
+                now = int(time.time())
+                with self.transaction(write=True) as db:
+                    expired = db.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,)).rowcount
+                    (next_expiry,) = db.execute("SELECT MIN(expires_at) FROM sessions").fetchone()
+                if expired:
+                    logging.info(f"{expired} sessions expirées supprimées")
+                delay = next_expiry - now if next_expiry is not None else REAP_MAX_WAIT
+            except sqlite3.Error as e:
+                logging.error(f"Erreur de nettoyage des sessions : {e}")
+                delay = REAP_MAX_WAIT
+            self._stop.wait(min(max(delay, 1), REAP_MAX_WAIT))
+
+    def _retention_loop(self):
+        """
+        Applique périodiquement la politique de rétention jusqu'à l'arrêt du stockage.
+        """
+        while not self._stop.wait(self.retention_interval):
+            try:
+                self.apply_retention()
+            except (OSError, sqlite3.Error) as e:
+                logging.error(f"Erreur d'archivage : {e}")
+
+    def start(self):
+        """
+        Démarre le nettoyage des sessions expirées et l'archivage ; les écritures sont
+        validées immédiatement.
+        """
+        if self.session_ttl or self.session_idle_ttl:
+            threading.Thread(target=self._reap_loop, daemon=True).start()
+        if self.retention_interval:
+            threading.Thread(target=self._retention_loop, daemon=True).start()
+
+    def flush(self):
+        """
+        Rien à écrire : chaque écriture est validée immédiatement.
+        """
+
+    def close(self):
+        """
+        Arrête le nettoyage des sessions et ferme la connexion du thread courant.
+        """
+        self._stop.set()
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+    def get_user(self, username):
+        """
+        Retourne l'empreinte du mot de passe d'un utilisateur.
+        :param username: Nom de l'utilisateur.
+        :return: Empreinte, ou None si l'utilisateur n'existe pas.
+        """
+        row = self.db.execute("SELECT password_hash FROM users WHERE username = ?", (username,)).fetchone()
+        return row[0] if row else None
+
+    def create_user(self, username, password_hash):
+        """
+        Crée un utilisateur.
+        :param username: Nom de l'utilisateur.
+        :param password_hash: Empreinte du mot de passe.
+        :return: False si le nom est déjà pris, sinon True.
+        """
+        cursor = self.db.execute("INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)",
+                                 (username, password_hash))
+        return cursor.rowcount == 1
+
+    def _insert_session(self, db, token, username):
+        """
+        Insère une session et supprime au passage les sessions expirées (recherche par index),
+        ainsi que les plus anciennes de l'utilisateur au-delà de max_sessions.
+        :param db: Connexion dans une transaction d'écriture.
+        :param token: Token de la session.
+        :param username: Utilisateur associé.
+        """
+        now = int(time.time())
+        expires_at = session_expiry(now, now, self.session_ttl, self.session_idle_ttl)
+        db.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+        db.execute("DELETE FROM sessions WHERE token = ?", (token,))
+        if self.max_sessions:
+            db.execute("""
+                DELETE FROM sessions WHERE token IN (
+                    SELECT token FROM sessions WHERE username = ?
+                    ORDER BY created_at DESC LIMIT -1 OFFSET ?)
+            """, (username, self.max_sessions - 1))
+        db.execute("INSERT INTO sessions (token, username, created_at, last_seen, expires_at) VALUES (?, ?, ?, ?, ?)",
+                   (token, username, now, now, expires_at))
+
+    def create_session(self, token, username):
+        """
+        Enregistre une session.
+        :param token: Token de la session.
+        :param username: Utilisateur associé.
+        """
+        with self.transaction(write=True) as db:
+            self._insert_session(db, token, username)
+
+    def login(self, username, password_hash, token):
+        """
+        Vérifie le mot de passe et crée la session dans la même transaction.
+        :param username: Nom de l'utilisateur.
+        :param password_hash: Empreinte du mot de passe fourni.
+        :param token: Token de la session à créer.
+        :return: True si la session est créée.
+        """
+        with self.transaction(write=True) as db:
+            row = db.execute("SELECT password_hash FROM users WHERE username = ?", (username,)).fetchone()
+            if not row or row[0] != password_hash:
+                return False
+            self._insert_session(db, token, username)
+            return True
+
+    def get_session(self, token):
+        """
+        Retourne l'utilisateur associé à un token, si la session n'a pas expiré.
+        La dernière activité n'est enregistrée qu'une fois par session_touch secondes.
+        :param token: Token de la session.
+        :return: Nom de l'utilisateur, ou None.
+        """
+        if not isinstance(token, str):
+            return None
+        now = int(time.time())
+        row = self.db.execute("SELECT username, created_at, last_seen FROM sessions "
+                              "WHERE token = ? AND (expires_at IS NULL OR expires_at > ?)", (token, now)).fetchone()
+        if not row:
+            return None
+        username, created_at, last_seen = row
+        if self.session_touch and now - last_seen >= self.session_touch:
+            self.db.execute("UPDATE sessions SET last_seen = ?, expires_at = ? WHERE token = ?",
+                            (now, session_expiry(created_at, now, self.session_ttl, self.session_idle_ttl), token))
+        return username
+
+    def delete_session(self, token):
+        """
+        Supprime une session.
+        :param token: Token de la session.
+        :return: Nom de l'utilisateur qui était associé, ou None.
+        """
+        rows = self.db.execute("DELETE FROM sessions WHERE token = ? RETURNING username", (token,)).fetchall()
+        return rows[0][0] if rows else None
+
+    def append_message(self, recipient, entry):
+        """
+        Ajoute un message dans la boîte d'un destinataire.
+        :param recipient: Destinataire.
+        :param entry: Message (sender, timestamp, message).
+        :return: Identifiant attribué au message dans la boîte.
+        """
+        return self.append_messages(recipient, [entry])[0]
+
+    def append_messages(self, recipient, entries):
+        """
+        Ajoute des messages dans la boîte d'un destinataire, en une transaction.
+        :param recipient: Destinataire.
+        :param entries: Messages (sender, timestamp, message).
+        :return: Identifiants attribués, dans l'ordre.
+        """
+        return [ids[recipient] for ids in self.append_batch([([recipient], entry) for entry in entries])]
+
+    def append_batch(self, items):
+        """
+        Ajoute des messages, chacun pour un ou plusieurs destinataires, en une transaction.
+        Les identifiants sont calculés dans la même transaction que l'insertion.
+        :param items: Liste de (destinataires, message (sender, timestamp, message)).
+        :return: Pour chaque message, {destinataire : identifiant attribué}.
+        """
+        with self.transaction(write=True) as db:
+            next_ids = {}
+            results = []
+            inserted = []
+            rows = []
+            documents = []
+            for recipients, e in items:
+                text, body_id = e["message"], None
+                if len(recipients) > 1:
+                    body_id = db.execute("INSERT INTO bodies (message) VALUES (?)", (text,)).lastrowid
+                    text = ""
+                ids = {}
+                for recipient in recipients:
+                    if recipient not in next_ids:
+                        # après archivage complet de la boîte, la numérotation reprend après le dernier archivé
+                        (next_ids[recipient],) = db.execute("""
+                            SELECT COALESCE(MAX(id), (SELECT archived_id FROM mailboxes WHERE recipient = ?1), 0) + 1
+                            FROM messages WHERE recipient = ?1
+                        """, (recipient,)).fetchone()
+                    msg_id = ids[recipient] = next_ids[recipient]
+                    next_ids[recipient] += 1
+                    inserted.append((recipient, msg_id, e["sender"], e["timestamp"], text, body_id))
+                    rows.append((recipient, e["sender"], e["timestamp"], e["message"][:PREVIEW_LENGTH], msg_id))
+                    documents.append(search.document(recipient, msg_id, e, body_id))
+                results.append(ids)
+            db.executemany("INSERT INTO messages (recipient, id, sender, timestamp, message, body_id)"
+                           " VALUES (?, ?, ?, ?, ?, ?)", inserted)
+            db.executemany(search.INSERT, documents)
+            # résumé du destinataire : un non lu de plus ; résumé de l'expéditeur : dernier message
+            db.executemany("""
+                INSERT INTO conversations (owner, partner, timestamp, sender, preview, unread, last_id)
+                VALUES (?1, ?2, ?3, ?2, ?4, 1, ?5)
+                ON CONFLICT (owner, partner) DO UPDATE SET
+                    timestamp = MAX(timestamp, excluded.timestamp),
+                    sender = IIF(excluded.timestamp >= timestamp, excluded.sender, sender),
+                    preview = IIF(excluded.timestamp >= timestamp, excluded.preview, preview),
+                    unread = unread + 1,
+                    last_id = excluded.last_id
+            """, rows)
+            db.executemany("""
+                INSERT INTO conversations (owner, partner, timestamp, sender, preview)
+                VALUES (?2, ?1, ?3, ?2, ?4)
+                ON CONFLICT (owner, partner) DO UPDATE SET
+                    timestamp = MAX(timestamp, excluded.timestamp),
+                    sender = IIF(excluded.timestamp >= timestamp, excluded.sender, sender),
+                    preview = IIF(excluded.timestamp >= timestamp, excluded.preview, preview)
+            """, [row[:4] for row in rows])
+        return results
+
+    def get_messages(self, recipient, since=0, limit=None, sender=None):
+        """
+        Retourne les messages d'une boîte postérieurs à un curseur.
+        :param recipient: Destinataire.
+        :param since: Curseur (identifiant du dernier message déjà reçu).
+        :param limit: Nombre maximal de messages.
+        :param sender: Filtre sur l'expéditeur.
+        :return: (messages, curseur suivant).
+        """
+        sql = f"SELECT id, sender, timestamp, {self.TEXT} FROM messages WHERE recipient = ?"
+        params = [recipient]
+        if sender is not None:
+            # sans statistiques, SQLite préférerait la clé primaire puis un filtrage
+            sql = (f"SELECT id, sender, timestamp, {self.TEXT} FROM messages INDEXED BY messages_by_sender"
+                   " WHERE recipient = ? AND sender = ?")
+            params.append(sender)
+        sql += " AND id > ? ORDER BY id LIMIT ?"
+        params += [since, -1 if limit is None else limit]
+        with self.transaction() as db:
+            rows = db.execute(sql, params).fetchall()
+            if limit is not None and len(rows) == limit:
+                cursor = rows[-1][0]
+            else:
+                # tous les messages ont été parcourus, même ceux écartés par le filtre
+                (last,) = db.execute("SELECT MAX(id) FROM messages WHERE recipient = ?", (recipient,)).fetchone()
+                cursor = max(since, last or 0)
+        messages = [{"sender": s, "timestamp": t, "message": m, "id": i} for i, s, t, m in rows]
+        return messages, cursor
+
+    def ack_messages(self, recipient, cursor):
+        """
+        Enregistre l'acquittement des messages d'une boîte jusqu'à un curseur :
+        ils seront archivés au prochain passage de la rétention.
+        :param recipient: Destinataire.
+        :param cursor: Identifiant du dernier message reçu (borné au dernier message de la boîte).
+        :return: Curseur acquitté.
+        """
+        with self.transaction(write=True) as db:
+            (acked,) = db.execute("""
+                INSERT INTO mailboxes (recipient, acked_id)
+                VALUES (?1, MIN(?2, (SELECT COALESCE(MAX(id), 0) FROM messages WHERE recipient = ?1)))
+                ON CONFLICT (recipient) DO UPDATE SET acked_id = MAX(acked_id, excluded.acked_id)
+                RETURNING acked_id
+            """, (recipient, cursor)).fetchone()
+        return acked
+
+    def apply_retention(self, now=None):
+        """
+        Archive les messages sortis de la politique de rétention, boîte par boîte :
+        les messages sont choisis dans une transaction de lecture, le segment est
+        écrit hors de toute transaction, puis une transaction d'écriture courte
+        retire les messages (au pire, un arrêt brutal les archive deux fois).
+        :param now: Instant de référence (défaut : maintenant).
+        :return: Nombre de messages archivés.
+        """
+        now = time.time() if now is None else now
+        cutoff = now - self.retention_max_age if self.retention_max_age else None
+        # destinataires distincts par sauts dans la clé primaire
+        recipients = [row[0] for row in self.db.execute("""
+            WITH RECURSIVE r(recipient) AS (
+                SELECT MIN(recipient) FROM messages
+                UNION ALL
+                SELECT (SELECT MIN(recipient) FROM messages WHERE recipient > r.recipient)
+                FROM r WHERE r.recipient IS NOT NULL
+            )
+            SELECT recipient FROM r WHERE recipient IS NOT NULL
+        """).fetchall()]
+        count = 0
+        boxes = 0
+        for recipient in recipients:
+            with self.transaction() as db:
+                row = db.execute("SELECT acked_id FROM mailboxes WHERE recipient = ?", (recipient,)).fetchone()
+                total = 0
+                if self.retention_max_count:
+                    (total,) = db.execute("SELECT COUNT(*) FROM messages WHERE recipient = ?", (recipient,)).fetchone()
+                rows = db.execute(f"SELECT id, sender, timestamp, {self.TEXT} FROM messages"
+                                  " WHERE recipient = ? ORDER BY id", (recipient,))
+                try:
+                    batch = retention_cut(({"sender": s, "timestamp": t, "message": m, "id": i} for i, s, t, m in rows),
+                                          total, row[0] if row else 0, cutoff, self.retention_max_count)
+                finally:
+                    rows.close()
+            if not batch:
+                continue
+            last = batch[-1]["id"]
+            write_segment(self.archive_folder, recipient, batch)
+            with self.transaction(write=True) as db:
+                db.execute("DELETE FROM messages WHERE recipient = ? AND id <= ?", (recipient, last))
+                search.remove(db, {recipient: last})
+                db.execute("""
+                    INSERT INTO mailboxes (recipient, archived_id) VALUES (?, ?)
+                    ON CONFLICT (recipient) DO UPDATE SET archived_id = MAX(archived_id, excluded.archived_id)
+                """, (recipient, last))
+            count += len(batch)
+            boxes += 1
+        if count:
+            logging.info(f"{count} messages archivés ({boxes} boîtes)")
+        return count
+
+    def list_conversations(self, user):
+        """
+        Retourne les résumés des conversations d'un utilisateur, la plus récente en premier.
+        :param user: Utilisateur.
+        :return: Liste de résumés (partner, timestamp, sender, preview, unread).
+        """
+        rows = self.db.execute("SELECT partner, timestamp, sender, preview, unread FROM conversations"
+                               " WHERE owner = ? ORDER BY timestamp DESC", (user,)).fetchall()
+        return [{"partner": p, "timestamp": t, "sender": s, "preview": m, "unread": u} for p, t, s, m, u in rows]
+
+    def mark_read(self, user, messages):
+        """
+        Marque comme lus des messages remis à un utilisateur. Le nombre de non lus
+        restants est recompté par l'index (recipient, sender, id), sur les seuls
+        messages postérieurs à la lecture.
+        :param user: Destinataire.
+        :param messages: Messages remis, par identifiant croissant.
+        """
+        read = {}
+        for msg in messages:
+            read[msg["sender"]] = max(read.get(msg["sender"], 0), msg["id"])
+        if not read:
+            return
+        with self.transaction(write=True) as db:
+            db.executemany("""
+                UPDATE conversations SET
+                    read_id = :id,
+                    unread = (SELECT COUNT(*) FROM messages INDEXED BY messages_by_sender
+                              WHERE recipient = :u AND sender = :p AND id > :id)
+                WHERE owner = :u AND partner = :p AND read_id < :id
+            """, [{"u": user, "p": partner, "id": msg_id} for partner, msg_id in read.items()])
+
+    def mark_conversation_read(self, user, partner, cursor):
+        """
+        Marque comme lus les messages d'une conversation affichée par le client.
+        :param user: Destinataire.
+        :param partner: Partenaire de conversation.
+        :param cursor: Identifiant du dernier message affiché (borné au dernier message reçu du partenaire).
+        """
+        row = self.db.execute("SELECT last_id FROM conversations WHERE owner = ? AND partner = ?",
+                              (user, partner)).fetchone()
+        if row:
+            self.mark_read(user, [{"sender": partner, "id": min(cursor, row[0])}])
+
+    def partners(self, recipient):
+        """
+        Liste les expéditeurs présents dans une boîte.
+        Parcours par sauts dans l'index (recipient, sender, id) : une recherche par
+        expéditeur distinct, quelle que soit la taille de la boîte.
+        :param recipient: Destinataire.
+        :return: Noms triés.
+        """
+        rows = self.db.execute("""
+            WITH RECURSIVE p(sender) AS (
+                SELECT MIN(sender) FROM messages WHERE recipient = :r
+                UNION ALL
+                SELECT (SELECT MIN(sender) FROM messages WHERE recipient = :r AND sender > p.sender)
+                FROM p WHERE p.sender IS NOT NULL
+            )
+            SELECT sender FROM p WHERE sender IS NOT NULL
+        """, {"r": recipient}).fetchall()
+        return [row[0] for row in rows]
+
+    def conversation(self, user, partner, limit=50):
+        """
+        Retourne les derniers messages échangés entre deux utilisateurs, dans les deux sens.
+        :param user: Premier utilisateur.
+        :param partner: Second utilisateur.
+        :param limit: Nombre maximal de messages.
+        :return: Messages triés par date, chacun avec son destinataire.
+        """
+        rows = self.db.execute(f"""
+            SELECT * FROM (
+                SELECT recipient, id, sender, timestamp, {self.TEXT} FROM messages INDEXED BY messages_by_sender
+                WHERE recipient = :u AND sender = :p ORDER BY id DESC LIMIT :n)
+            UNION ALL
+            SELECT * FROM (
+                SELECT recipient, id, sender, timestamp, {self.TEXT} FROM messages INDEXED BY messages_by_sender
+                WHERE recipient = :p AND sender = :u ORDER BY id DESC LIMIT :n)
+        """, {"u": user, "p": partner, "n": limit}).fetchall()
+        messages = [{"recipient": r, "id": i, "sender": s, "timestamp": t, "message": m} for r, i, s, t, m in rows]
+        return sorted(messages, key=lambda m: m["timestamp"])[-limit:]
+
+    def search_messages(self, user, text, offset=0, limit=20, partner=None):
+        """
+        Cherche dans les messages envoyés et reçus par un utilisateur.
+        :param user: Utilisateur.
+        :param text: Mots cherchés (le dernier peut être incomplet).
+        :param offset: Nombre de résultats à sauter.
+        :param limit: Nombre maximal de résultats.
+        :param partner: Restreint la recherche à la conversation avec ce partenaire.
+        :return: Résultats par pertinence (recipient, id, sender, timestamp, snippet).
+        """
+        with self.transaction() as db:
+            return search.search(db, user, text, offset, limit, partner)
+
+
+BACKENDS = {
+    'json': JsonStore,
+    'log': LogStore,
+    'sqlite': SqliteStore,
+}
+
+def open_store(backend, folder, **options):
+    """
+    Instancie le moteur de stockage demandé.
+    :param backend: Nom du moteur ('json', 'log' ou 'sqlite').
+    :param folder: Dossier des données.
+    :param options: Paramètres du moteur (flush_interval, flush_batch...).
+    :return: Instance du stockage.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Moteur de stockage inconnu : {backend}")
+    return BACKENDS[backend](folder, **options)
@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import time
+import socket
+import subprocess
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER = os.path.join(ROOT, "poc-server", "poc-server.py")
+sys.path[:0] = [os.path.join(ROOT, "poc-server"), os.path.join(ROOT, "common")]
+
+
+def free_port():
+    """
+    :return: Port TCP libre sur l'interface locale.
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def legacy_request(port, req, timeout=5):
+    """
+    Envoie une requête historique (objet JSON brut, puis fin d'écriture) et lit la réponse.
+    :param port: Port du serveur.
+    :param req: Requête (dict).
+    :return: Réponse décodée, ou None si le serveur ferme sans répondre.
+    """
+    with socket.create_connection(("127.0.0.1", port), timeout=timeout) as s:
+        s.sendall(json.dumps(req).encode())
+        s.shutdown(socket.SHUT_WR)
+        data = b""
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data) if data else None
+
+
+@pytest.fixture
+def start_server(tmp_path):
+    """
+    Démarre le serveur dans un dossier temporaire ; arrêté à la fin du test.
+    :return: start(**env) → port d'écoute.
+    """
+    processes = []
+
+    def start(**env):
+        port = free_port()
+        env = dict(os.environ, PORT=str(port), METRICS_PORT="0", **{k: str(v) for k, v in env.items()})
+        process = subprocess.Popen([sys.executable, SERVER], cwd=tmp_path, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        processes.append(process)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                return port
+            except OSError:
+                if process.poll() is not None:
+                    break
+                time.sleep(0.05)
+        raise RuntimeError("le serveur n'a pas démarré")
+
+    yield start
+    for process in processes:
+        process.terminate()
+        process.wait(10)
@@ -0,0 +1,40 @@
+import pytest
+
+from conftest import legacy_request
+
+
+def unread(port, token):
+    result = legacy_request(port, {"action": "list_conversations", "token": token})
+    return {c["partner"]: c["unread"] for c in result["conversations"]}
+
+
+@pytest.mark.parametrize("backend", ["json", "log", "sqlite"])
+def test_unread_until_displayed(start_server, backend):
+    port = start_server(STORAGE_BACKEND=backend, SERVER_MODE="asyncio", FLUSH_INTERVAL="0")
+    tokens = {}
+    for name in ["alice", "bob"]:
+        legacy_request(port, {"action": "register", "username": name, "password": "pw"})
+        tokens[name] = legacy_request(port, {"action": "login", "username": name, "password": "pw"})["token"]
+    for text in ["un", "deux", "trois"]:
+        legacy_request(port, {"action": "send_message", "token": tokens["alice"], "to": "bob", "message": text})
+
+    # synchronisation : messages remis sans être lus
+    result = legacy_request(port, {"action": "wait_messages", "token": tokens["bob"], "timeout": 0,
+                                   "mark_read": False})
+    assert [m["message"] for m in result["messages"]] == ["un", "deux", "trois"]
+    assert unread(port, tokens["bob"]) == {"alice": 3}
+
+    # affichage de la conversation jusqu'au deuxième message
+    ids = [m["id"] for m in result["messages"]]
+    read = {"action": "mark_read", "token": tokens["bob"], "with": "alice", "cursor": ids[1]}
+    assert legacy_request(port, read) == {"status": "ok"}
+    assert unread(port, tokens["bob"]) == {"alice": 1}
+    read["cursor"] = 10 ** 9  # borné au dernier message reçu
+    assert legacy_request(port, read) == {"status": "ok"}
+    assert unread(port, tokens["bob"]) == {"alice": 0}
+
+    # les anciens clients marquent toujours lus les messages remis
+    legacy_request(port, {"action": "send_message", "token": tokens["alice"], "to": "bob", "message": "quatre"})
+    assert unread(port, tokens["bob"]) == {"alice": 1}
+    legacy_request(port, {"action": "get_messages", "token": tokens["bob"], "since": ids[-1]})
+    assert unread(port, tokens["bob"]) == {"alice": 0}
@@ -0,0 +1,25 @@
+import uuid
+
+from conftest import legacy_request
+
+
+def test_rotating_tokens_share_the_anonymous_bucket(start_server):
+    port = start_server(RATE_LIMIT_TOKEN="1000:1000", RATE_LIMIT_ANONYMOUS="1:5")
+    assert legacy_request(port, {"action": "register", "username": "alice", "password": "pw"})["status"] == "ok"
+    token = legacy_request(port, {"action": "login", "username": "alice", "password": "pw"})["token"]
+    # 2 requêtes anonymes déjà prises (register, login) : le seau de 5 s'épuise vite
+    statuses = [legacy_request(port, {"action": "get_messages", "token": str(uuid.uuid4())}).get("message")
+                for _ in range(10)]
+    assert statuses.count("rate limited") >= 6
+    assert "unauthorized" in statuses
+    # une session valide garde son propre seau
+    assert legacy_request(port, {"action": "get_messages", "token": token})["status"] == "ok"
+
+
+def test_valid_session_is_limited_per_session(start_server):
+    port = start_server(RATE_LIMIT_TOKEN="1:3")
+    legacy_request(port, {"action": "register", "username": "bob", "password": "pw"})
+    token = legacy_request(port, {"action": "login", "username": "bob", "password": "pw"})["token"]
+    responses = [legacy_request(port, {"action": "get_messages", "token": token}) for _ in range(6)]
+    assert [r["status"] for r in responses[:3]] == ["ok"] * 3
+    assert responses[-1]["message"] == "rate limited" and responses[-1]["retry_after"] > 0
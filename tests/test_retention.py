@@ -0,0 +1,37 @@
+import gzip
+import json
+import os
+
+import pytest
+
+import storage
+from storage import open_store
+
+
+@pytest.mark.parametrize("backend", ["json", "log", "sqlite"])
+def test_segment_written_outside_lock(tmp_path, backend, monkeypatch):
+    store = open_store(backend, str(tmp_path), flush_interval=0, retention_max_count=2, retention_interval=0)
+    written = []
+
+    def write_segment(folder, recipient, entries):
+        # un envoi doit pouvoir passer pendant la compression du segment
+        if backend != "sqlite":
+            assert not store.lock.locked()
+        written.append([entry["id"] for entry in entries])
+        return real(folder, recipient, entries)
+
+    real = storage.write_segment
+    monkeypatch.setattr(storage, "write_segment", write_segment)
+    try:
+        store.append_batch([(["bob"], {"sender": "alice", "timestamp": t, "message": f"m{t}"}) for t in range(5)])
+        store.flush()
+        assert store.apply_retention() == 3
+        assert written == [[1, 2, 3]]
+        messages, _ = store.get_messages("bob")
+        assert [m["id"] for m in messages] == [4, 5]
+        (segment,) = os.listdir(os.path.join(str(tmp_path), "archive", "bob"))
+        with gzip.open(os.path.join(str(tmp_path), "archive", "bob", segment)) as f:
+            assert [json.loads(line)["message"] for line in f] == ["m0", "m1", "m2"]
+        assert store.apply_retention() == 0
+    finally:
+        store.close()
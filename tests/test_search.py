@@ -0,0 +1,23 @@
+import pytest
+
+from storage import open_store
+
+
+@pytest.mark.parametrize("backend", ["json", "log", "sqlite"])
+def test_group_message_found_once(tmp_path, backend):
+    store = open_store(backend, str(tmp_path), flush_interval=0)
+    try:
+        store.append_batch([
+            (["bob", "carol", "dave"], {"sender": "alice", "timestamp": 1, "message": "rendez-vous demain"}),
+            # même texte, même seconde, envois distincts : deux résultats
+            (["bob"], {"sender": "alice", "timestamp": 1, "message": "demain ok"}),
+            (["carol"], {"sender": "alice", "timestamp": 1, "message": "demain ok"}),
+        ])
+        store.flush()
+        hits = store.search_messages("alice", "demain")
+        assert len(hits) == 3
+        assert sorted(hit["snippet"] for hit in hits) == ["[demain] ok", "[demain] ok", "rendez-vous [demain]"]
+        assert [hit["recipient"] for hit in store.search_messages("carol", "rendez")] == ["carol"]
+        assert "ref" not in store.get_messages("carol")[0][0]
+    finally:
+        store.close()
@@ -0,0 +1,13 @@
+from conftest import legacy_request
+
+
+def test_legacy_request_asyncio(start_server):
+    port = start_server(SERVER_MODE="asyncio")
+    assert legacy_request(port, {"action": "ping", "id": 7}) == {"status": "ok", "id": 7}
+    assert legacy_request(port, {"action": "register", "username": "alice", "password": "pw"})["status"] == "ok"
+    assert legacy_request(port, {"action": "login", "username": "alice", "password": "pw"})["token"]
+
+
+def test_legacy_request_threads(start_server):
+    port = start_server(SERVER_MODE="threads")
+    assert legacy_request(port, {"action": "ping", "id": 7}) == {"status": "ok", "id": 7}